@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""Recurrent vs feed-forward clinical encoders: train time, latency and AUC.
+
+Every patient is fed to the clinical model as a length-1 sequence, so the LSTM/GRU
+gates buy nothing temporal. This trains each candidate on the same split and
+epochs and reports, side by side:
+
+    params        trainable parameter count
+    train s       wall time of model.fit
+    1-row ms      median latency of a single-patient forward pass (model(x), eager)
+    rows/s        batched inference throughput over the test split (predict_on_batch)
+    val/test AUC  ROC AUC of the trained model
+    feat          width of extract_rnn_features (must be 32 for the fusion layer)
+
+Usage:
+    python benchmarks/bench_clinical_encoder.py --input Clinical_and_Other_Features.xlsx --epochs 30
+"""
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+CANDIDATES = {
+    'bilstm128': dict(rnn_type='LSTM', units=128, bidirectional=True),
+    'gru64': dict(rnn_type='GRU', units=64, bidirectional=False),
+    'dense128': dict(rnn_type='Dense', units=128),
+    'dense64': dict(rnn_type='Dense', units=64),
+}
+
+
+def load_splits(input_path):
+    from clinical_data_rnn import (load_clinical_table, find_target_column, drop_metadata_rows,
+                                   ClinicalEncoder, encode_clinical_data, split_rnn_sequences)
+
+    clinical_df = drop_metadata_rows(load_clinical_table(input_path))
+    target_col = find_target_column(clinical_df)
+    encoded_df = encode_clinical_data(clinical_df, encoder=ClinicalEncoder(target_col=target_col).fit(clinical_df))
+    _, _, train, val, test = split_rnn_sequences(encoded_df, target_col)
+    return [(X.astype(np.float32), np.asarray(y, dtype=np.float32)) for X, y in (train, val, test)]
+
+
+def run_candidate(tf, params, splits, epochs, batch_size, latency_runs):
+    from sklearn.metrics import roc_auc_score
+
+    from clinical_data_rnn import build_advanced_rnn_model, extract_rnn_features
+    from tf_input import make_dataset
+
+    (X_train, y_train), (X_val, y_val), (X_test, y_test) = splits
+    tf.keras.backend.clear_session()
+    tf.keras.utils.set_random_seed(42)
+    model = build_advanced_rnn_model(input_shape=X_train.shape[1:], **params)
+
+    start = time.perf_counter()
+    model.fit(make_dataset(X_train, y_train, batch_size=batch_size, shuffle=True),
+              epochs=epochs, verbose=0)
+    train_seconds = time.perf_counter() - start
+
+    row = tf.convert_to_tensor(X_test[:1])
+    model(row, training=False)
+    latencies = []
+    for _ in range(latency_runs):
+        start = time.perf_counter()
+        model(row, training=False)
+        latencies.append(time.perf_counter() - start)
+
+    model.predict_on_batch(X_test)
+    start = time.perf_counter()
+    test_prob = np.asarray(model.predict_on_batch(X_test)).ravel()
+    throughput = len(X_test) / (time.perf_counter() - start)
+
+    val_prob = np.asarray(model.predict_on_batch(X_val)).ravel()
+    return {
+        'params': model.count_params(),
+        'train_seconds': train_seconds,
+        'latency_ms': 1000 * float(np.median(latencies)),
+        'rows_per_sec': throughput,
+        'val_auc': roc_auc_score(y_val, val_prob),
+        'test_auc': roc_auc_score(y_test, test_prob),
+        'feature_width': extract_rnn_features(model, X_test[:2]).shape[1],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare recurrent and dense clinical encoders")
+    parser.add_argument('--input', default='./Clinical_and_Other_Features.xlsx')
+    parser.add_argument('--epochs', type=int, default=30)
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--latency_runs', type=int, default=200)
+    parser.add_argument('--models', nargs='+', default=list(CANDIDATES), choices=list(CANDIDATES))
+    args = parser.parse_args(argv)
+
+    os.environ.setdefault('TF_CPP_MIN_LOG_LEVEL', '2')
+    import tensorflow as tf
+
+    splits = load_splits(args.input)
+    results = {name: run_candidate(tf, CANDIDATES[name], splits, args.epochs, args.batch_size, args.latency_runs)
+               for name in args.models}
+
+    print(f"{'model':<10} {'params':>8} {'train s':>8} {'1-row ms':>9} {'rows/s':>9} "
+          f"{'val AUC':>8} {'test AUC':>8} {'feat':>5}")
+    for name, r in results.items():
+        print(f"{name:<10} {r['params']:>8} {r['train_seconds']:>8.1f} {r['latency_ms']:>9.2f} "
+              f"{r['rows_per_sec']:>9.0f} {r['val_auc']:>8.3f} {r['test_auc']:>8.3f} {r['feature_width']:>5}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
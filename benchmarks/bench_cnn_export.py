@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""Eager vs exported/compiled TumorFeatureCNN throughput on CPU.
+
+For the unmasked and masked variants at 224x224, times a forward pass per batch
+size (1 to 64 by default) through:
+
+    eager     TumorFeatureCNN as mri_images_cnn.extract_features runs it
+    compile   torch.compile(model), Inductor kernels JIT-built in this process
+    program   export_cnn(..., compiled=False), the portable ExportedProgram
+    aoti      export_cnn(..., compiled=True), the AOTInductor package
+
+Both archives are reloaded through load_cnn_export, which does not need the
+TumorFeatureCNN class. Each runtime's output is checked against eager before
+timing. Reported per cell: images/sec (median over --runs) and the speedup over
+eager.
+
+Usage:
+    python benchmarks/bench_cnn_export.py --batch_sizes 1 4 16 64 --threads 4
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import warnings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import torch
+
+RUNTIMES = ('eager', 'compile', 'program', 'aoti')
+
+
+def images_per_sec(model, images, masks, runs):
+    with torch.inference_mode():
+        model(images, masks)  # warm-up (and torch.compile's compile for this shape)
+        seconds = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            model(images, masks)
+            seconds.append(time.perf_counter() - start)
+    return len(images) / float(np.median(seconds))
+
+
+def build_runtimes(use_mask, tmp_dir):
+    from mri_images_cnn import TumorFeatureCNN, export_cnn, load_cnn_export
+
+    torch.manual_seed(42)
+    model = TumorFeatureCNN(use_mask=use_mask, in_channels=1).eval()
+    runtimes = {'eager': model, 'compile': torch.compile(model)}
+    for name, compiled in (('program', False), ('aoti', True)):
+        path = os.path.join(tmp_dir, f"cnn_{'mask' if use_mask else 'nomask'}_{name}.pt2")
+        start = time.perf_counter()
+        export_cnn(model, path, compiled=compiled)
+        print(f"  {name}: exported in {time.perf_counter() - start:.1f}s, {os.path.getsize(path) / 1024:.0f} KiB")
+        runtimes[name] = load_cnn_export(path)
+    return runtimes
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark eager vs compiled TumorFeatureCNN throughput")
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32, 64])
+    parser.add_argument('--variants', nargs='+', choices=('nomask', 'mask'), default=['nomask', 'mask'])
+    parser.add_argument('--runtimes', nargs='+', choices=RUNTIMES, default=list(RUNTIMES))
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--threads', type=int, default=None, help="torch intra-op threads")
+    args = parser.parse_args(argv)
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    # torch.export/jit deprecation chatter is not useful here
+    warnings.simplefilter("ignore", FutureWarning)
+    print(f"torch {torch.__version__}, {torch.get_num_threads()} threads")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for variant in args.variants:
+            print(f"\n{variant}:")
+            runtimes = {name: model for name, model in build_runtimes(variant == 'mask', tmp_dir).items()
+                        if name in args.runtimes or name == 'eager'}
+            generator = torch.Generator().manual_seed(0)
+            table = {}
+            for batch_size in args.batch_sizes:
+                images = torch.rand((batch_size, 1, 224, 224), generator=generator)
+                masks = (torch.rand((batch_size, 1, 224, 224), generator=generator) > 0.5).float()
+                with torch.inference_mode():
+                    expected = runtimes['eager'](images, masks)
+                    for name, model in runtimes.items():
+                        diff = (model(images, masks) - expected).abs().max().item()
+                        if diff > 1e-4:
+                            raise SystemExit(f"{variant} {name} differs from eager by {diff:.2e}")
+                table[batch_size] = {name: images_per_sec(model, images, masks, args.runs)
+                                     for name, model in runtimes.items()}
+
+            print(f"{'batch':>5} " + " ".join(f"{name + ' img/s':>13}" for name in runtimes))
+            for batch_size, row in table.items():
+                cells = [f"{row['eager']:>13.1f}"] + [f"{row[name]:>7.1f} ({row[name] / row['eager']:.2f}x)"
+                                                      for name in runtimes if name != 'eager']
+                print(f"{batch_size:>5} " + " ".join(cells))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
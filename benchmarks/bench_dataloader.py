@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""DataLoader throughput across worker counts.
+
+Iterates a BreastMRIDataset (raw DICOM/NRRD) or a MemmapMRIDataset (pre-baked tensor
+store) through make_mri_loader for every requested num_workers value and reports
+images/sec for the first epoch (worker start-up, cold cache) and the steady-state
+epochs (persistent workers, warm cache).
+
+Usage:
+    python benchmarks/bench_dataloader.py --images_dir data/images/ --masks_dir data/masks/ \\
+        --clinical_csv data/clinical.csv --workers 0 1 2 4 8
+    python benchmarks/bench_dataloader.py --store mri_store --workers 0 2 4
+"""
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from torchvision.transforms import Resize, Compose
+
+from mri_images_cnn import BreastMRIDataset, make_mri_loader, collect_patients
+from tensor_store import MemmapMRIDataset
+from volume_cache import VolumeCache
+
+
+def build_dataset(args):
+    transform = Compose([Resize((224, 224))])
+    if args.store:
+        return MemmapMRIDataset(args.store, transform=transform, use_mask=True)
+    patients = collect_patients(args.images_dir, args.masks_dir, args.clinical_csv)
+    cache = VolumeCache(cache_dir=args.cache_dir) if args.cache_dir else None
+    return BreastMRIDataset(
+        series_dirs=[series_dir for _, series_dir, _, _ in patients],
+        mask_paths=[mask_path for _, _, mask_path, _ in patients],
+        labels=[label for _, _, _, label in patients],
+        transform=transform,
+        use_mask=True,
+        cache=cache,
+    )
+
+
+def time_epochs(dataset, num_workers, batch_size, epochs):
+    loader = make_mri_loader(dataset, batch_size=batch_size, num_workers=num_workers, shuffle=True)
+    epoch_times = []
+    for _ in range(epochs):
+        start = time.perf_counter()
+        for images, masks, labels, mask_present in loader:
+            pass
+        epoch_times.append(time.perf_counter() - start)
+    return epoch_times
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark MRI DataLoader throughput across worker counts")
+    parser.add_argument('--store', default=None, help="tensor store prefix (skips DICOM decoding)")
+    parser.add_argument('--images_dir', default=None)
+    parser.add_argument('--masks_dir', default=None)
+    parser.add_argument('--clinical_csv', default=None)
+    parser.add_argument('--cache_dir', default=None, help="optional VolumeCache directory for the raw dataset")
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 1, 2, 4])
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--epochs', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    dataset = build_dataset(args)
+    print(f"{len(dataset)} patients, batch_size={args.batch_size}, epochs={args.epochs}")
+    print(f"{'workers':>8} {'first epoch img/s':>18} {'steady img/s':>13}")
+    for num_workers in args.workers:
+        epoch_times = time_epochs(dataset, num_workers, args.batch_size, args.epochs)
+        first = len(dataset) / epoch_times[0]
+        steady_times = epoch_times[1:] or epoch_times
+        steady = len(dataset) * len(steady_times) / sum(steady_times)
+        print(f"{num_workers:>8} {first:>18.1f} {steady:>13.1f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
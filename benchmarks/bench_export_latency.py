@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""Single-row latency of the Keras models before and after TFLite export.
+
+For each given model (the clinical RNN and/or the fusion model) this exports a
+TFLite copy per quantization mode with model_export.export_tflite and times one
+row through each runtime:
+
+    keras predict   model.predict(x), how the pipeline scripts call it
+    keras call      model(x, training=False), eager, no data adapter
+    tflite <mode>   TFLiteModel.predict(x) for none / float16 / int8
+
+Reported per row: median and p99 latency, file size, and the max absolute
+difference from Keras on the parity rows.
+
+Usage:
+    python benchmarks/bench_export_latency.py --rnn_model best_model.keras --fusion_model fusion_model.keras
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+
+def time_calls(fn, runs):
+    fn()
+    latencies = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - start)
+    return 1000 * np.percentile(latencies, [50, 99])
+
+
+def bench_model(tf, path, args, tmp_dir):
+    from model_export import QUANTIZATION_MODES, TFLiteModel, export_tflite, check_parity
+
+    model = tf.keras.models.load_model(path, compile=False)
+    rng = np.random.default_rng(0)
+    xs = [rng.standard_normal((1,) + tuple(t.shape[1:])).astype(np.float32) for t in model.inputs]
+    x = xs if len(xs) > 1 else xs[0]
+    tensor_x = [tf.convert_to_tensor(a) for a in xs] if len(xs) > 1 else tf.convert_to_tensor(xs[0])
+
+    rows = [('keras predict', time_calls(lambda: model.predict(x, verbose=0), args.predict_runs),
+             os.path.getsize(path), 0.0),
+            ('keras call', time_calls(lambda: model(tensor_x, training=False), args.runs),
+             os.path.getsize(path), 0.0)]
+    for mode in QUANTIZATION_MODES:
+        lite_path = os.path.join(tmp_dir, f"{os.path.basename(path)}.{mode}.tflite")
+        size = export_tflite(model, lite_path, quantize=mode)
+        lite = TFLiteModel(lite_path, num_threads=args.threads)
+        diff = check_parity(model, lite_path, n_rows=args.parity_rows)['probability']
+        rows.append((f"tflite {mode}", time_calls(lambda: lite.predict(x), args.runs), size, diff))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Single-row latency: Keras vs exported TFLite models")
+    parser.add_argument('--rnn_model', default=None, help="best_model.keras from clinical_data_rnn.py")
+    parser.add_argument('--fusion_model', default=None, help="fusion_model.keras from fusion_layer.py")
+    parser.add_argument('--runs', type=int, default=500)
+    parser.add_argument('--predict_runs', type=int, default=50, help="runs for the slow model.predict path")
+    parser.add_argument('--parity_rows', type=int, default=256)
+    parser.add_argument('--threads', type=int, default=None, help="TFLite interpreter threads")
+    args = parser.parse_args(argv)
+    models = [path for path in (args.rnn_model, args.fusion_model) if path]
+    if not models:
+        parser.error("give --rnn_model and/or --fusion_model")
+
+    os.environ.setdefault('TF_CPP_MIN_LOG_LEVEL', '2')
+    import tensorflow as tf
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for path in models:
+            rows = bench_model(tf, path, args, tmp_dir)
+            baseline = rows[0][1][0]
+            print(f"\n{path}")
+            print(f"{'runtime':<15} {'p50 ms':>9} {'p99 ms':>9} {'speedup':>8} {'KiB':>7} {'max diff':>9}")
+            for name, (p50, p99), size, diff in rows:
+                print(f"{name:<15} {p50:>9.3f} {p99:>9.3f} {baseline / p50:>7.0f}x {size / 1024:>7.0f} {diff:>9.1e}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
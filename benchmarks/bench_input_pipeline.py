@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""Training steps/sec with NumPy arrays vs tf.data input pipelines.
+
+Trains the gated fusion model (on the aligned feature stores) or the advanced RNN
+(on the encoded clinical sheet) for a few epochs per feed and reports steady-state
+steps/sec, leaving out the first epoch (graph tracing):
+
+    numpy   model.fit(arrays, batch_size=...)             the previous behaviour
+    tfdata  model.fit(tf_input.make_dataset(...))
+    stream  model.fit(tf_input.stream_fused_features(...)) fusion only, reads the memory maps
+
+--tile repeats the rows to simulate a larger cohort (the stream feed reads a tiled
+copy of the stores written to a temporary directory).
+
+Usage:
+    python benchmarks/bench_input_pipeline.py --model fusion --tile 20 --epochs 4
+    python benchmarks/bench_input_pipeline.py --model rnn --input Clinical_and_Other_Features.xlsx
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+
+def epoch_timer(tf):
+    class EpochTimer(tf.keras.callbacks.Callback):
+        def on_train_begin(self, logs=None):
+            self.times = []
+
+        def on_epoch_begin(self, epoch, logs=None):
+            self.start = time.perf_counter()
+
+        def on_epoch_end(self, epoch, logs=None):
+            self.times.append(time.perf_counter() - self.start)
+
+    return EpochTimer()
+
+
+def time_fit(tf, build, feed, epochs, steps):
+    """Steady-state steps/sec of model.fit on one feed (first epoch left out)"""
+    tf.keras.backend.clear_session()
+    tf.keras.utils.set_random_seed(42)
+    model = build()
+    timer = epoch_timer(tf)
+    x, y, kwargs = feed()
+    model.fit(x, y, epochs=epochs, verbose=0, callbacks=[timer], **kwargs)
+    steady = timer.times[1:] or timer.times
+    return steps / np.mean(steady)
+
+
+def fusion_feeds(tf, args, tmp_dir):
+    from feature_store import save_features
+    from fusion_layer import load_aligned_features, build_gated_fusion_model
+    from tf_input import make_dataset, stream_fused_features
+
+    X_cnn, X_rnn, y, ids = load_aligned_features(args.cnn_features, args.rnn_features)
+    X_cnn, X_rnn, y = (np.tile(a, (args.tile,) + (1,) * (a.ndim - 1)) for a in (X_cnn, X_rnn, y))
+    tiled_ids = [f"{patient}#{i}" for i in range(args.tile) for patient in ids]
+
+    cnn_path, rnn_path = os.path.join(tmp_dir, "cnn"), os.path.join(tmp_dir, "rnn")
+    save_features(cnn_path, X_cnn, y, tiled_ids)
+    save_features(rnn_path, X_rnn, y, tiled_ids)
+
+    build = lambda: build_gated_fusion_model(X_cnn.shape[1], X_rnn.shape[1])
+    feeds = {
+        'numpy': lambda: ({'cnn_in': X_cnn, 'rnn_in': X_rnn}, y, {'batch_size': args.batch_size}),
+        'tfdata': lambda: (make_dataset({'cnn_in': X_cnn, 'rnn_in': X_rnn}, y,
+                                        batch_size=args.batch_size, shuffle=True), None, {}),
+        'stream': lambda: (stream_fused_features(cnn_path, rnn_path, batch_size=args.batch_size,
+                                                 shuffle=True, block_rows=args.block_rows), None, {}),
+    }
+    return build, feeds, len(y)
+
+
+def rnn_feeds(tf, args):
+    from clinical_data_rnn import build_advanced_rnn_model
+    from rnn_sweep import load_sweep_data
+    from tf_input import make_dataset
+
+    X_train, y_train, _, _ = load_sweep_data(args.input)
+    X_train = np.tile(X_train, (args.tile, 1, 1))
+    y_train = np.tile(y_train, args.tile)
+
+    build = lambda: build_advanced_rnn_model(input_shape=X_train.shape[1:], units=128)
+    feeds = {
+        'numpy': lambda: (X_train, y_train, {'batch_size': args.batch_size}),
+        'tfdata': lambda: (make_dataset(X_train, y_train, batch_size=args.batch_size, shuffle=True), None, {}),
+    }
+    return build, feeds, len(y_train)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark model.fit steps/sec for NumPy vs tf.data feeds")
+    parser.add_argument('--model', choices=('fusion', 'rnn'), default='fusion')
+    parser.add_argument('--cnn_features', default='cnn_features')
+    parser.add_argument('--rnn_features', default='rnn_features')
+    parser.add_argument('--input', default='./Clinical_and_Other_Features.xlsx', help="clinical sheet (--model rnn)")
+    parser.add_argument('--tile', type=int, default=1, help="repeat the rows this many times")
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--epochs', type=int, default=4)
+    parser.add_argument('--block_rows', type=int, default=65536, help="rows per read of the stream feed")
+    args = parser.parse_args(argv)
+
+    os.environ.setdefault('TF_CPP_MIN_LOG_LEVEL', '2')
+    import tensorflow as tf
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if args.model == 'fusion':
+            build, feeds, n_rows = fusion_feeds(tf, args, tmp_dir)
+        else:
+            build, feeds, n_rows = rnn_feeds(tf, args)
+        steps = -(-n_rows // args.batch_size)
+        print(f"{args.model}: {n_rows} rows, {steps} steps/epoch, batch size {args.batch_size}")
+
+        results = {name: time_fit(tf, build, feed, args.epochs, steps) for name, feed in feeds.items()}
+
+    baseline = results['numpy']
+    print(f"{'feed':<8} {'steps/s':>9} {'vs numpy':>9}")
+    for name, steps_per_sec in results.items():
+        print(f"{name:<8} {steps_per_sec:>9.1f} {steps_per_sec / baseline:>8.2f}x")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""Full-slice vs mask-ROI-cropped CNN inputs: resolution on the mask and compute per patient.
+
+For every configuration (the full slice at 224x224, then ROI crops at the given
+sizes) this builds a BreastMRIDataset over the patients and reports:
+
+    on mask   mean fraction of the CNN input pixels inside the mask (where the resolution goes)
+    GFLOP     TumorFeatureCNN multiply-adds x2 per patient at that input size
+    cnn ms    measured forward time per patient (batches of --batch_size)
+    cold ms   decode + crop + resize per patient with an empty cache
+    warm ms   the same with the ROI boxes and decoded series cached
+
+Usage:
+    python benchmarks/bench_roi_crop.py --images_dir data/images/ --masks_dir data/masks/ \\
+        --clinical_csv data/clinical.csv --sizes 224 160 128 96 --roi_margin 0.1
+"""
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import torch
+
+
+def cnn_gflops(model, size):
+    """Conv multiply-adds x2 of one TumorFeatureCNN forward at size x size (padding keeps the size)"""
+    macs = sum(conv.in_channels * conv.out_channels * conv.kernel_size[0] * conv.kernel_size[1]
+               for conv in (model.conv1, model.conv2, model.conv3))
+    return 2 * macs * size * size / 1e9
+
+
+def run_config(patients, size, roi_margin, args):
+    from torchvision.transforms import Resize
+
+    from mri_images_cnn import BreastMRIDataset, TumorFeatureCNN, collate_mri_batch
+    from volume_cache import VolumeCache
+
+    cache = VolumeCache()
+
+    def dataset():
+        return BreastMRIDataset([p[1] for p in patients], [p[2] for p in patients], [p[3] for p in patients],
+                                transform=Resize((size, size)), use_mask=True, cache=cache,
+                                roi_margin=roi_margin, target_size=(size, size))
+
+    timings = {}
+    for phase in ('cold', 'warm'):
+        data = dataset()
+        start = time.perf_counter()
+        items = [data[i] for i in range(len(data))]
+        timings[phase] = 1000 * (time.perf_counter() - start) / len(items)
+
+    images, masks, _, present = collate_mri_batch(items)
+    on_mask = float(masks[present].gt(0).float().mean()) if present.any() else float('nan')
+
+    torch.manual_seed(42)
+    model = TumorFeatureCNN(use_mask=args.use_mask, in_channels=1).eval()
+    with torch.inference_mode():
+        model(images[:args.batch_size], masks[:args.batch_size])
+        start = time.perf_counter()
+        for batch in range(0, len(images), args.batch_size):
+            model(images[batch:batch + args.batch_size], masks[batch:batch + args.batch_size])
+        cnn_ms = 1000 * (time.perf_counter() - start) / len(images)
+    return {'on_mask': on_mask, 'gflops': cnn_gflops(model, size), 'cnn_ms': cnn_ms, **timings}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark mask-ROI cropping against full-slice CNN inputs")
+    parser.add_argument('--images_dir', required=True)
+    parser.add_argument('--masks_dir', required=True)
+    parser.add_argument('--clinical_csv', required=True)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[224, 160, 128, 96], help="ROI input sizes")
+    parser.add_argument('--roi_margin', type=float, default=0.1)
+    parser.add_argument('--patients', type=int, default=None, help="use only the first N patients")
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--use_mask', action='store_true', help="CNN takes the mask channel")
+    parser.add_argument('--threads', type=int, default=None, help="torch intra-op threads")
+    args = parser.parse_args(argv)
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    from mri_images_cnn import collect_patients
+
+    patients = [p for p in collect_patients(args.images_dir, args.masks_dir, args.clinical_csv) if p[2] is not None]
+    patients = patients[:args.patients] if args.patients else patients
+    print(f"{len(patients)} patients with masks")
+
+    configs = [('full', 224, None)] + [('roi', size, args.roi_margin) for size in args.sizes]
+    results = [(name, size, run_config(patients, size, margin, args)) for name, size, margin in configs]
+
+    full = results[0][2]
+    print(f"{'input':<9} {'on mask':>8} {'GFLOP':>7} {'cnn ms':>8} {'vs full':>8} {'cold ms':>8} {'warm ms':>8}")
+    for name, size, r in results:
+        print(f"{f'{name} {size}':<9} {r['on_mask']:>8.2f} {r['gflops']:>7.2f} {r['cnn_ms']:>8.1f} "
+              f"{full['cnn_ms'] / r['cnn_ms']:>7.1f}x {r['cold']:>8.1f} {r['warm']:>8.1f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
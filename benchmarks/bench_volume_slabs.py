@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""Peak memory and time of TumorFeatureCNN3D.forward_volume vs series depth and slab size.
+
+Each configuration runs in a fresh spawned process on a random (1, 1, Z, S, S)
+volume, so ru_maxrss is that configuration's own peak. Reported:
+
+    base MB   RSS after torch import and allocating the volume
+    peak MB   peak RSS during forward_volume
+    +MB       peak - base, the activation memory of the slab passes
+    s/vol     wall time of one volume
+
+With slabs, +MB should stay flat as Z grows. --whole adds one slab spanning the
+whole series (slab_depth = Z), the unbounded baseline. Keep Z modest with --whole.
+
+Usage:
+    python benchmarks/bench_volume_slabs.py --depths 64 160 --slab_depths 8 16 --size 224
+"""
+
+import os
+import sys
+import time
+import argparse
+import resource
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _rss_mb():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _run(depth, size, slab_depth, overlap, slab_batch, use_mask, threads, results):
+    import torch
+
+    from mri_images_cnn import TumorFeatureCNN3D
+
+    torch.set_num_threads(threads)
+    torch.manual_seed(42)
+    model = TumorFeatureCNN3D(use_mask=use_mask, slab_depth=slab_depth, slab_overlap=overlap,
+                              slab_batch=slab_batch).eval()
+    volume = torch.rand((1, 1, depth, size, size))
+    mask = (torch.rand((1, 1, depth, size, size)) > 0.5).float() if use_mask else None
+    base = _rss_mb()
+    start = time.perf_counter()
+    with torch.inference_mode():
+        features = model.forward_volume(volume, mask)
+    results.put({'seconds': time.perf_counter() - start, 'base': base, 'peak': _rss_mb(),
+                 'width': features.shape[1]})
+
+
+def measure(depth, size, slab_depth, overlap, args):
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=_run, args=(depth, size, slab_depth, overlap, args.slab_batch,
+                                                 args.use_mask, args.threads, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark peak memory of slab-wise 3D feature extraction")
+    parser.add_argument('--depths', type=int, nargs='+', default=[64, 160], help="slices per series")
+    parser.add_argument('--slab_depths', type=int, nargs='+', default=[8, 16])
+    parser.add_argument('--overlap', type=int, default=4)
+    parser.add_argument('--slab_batch', type=int, default=2)
+    parser.add_argument('--size', type=int, default=224, help="slice height/width")
+    parser.add_argument('--use_mask', action='store_true')
+    parser.add_argument('--whole', action='store_true', help="also run one slab spanning the whole series")
+    parser.add_argument('--threads', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    print(f"{'Z':>5} {'slab':>6} {'base MB':>8} {'peak MB':>8} {'+MB':>7} {'s/vol':>7}")
+    for depth in args.depths:
+        slabs = [(slab, min(args.overlap, slab - 1)) for slab in args.slab_depths]
+        if args.whole:
+            slabs.append((depth, 0))
+        for slab_depth, overlap in slabs:
+            r = measure(depth, args.size, slab_depth, overlap, args)
+            label = 'whole' if slab_depth == depth and args.whole else str(slab_depth)
+            print(f"{depth:>5} {label:>6} {r['base']:>8.0f} {r['peak']:>8.0f} {r['peak'] - r['base']:>7.0f} "
+                  f"{r['seconds']:>7.1f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""Closed-loop load generator for inference_server.py.
+
+--concurrency client threads each keep one keep-alive connection open and send
+POST /predict requests back to back until --requests_total have completed. The
+request bodies come from a JSON-lines file (cycled) or from a single
+--series_dir/--clinical_json pair. The client-side latency percentiles and
+throughput are printed next to the server's own /stats report.
+
+Usage:
+    python benchmarks/load_generator.py --url http://127.0.0.1:8080 --requests patients.jsonl \\
+        --requests_total 500 --concurrency 8
+    python benchmarks/load_generator.py --socket /tmp/fusion.sock --series_dir data/images/Breast_MRI_001/... \\
+        --clinical_json row.json
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import threading
+import http.client
+from urllib.parse import urlparse
+
+import numpy as np
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=60):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def connect(args):
+    if args.socket:
+        return UnixHTTPConnection(args.socket)
+    url = urlparse(args.url)
+    return http.client.HTTPConnection(url.hostname, url.port or 80, timeout=60)
+
+
+def call(conn, method, path, body=None):
+    headers = {"Content-Type": "application/json"} if body is not None else {}
+    conn.request(method, path, body=body, headers=headers)
+    response = conn.getresponse()
+    return response.status, json.loads(response.read())
+
+
+def wait_for_server(args, timeout):
+    """Poll GET /health until the server answers (it loads and warms its models first)"""
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            conn = connect(args)
+            status, _ = call(conn, "GET", "/health")
+            conn.close()
+            if status == 200:
+                return
+        except OSError:
+            pass
+        if time.perf_counter() > deadline:
+            raise SystemExit(f"Server did not come up within {timeout:.0f}s")
+        time.sleep(0.5)
+
+
+def load_bodies(args):
+    if args.requests:
+        with open(args.requests) as f:
+            return [line.strip().encode() for line in f if line.strip()]
+    clinical = {}
+    if args.clinical_json:
+        with open(args.clinical_json) as f:
+            clinical = json.load(f)
+    return [json.dumps({'series_dir': args.series_dir, 'mask_path': args.mask_path,
+                        'clinical': clinical}).encode()]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Drive inference_server.py and report latency percentiles")
+    parser.add_argument('--url', default='http://127.0.0.1:8080')
+    parser.add_argument('--socket', default=None, help="Unix socket of the server (instead of --url)")
+    parser.add_argument('--requests', default=None, help="JSON-lines file of /predict request bodies")
+    parser.add_argument('--series_dir', default=None, help="single DICOM series to request (without --requests)")
+    parser.add_argument('--mask_path', default=None)
+    parser.add_argument('--clinical_json', default=None, help="JSON object with the clinical row")
+    parser.add_argument('--requests_total', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--wait', type=float, default=120.0, help="seconds to wait for the server to come up")
+    args = parser.parse_args(argv)
+    if not args.requests and not args.series_dir:
+        parser.error("give --requests or --series_dir")
+
+    bodies = load_bodies(args)
+    wait_for_server(args, args.wait)
+    latencies, errors = [], []
+    counter = iter(range(args.requests_total))
+    lock = threading.Lock()
+
+    def worker():
+        conn = connect(args)
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                break
+            start = time.perf_counter()
+            status, payload = call(conn, "POST", "/predict", bodies[i % len(bodies)])
+            elapsed = time.perf_counter() - start
+            with lock:
+                (latencies if status == 200 else errors).append(elapsed if status == 200 else payload)
+        conn.close()
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+
+    latencies = np.asarray(latencies) * 1000.0
+    print(f"{len(latencies)} ok, {len(errors)} errors in {wall:.2f}s "
+          f"({len(latencies) / wall:.1f} req/s at concurrency {args.concurrency})")
+    if errors:
+        print("First error:", errors[0])
+    if latencies.size:
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+        print(f"client latency ms: p50 {p50:.1f}  p90 {p90:.1f}  p99 {p99:.1f}  max {latencies.max():.1f}")
+
+    conn = connect(args)
+    _, stats = call(conn, "GET", "/stats")
+    conn.close()
+    print("server /stats:", json.dumps(stats))
+    return 0 if not errors else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
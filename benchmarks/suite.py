@@ -0,0 +1,391 @@
+# -*- coding: utf-8 -*-
+"""Pipeline benchmark suite on a synthetic cohort, with stored results for regression checks.
+
+Generates (or reuses) a synthetic_data cohort in --data_dir and times each stage
+of the pipeline on it, every benchmark in a fresh spawned process so its imports,
+caches and ru_maxrss are its own:
+
+    load_dicom_series     decode + collapse + resize of every series, no volume cache
+    load_nrrd_mask        read + collapse of every segmentation
+    read_clinical_excel   parse of the clinical sheet (what the Parquet snapshot avoids)
+    encode_clinical_data  ClinicalEncoder fit + transform of the parsed sheet
+    cnn_extraction        TumorFeatureCNN over the cohort, decode included (extract_features)
+    rnn_training          advanced RNN on the encoded sheet (train_with_advanced_callbacks)
+    fusion_training       gated fusion model on random CNN/RNN-width features, one row per sheet row
+
+Each benchmark runs once to warm up and then --repeats times; the table shows the
+median and minimum seconds, throughput at the median and peak RSS. Results are
+written to --results_dir as <UTC time>-<commit>.json together with the git commit,
+library versions and cohort parameters. --compare checks the run against an
+earlier result file (or "latest", the newest one with the same cohort and
+settings) and exits with status 1 if any median got slower by more than
+--tolerance.
+
+Usage:
+    python benchmarks/suite.py --patients 16 --size 256 --depth 32 --clinical_rows 2000
+    python benchmarks/suite.py --only load_dicom_series cnn_extraction --compare latest --tolerance 0.15
+"""
+
+import os
+import sys
+import glob
+import json
+import queue
+import time
+import argparse
+import platform
+import resource
+import statistics
+import subprocess
+import tempfile
+import warnings
+import multiprocessing
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import synthetic_data
+
+# Bump when a benchmark changes what it measures so old results are not compared against
+SUITE_VERSION = 1
+
+
+def _rss_mb():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _patients(paths):
+    from mri_images_cnn import collect_patients
+
+    return collect_patients(paths['images_dir'], paths['masks_dir'], paths['clinical_csv'])
+
+
+def _clinical_table(paths):
+    from clinical_data_rnn import read_clinical_excel, drop_metadata_rows
+
+    return drop_metadata_rows(read_clinical_excel(paths['clinical_xlsx']))
+
+
+def _encoded_sequences(paths):
+    from clinical_data_rnn import ClinicalEncoder, encode_clinical_data, find_target_column, split_rnn_sequences
+
+    df = _clinical_table(paths)
+    target_col = find_target_column(df)
+    encoded = encode_clinical_data(df, encoder=ClinicalEncoder(target_col=target_col).fit(df))
+    return split_rnn_sequences(encoded, target_col)
+
+
+"""Benchmarks"""
+
+# Each bench_* prepares its inputs outside the timed region and returns (run, items, unit):
+# run() is the timed call, items/unit what its throughput is counted in
+
+def bench_load_dicom_series(paths, args):
+    from mri_images_cnn import load_dicom_series
+
+    series_dirs = [p[1] for p in _patients(paths)]
+
+    def run():
+        for series_dir in series_dirs:
+            load_dicom_series(series_dir)
+    return run, len(series_dirs), 'series'
+
+
+def bench_load_nrrd_mask(paths, args):
+    from mri_images_cnn import load_nrrd_mask
+
+    mask_paths = [p[2] for p in _patients(paths) if p[2] is not None]
+
+    def run():
+        for mask_path in mask_paths:
+            load_nrrd_mask(mask_path)
+    return run, len(mask_paths), 'masks'
+
+
+def bench_read_clinical_excel(paths, args):
+    from clinical_data_rnn import read_clinical_excel
+
+    rows = len(_clinical_table(paths))
+    return (lambda: read_clinical_excel(paths['clinical_xlsx'])), rows, 'rows'
+
+
+def bench_encode_clinical_data(paths, args):
+    from clinical_data_rnn import ClinicalEncoder, encode_clinical_data, find_target_column
+
+    df = _clinical_table(paths)
+    target_col = find_target_column(df)
+
+    def run():
+        encode_clinical_data(df, encoder=ClinicalEncoder(target_col=target_col).fit(df))
+    return run, len(df), 'rows'
+
+
+def bench_cnn_extraction(paths, args):
+    import torch
+    from torchvision.transforms import Resize
+
+    from mri_images_cnn import BreastMRIDataset, TumorFeatureCNN, extract_features
+
+    patients = _patients(paths)
+    dataset = BreastMRIDataset([p[1] for p in patients], [p[2] for p in patients], [p[3] for p in patients],
+                               transform=Resize((224, 224)), use_mask=True)
+    torch.manual_seed(42)
+    model = TumorFeatureCNN(use_mask=True, in_channels=1).eval()
+    return (lambda: extract_features(model, dataset, batch_size=args.batch_size)), len(patients), 'images'
+
+
+def bench_rnn_training(paths, args):
+    import tensorflow as tf
+
+    from clinical_data_rnn import build_advanced_rnn_model, train_with_advanced_callbacks
+
+    _, _, (X_train, y_train), (X_val, y_val), _ = _encoded_sequences(paths)
+    checkpoint = os.path.join(tempfile.mkdtemp(prefix='bench_rnn_'), 'model.keras')
+
+    def run():
+        tf.keras.backend.clear_session()
+        tf.keras.utils.set_random_seed(42)
+        # Same architecture as clinical_data_rnn.main
+        model = build_advanced_rnn_model((X_train.shape[1], X_train.shape[2]), rnn_type='LSTM', units=128)
+        train_with_advanced_callbacks(model, X_train, y_train, X_val, y_val, batch_size=args.batch_size,
+                                      epochs=args.epochs, early_stopping_patience=args.epochs,
+                                      model_checkpoint_path=checkpoint)
+    return run, args.epochs * len(X_train), 'rows'
+
+
+def bench_fusion_training(paths, args):
+    import numpy as np
+    import tensorflow as tf
+
+    from clinical_data_rnn import find_target_column
+    from fusion_layer import build_gated_fusion_model
+    from tf_input import make_dataset
+
+    df = _clinical_table(paths)
+    y = df[find_target_column(df)].to_numpy(dtype=np.float32)
+    rng = np.random.default_rng(0)
+    # TumorFeatureCNN and extract_rnn_features widths
+    X_cnn = rng.standard_normal((len(y), 128), dtype=np.float32)
+    X_rnn = rng.standard_normal((len(y), 32), dtype=np.float32)
+
+    def run():
+        tf.keras.backend.clear_session()
+        tf.keras.utils.set_random_seed(42)
+        model = build_gated_fusion_model(X_cnn.shape[1], X_rnn.shape[1])
+        model.fit(make_dataset({'cnn_in': X_cnn, 'rnn_in': X_rnn}, y, batch_size=args.batch_size, shuffle=True),
+                  epochs=args.epochs, verbose=0)
+    return run, args.epochs * len(y), 'rows'
+
+
+BENCHMARKS = {
+    'load_dicom_series': bench_load_dicom_series,
+    'load_nrrd_mask': bench_load_nrrd_mask,
+    'read_clinical_excel': bench_read_clinical_excel,
+    'encode_clinical_data': bench_encode_clinical_data,
+    'cnn_extraction': bench_cnn_extraction,
+    'rnn_training': bench_rnn_training,
+    'fusion_training': bench_fusion_training,
+}
+
+
+"""Running"""
+
+def _run(name, paths, args, results):
+    # Keep TF's start-up logging, warnings and Keras progress bars out of the table
+    os.environ.setdefault('TF_CPP_MIN_LOG_LEVEL', '2')
+    warnings.simplefilter('ignore')
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        import torch
+
+        import instrumentation
+
+        torch.set_num_threads(args.threads)
+        instrumentation.setup_logging('WARNING')
+
+        run, items, unit = BENCHMARKS[name](paths, args)
+        run()  # warm-up: imports, graph tracing, allocator and page cache
+        times = []
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start)
+        results.put({'times': times, 'items': items, 'unit': unit, 'peak_rss_mb': _rss_mb()})
+    except Exception as e:
+        results.put({'error': f"{type(e).__name__}: {e}"})
+
+
+def measure(name, paths, args):
+    """Run one benchmark in a spawned process and summarize its timings"""
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=_run, args=(name, paths, args, results))
+    process.start()
+    result = None
+    while result is None:
+        try:
+            result = results.get(timeout=1.0)
+        except queue.Empty:
+            if process.is_alive():
+                continue
+            # Exited without a result (OOM kill, native crash, ...); it may still have put one just before exiting
+            try:
+                result = results.get(timeout=1.0)
+            except queue.Empty:
+                result = {'error': f"exit code {process.exitcode}"}
+    process.join()
+    if 'error' in result:
+        return result
+    median = statistics.median(result['times'])
+    return {
+        **result,
+        'median_s': median,
+        'min_s': min(result['times']),
+        'per_sec': result['items'] / median if median > 0 else 0.0,
+    }
+
+
+def _git(*cmd):
+    try:
+        return subprocess.run(['git', *cmd], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment():
+    """Commit, host and library versions the results were measured with"""
+    from importlib.metadata import version, PackageNotFoundError
+
+    versions = {}
+    for package in ('numpy', 'pandas', 'torch', 'tensorflow', 'pydicom', 'SimpleITK'):
+        try:
+            versions[package] = version(package)
+        except PackageNotFoundError:
+            versions[package] = None
+    return {
+        'commit': _git('rev-parse', '--short', 'HEAD'),
+        'dirty': bool(_git('status', '--porcelain', '--untracked-files=no')),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'versions': versions,
+    }
+
+
+def settings(args, cohort):
+    """Everything that must match for two result files to be comparable"""
+    return {'suite_version': SUITE_VERSION, 'cohort': cohort, 'repeats': args.repeats, 'epochs': args.epochs,
+            'batch_size': args.batch_size, 'threads': args.threads}
+
+
+def save_result(results_dir, record):
+    os.makedirs(results_dir, exist_ok=True)
+    stamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+    path = os.path.join(results_dir, f"{stamp}-{record['env']['commit'] or 'nogit'}.json")
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(record, f, indent=2)
+    os.replace(tmp_path, path)
+    return path
+
+
+def find_baseline(results_dir, record, exclude=None):
+    """Newest result file in results_dir measured with the same settings, or None"""
+    for path in sorted(glob.glob(os.path.join(results_dir, '*.json')), reverse=True):
+        if path == exclude:
+            continue
+        try:
+            with open(path) as f:
+                candidate = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if candidate.get('settings') == record['settings']:
+            return path
+    return None
+
+
+def compare(record, baseline, tolerance):
+    """Print median ratios against baseline and return the names that regressed"""
+    if baseline['settings'] != record['settings']:
+        print("Baseline was measured with different settings, the ratios below are not comparable")
+    regressions = []
+    print(f"{'benchmark':<22} {'base s':>9} {'now s':>9} {'ratio':>7}")
+    for name, now in record['results'].items():
+        base = baseline['results'].get(name)
+        if base is None or 'error' in base or 'error' in now:
+            continue
+        ratio = now['median_s'] / base['median_s'] if base['median_s'] > 0 else float('inf')
+        flag = ''
+        if ratio > 1 + tolerance:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print(f"{name:<22} {base['median_s']:>9.3f} {now['median_s']:>9.3f} {ratio:>6.2f}x{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on a synthetic cohort")
+    parser.add_argument('--data_dir', default=os.path.join(tempfile.gettempdir(), 'breast_mri_synthetic'),
+                        help="cohort directory, reused while its parameters match")
+    parser.add_argument('--patients', type=int, default=16)
+    parser.add_argument('--size', type=int, default=256, help="slice height/width")
+    parser.add_argument('--depth', type=int, default=32, help="slices per series")
+    parser.add_argument('--clinical_rows', type=int, default=1000)
+    parser.add_argument('--template', default=None, help="real clinical sheet to resample (see synthetic_data.py)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), default=None)
+    parser.add_argument('--repeats', type=int, default=3, help="timed runs after the warm-up")
+    parser.add_argument('--epochs', type=int, default=3, help="epochs of the training benchmarks")
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--threads', type=int, default=1, help="torch intra-op threads")
+    parser.add_argument('--results_dir', default=os.path.join(ROOT, 'benchmarks', 'results'))
+    parser.add_argument('--no_save', action='store_true', help="don't write a result file")
+    parser.add_argument('--compare', default=None, help='result file to compare against, or "latest"')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="allowed median slowdown before a benchmark counts as a regression")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    paths = synthetic_data.generate(args.data_dir, patients=args.patients, size=args.size, depth=args.depth,
+                                    clinical_rows=args.clinical_rows, template=args.template, seed=args.seed)
+    cohort = synthetic_data.read_manifest(args.data_dir)
+    print(f"Cohort {args.data_dir}: {args.patients} patients of {args.depth}x{args.size}x{args.size}, "
+          f"{cohort['clinical_rows']} clinical rows ({time.perf_counter() - start:.1f}s)")
+
+    record = {'env': environment(), 'settings': settings(args, cohort), 'results': {}}
+    print(f"{'benchmark':<22} {'median s':>9} {'min s':>9} {'throughput':>18} {'peak MB':>8}")
+    for name in args.only or BENCHMARKS:
+        r = measure(name, paths, args)
+        record['results'][name] = r
+        if 'error' in r:
+            print(f"{name:<22} failed: {r['error']}")
+            continue
+        throughput = f"{r['per_sec']:.1f} {r['unit']}/s"
+        print(f"{name:<22} {r['median_s']:>9.3f} {r['min_s']:>9.3f} {throughput:>18} {r['peak_rss_mb']:>8.0f}")
+
+    saved = None
+    if not args.no_save:
+        saved = save_result(args.results_dir, record)
+        print(f"Results written to {saved}")
+
+    if args.compare:
+        baseline_path = args.compare
+        if baseline_path == 'latest':
+            baseline_path = find_baseline(args.results_dir, record, exclude=saved)
+            if baseline_path is None:
+                print("No earlier result with the same settings to compare against")
+                return 0
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        print(f"Compared with {baseline_path} (commit {baseline['env']['commit']}):")
+        regressions = compare(record, baseline, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} regression(s) above {args.tolerance:.0%}: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
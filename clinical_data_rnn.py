@@ -11,36 +11,24 @@ Original file is located at
 # **Environment Setup and Imports**
 """
 
-# Commented out IPython magic to ensure Python compatibility.
-import torch
+import os
 import re
-import torch.nn as nn
-import torch.optim as optim
-import tensorflow as tf
-from tensorflow import keras
+import sys
+import glob
+import json
+import hashlib
+import argparse
+
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-from sklearn.preprocessing import LabelEncoder, StandardScaler
-from sklearn.impute import SimpleImputer
-from sklearn.model_selection import train_test_split
-from tensorflow.keras.models import Sequential
-from tensorflow.keras.layers import SimpleRNN, LSTM, GRU, Dense, Dropout
-from tensorflow.keras.optimizers import Adam
-from sklearn.metrics import classification_report, confusion_matrix, roc_curve, auc
-from tensorflow.keras.layers import Concatenate, BatchNormalization, Input, Bidirectional
-from tensorflow.keras.callbacks import EarlyStopping, ModelCheckpoint, ReduceLROnPlateau
-from tensorflow.keras.regularizers import l1_l2
-from tensorflow.keras.models import Sequential, Model
-from sklearn.metrics import classification_report, confusion_matrix, roc_curve, auc, precision_recall_curve
-
-# Clone repository and set working directory
-!git clone https://github.com/alexander-harmaty/Breast-Cancer-Prognosis-Prediction.git
-# %cd Breast-Cancer-Prognosis-Prediction
-
-# load the dataset from the repo root
-file_path = './Clinical_and_Other_Features.xlsx'
-clinical_df = pd.read_excel(file_path, header=[1,2])
+
+import instrumentation
+from instrumentation import get_logger, stage, count
+
+logger = get_logger('clinical_data_rnn')
+
+# TensorFlow/Keras, scikit-learn and the evaluation module (matplotlib) are imported inside the
+# functions that use them, so importing this module, --help and --encode_only stay fast
 
 """# **Data Preprocessing**
 
@@ -67,27 +55,248 @@ def merge_headers(col_tuple):
     else:
         return f"{first} - {second}"
 
-"""### scripts"""
+def make_unique_columns(columns):
+    """Suffix repeated column names with " (2)", " (3)", ... so every column is addressable"""
+    seen = {}
+    unique = []
+    for col in columns:
+        seen[col] = seen.get(col, 0) + 1
+        unique.append(col if seen[col] == 1 else f"{col} ({seen[col]})")
+    return unique
+
+# Bump when read_clinical_excel changes so old snapshots are not reused
+SNAPSHOT_VERSION = 1
+
+def file_sha1(path, chunk_size=1 << 20):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def read_clinical_excel(file_path):
+    """Parse the clinical sheet and merge its two header rows into unique single-level names"""
+    with stage('excel_parse', path=file_path):
+        df = pd.read_excel(file_path, header=[1, 2])
+    count('excel_rows', len(df))
+    # Merge multi-index headers for all columns
+    df.columns = make_unique_columns([merge_headers(col) for col in df.columns])
+    # Parquet needs one type per column: keep mixed object columns as strings (missing stays missing)
+    for col in df.columns[df.dtypes == object]:
+        df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+    return df
+
+def load_clinical_table(file_path, snapshot_dir=None, refresh=False):
+    """
+    Load the merged-header clinical table through a Parquet snapshot keyed by the
+    spreadsheet's content hash. The xlsx is only parsed when it changed (or refresh=True).
 
-# Load the data
-file_path = './Clinical_and_Other_Features.xlsx'
-clinical_df = pd.read_excel(file_path, header=[1, 2])
+    Parameters:
+    -----------
+    file_path : str
+        Path to Clinical_and_Other_Features.xlsx
+    snapshot_dir : str, optional
+        Where snapshots are kept, defaults to the spreadsheet's directory
+    refresh : bool, default=False
+        Re-parse the spreadsheet even if a snapshot exists
 
-# Preprocess the column headers
-# Merge multi-index headers for all columns
-new_columns = [merge_headers(col) for col in clinical_df.columns]
-clinical_df.columns = new_columns
+    Returns:
+    --------
+    pandas.DataFrame
+        The clinical table with merged headers
+    """
+    snapshot_dir = snapshot_dir or os.path.dirname(os.path.abspath(file_path))
+    stem = os.path.splitext(os.path.basename(file_path))[0]
+    snapshot_path = os.path.join(snapshot_dir, f"{stem}.{file_sha1(file_path)[:16]}.v{SNAPSHOT_VERSION}.parquet")
 
-# Print column info
-print(f"Total columns: {len(clinical_df.columns)}")
-print(f"Sample size: {len(clinical_df)}")
+    if not refresh and os.path.exists(snapshot_path):
+        try:
+            with stage('snapshot_read', path=snapshot_path):
+                return pd.read_parquet(snapshot_path)
+        except (ImportError, OSError, ValueError) as e:
+            logger.warning(f"Could not read snapshot {snapshot_path} ({e}), re-parsing spreadsheet")
+
+    df = read_clinical_excel(file_path)
+    try:
+        os.makedirs(snapshot_dir, exist_ok=True)
+        tmp_path = f"{snapshot_path}.{os.getpid()}.tmp"
+        with stage('snapshot_write', path=snapshot_path):
+            df.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, snapshot_path)
+    except ImportError as e:
+        logger.warning(f"Parquet engine unavailable ({e}), not snapshotting the clinical table")
+        return df
+
+    # Drop snapshots of older versions of the spreadsheet
+    for stale in glob.glob(os.path.join(snapshot_dir, f"{glob.escape(stem)}.*.parquet")):
+        if stale != snapshot_path:
+            os.remove(stale)
+    return df
 
 """## *Data Encoding*
 
 ### utilities
 """
 
-def encode_clinical_data(df):
+class ClinicalEncoder:
+    """
+    Fit/transform encoder for the clinical table.
+
+    Numeric columns are median-imputed and standardized in one vectorized pass;
+    every other column is encoded through pandas categorical codes (missing values
+    become the "MISSING" category, categories are sorted like LabelEncoder's).
+    The fitted state is plain JSON so new patients can be encoded consistently at
+    inference time. Repeated column names (the sheet has a few) are made unique
+    with make_unique_columns before fitting and transforming.
+
+    Parameters:
+    -----------
+    target_col : str, optional
+        Column passed through untouched. If None, the first column containing
+        "Recurrence event" is used.
+    """
+
+    MISSING = "MISSING"
+
+    def __init__(self, target_col=None):
+        self.target_col = target_col
+        self.columns_ = None
+        self.order_ = None
+        self.numeric_ = None
+        self.categorical_ = None
+
+    def _find_target(self, df):
+        if self.target_col is not None:
+            return self.target_col if self.target_col in df.columns else None
+        return next((col for col in df.columns if "Recurrence event" in col), None)
+
+    def fit(self, df):
+        """
+        Learn medians, means/stds and category vocabularies from df
+
+        Returns:
+        --------
+        ClinicalEncoder
+            self
+        """
+        df = self._with_unique_columns(df)
+        self.target_col = self._find_target(df)
+        feature_cols = [col for col in df.columns if col != self.target_col]
+        numeric_cols = [col for col in feature_cols
+                        if pd.api.types.is_numeric_dtype(df[col]) and not pd.api.types.is_bool_dtype(df[col])]
+        numeric_set = set(numeric_cols)
+        categorical_cols = [col for col in feature_cols if col not in numeric_set]
+
+        numeric = df[numeric_cols].astype(np.float64)
+        # All-missing columns have a NaN median and are filled with 0
+        medians = numeric.median().fillna(0.0)
+        filled = numeric.fillna(medians)
+        means = filled.mean()
+        stds = filled.std()
+        # Columns without variance are imputed but not standardized
+        constant = ~(stds > 0)
+        means[constant] = 0.0
+        stds[constant] = 1.0
+
+        self.columns_ = feature_cols
+        self.order_ = list(df.columns)
+        self.numeric_ = {
+            'columns': numeric_cols,
+            'median': medians.tolist(),
+            'mean': means.tolist(),
+            'std': stds.tolist(),
+        }
+        self.categorical_ = {
+            col: sorted(self._as_strings(df[col]).unique().tolist()) for col in categorical_cols
+        }
+        logger.debug(f"Fitted encoder: {len(numeric_cols)} numeric, {len(categorical_cols)} categorical columns")
+        return self
+
+    def _with_unique_columns(self, df):
+        if df.columns.has_duplicates:
+            df = df.copy()
+            df.columns = make_unique_columns(df.columns)
+        return df
+
+    def _as_strings(self, series):
+        return series.astype(object).where(series.notna(), self.MISSING).astype(str)
+
+    def transform(self, df):
+        """
+        Encode df with the fitted state; unseen categories become -1 and missing
+        columns are treated as entirely missing
+
+        Returns:
+        --------
+        pandas.DataFrame
+            Encoded features (plus the target column if present), in fit column order
+        """
+        if self.columns_ is None:
+            raise ValueError("ClinicalEncoder must be fitted before transform")
+        df = self._with_unique_columns(df)
+        has_target = self.target_col in df.columns
+        target = df[self.target_col] if has_target else None
+        df = df.reindex(columns=self.columns_)
+
+        numeric_cols = self.numeric_['columns']
+        values = df[numeric_cols].to_numpy(dtype=np.float64, na_value=np.nan)
+        values = np.where(np.isnan(values), np.asarray(self.numeric_['median']), values)
+        values = (values - np.asarray(self.numeric_['mean'])) / np.asarray(self.numeric_['std'])
+        encoded = {col: values[:, i] for i, col in enumerate(numeric_cols)}
+
+        for col, categories in self.categorical_.items():
+            codes = pd.Categorical(self._as_strings(df[col]), categories=categories).codes
+            encoded[col] = codes.astype(np.int64)
+
+        if has_target:
+            encoded[self.target_col] = target
+        return pd.DataFrame(encoded, index=df.index)[self.order_ if has_target else self.columns_]
+
+    def fit_transform(self, df):
+        return self.fit(df).transform(df)
+
+    def to_dict(self):
+        return {
+            'target_col': self.target_col,
+            'columns': self.columns_,
+            'order': self.order_,
+            'numeric': self.numeric_,
+            'categorical': self.categorical_,
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        encoder = cls(target_col=state['target_col'])
+        encoder.columns_ = state['columns']
+        encoder.order_ = state['order']
+        encoder.numeric_ = state['numeric']
+        encoder.categorical_ = state['categorical']
+        return encoder
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+
+def drop_metadata_rows(df):
+    """
+    Drop the leading header/metadata rows (rows 1-3) if the first column shows them,
+    i.e. if any of its first four values is a string containing '='
+    """
+    if df.shape[0] >= 4:
+        first_rows = df.loc[0:3, df.columns[0]].tolist()
+        if any(isinstance(val, str) and '=' in str(val) for val in first_rows):
+            logger.debug("First rows appear to contain metadata. Removing rows 0-3...")
+            df = df.iloc[3:].reset_index(drop=True)
+    return df
+
+
+def encode_clinical_data(df, encoder=None):
     """
     Encodes clinical data with the understanding that real data starts at row 4.
     Rows 1-3 contain header/metadata information.
@@ -96,185 +305,164 @@ def encode_clinical_data(df):
     -----------
     df : pandas.DataFrame
         The clinical dataframe to encode
+    encoder : ClinicalEncoder, optional
+        Already fitted encoder to apply; a new one is fitted on df if None
 
     Returns:
     --------
     pandas.DataFrame
         The encoded dataframe with all columns properly processed
     """
-    # Create a copy to avoid modifying the original
-    encoded_df = df.copy()
-
-    # First, check if we need to handle the header rows
-    # If the dataframe has already been loaded with headers processed
-    # (i.e., headers are in column names), we don't need this step
-    if encoded_df.shape[0] >= 4:
-        print("Checking if data starts at row 4...")
-        # Sample some values to see if first 3 rows appear to be headers
-        sample_col = encoded_df.columns[0]
-        first_rows = encoded_df.loc[0:3, sample_col].tolist()
-        print(f"First rows of sample column: {first_rows}")
-
-        # If first rows look like headers, remove them
-        if any(isinstance(val, str) and '=' in str(val) for val in first_rows):
-            print("First rows appear to contain metadata. Removing rows 0-3...")
-            encoded_df = encoded_df.iloc[3:].reset_index(drop=True)
-            print(f"Dataframe shape after removing header rows: {encoded_df.shape}")
-
-    # Identify the target column
-    target_col = None
-    for col in encoded_df.columns:
-        if "Recurrence event" in col:
-            target_col = col
-            target_values = encoded_df[target_col].copy()
-            print(f"Identified target column: {target_col}")
-            break
-
-    # Process each column individually
-    all_columns = encoded_df.columns.tolist()
-    print(f"Processing {len(all_columns)} total columns")
-
-    for col in all_columns:
-        # Skip target column for now
-        if col == target_col:
-            continue
-
-        print(f"Processing column: {col}")
-
-        try:
-            # Check column data type
-            if encoded_df[col].dtype == 'object':
-                # Categorical column
-                print(f"  Processing as categorical")
-
-                # Fill missing values
-                encoded_df[col] = encoded_df[col].fillna("MISSING")
-
-                # Convert to string
-                encoded_df[col] = encoded_df[col].astype(str)
-
-                # Apply label encoding
-                le = LabelEncoder()
-                encoded_df[col] = le.fit_transform(encoded_df[col])
-                print(f"  Encoded {len(le.classes_)} unique values")
-
-            else:
-                # Numeric column
-                print(f"  Processing as numeric")
-
-                # Handle missing values
-                if encoded_df[col].isna().any():
-                    if encoded_df[col].isna().all():
-                        encoded_df[col] = 0
-                        print(f"  All values missing, filled with 0")
-                    else:
-                        median = encoded_df[col].median()
-                        encoded_df[col] = encoded_df[col].fillna(median)
-                        print(f"  Filled missing values with median: {median}")
-
-                # Standardize if there's variance
-                if encoded_df[col].std() > 0:
-                    mean_val = encoded_df[col].mean()
-                    std_val = encoded_df[col].std()
-                    encoded_df[col] = (encoded_df[col] - mean_val) / std_val
-                    print(f"  Standardized numeric column")
-
-        except Exception as e:
-            print(f"Error processing column {col}: {str(e)}")
-
-            # Try alternative approach
-            try:
-                print(f"  Trying alternative encoding approach")
-
-                # Force to string and encode
-                encoded_df[col] = encoded_df[col].fillna("MISSING")
-                encoded_df[col] = encoded_df[col].astype(str)
-                le = LabelEncoder()
-                encoded_df[col] = le.fit_transform(encoded_df[col])
-                print(f"  Alternative encoding successful")
-
-            except Exception as e2:
-                print(f"  Alternative approach failed: {str(e2)}")
-                print(f"  Setting column to 0")
-                encoded_df[col] = 0
-
-    # Restore target column
-    if target_col and 'target_values' in locals():
-        encoded_df[target_col] = target_values
-        print(f"Restored target column: {target_col}")
-
-    # Final check for any NaN values
-    if encoded_df.isna().any().any():
-        nan_cols = encoded_df.columns[encoded_df.isna().any()].tolist()
-        print(f"Filling NaN values in {len(nan_cols)} columns")
-        encoded_df = encoded_df.fillna(0)
-
-    print(f"Final encoded dataframe shape: {encoded_df.shape}")
+    with stage('clinical_encode', rows=len(df)):
+        encoded_df = drop_metadata_rows(df)
+        if encoder is None:
+            encoder = ClinicalEncoder().fit(encoded_df)
+        encoded_df = encoder.transform(encoded_df)
+
+        # Final check for any NaN values (e.g. a missing target)
+        if encoded_df.isna().any().any():
+            nan_cols = encoded_df.columns[encoded_df.isna().any()].tolist()
+            logger.debug(f"Filling NaN values in {len(nan_cols)} columns")
+            encoded_df = encoded_df.fillna(0)
+    count('clinical_rows_encoded', len(encoded_df))
+
+    logger.debug(f"Final encoded dataframe shape: {encoded_df.shape}")
     return encoded_df
 
-"""### scripts"""
+"""## *Longitudinal Visits*
 
-# target variable
-target_col = "Recurrence event(s) - {0 = no, 1 = yes}"
-if target_col not in clinical_df.columns:
-    # Find the correct column name by looking for a substring match
-    matching_cols = [col for col in clinical_df.columns if "Recurrence event" in col]
-    if matching_cols:
-        target_col = matching_cols[0]
-        print(f"Found target column: {target_col}")
-    else:
-        raise ValueError("Target column not found! Please check the column names.")
+### utilities
+"""
 
-# Encode the data
-encoded_df = encode_clinical_data(clinical_df)
-print(f"Encoded data shape: {encoded_df.shape}")
+# Column holding the patient ids the fusion layer joins on
+ID_COL = "Patient ID"
+# Column ordering a patient's visits in the long-format visits table
+VISIT_COL = "Visit"
+
+def load_visits_table(path):
+    """Read a long-format visits table (one row per patient visit) from CSV, Parquet or Excel"""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".parquet":
+        return pd.read_parquet(path)
+    if ext in (".xlsx", ".xls"):
+        return pd.read_excel(path)
+    return pd.read_csv(path)
+
+def build_visit_sequences(visits_df, encoder=None, id_col=ID_COL, time_col=VISIT_COL):
+    """
+    Encode a long-format visits table and group it into one sequence per patient
 
-"""## *Data Spliitting and Reshaping*
+    Parameters:
+    -----------
+    visits_df : pandas.DataFrame
+        One row per visit with id_col, time_col and any number of feature columns
+    encoder : ClinicalEncoder, optional
+        Fitted encoder for the visit features; a new one is fitted on visits_df if None
+    id_col : str, default=ID_COL
+        Patient id column
+    time_col : str, default=VISIT_COL
+        Column ordering each patient's visits (visit number or date)
+
+    Returns:
+    --------
+    tuple
+        (ids, sequences, encoder): patient ids as strings, one float32 array of shape
+        (visits, features) per patient in chronological order, and the encoder used
+    """
+    for col in (id_col, time_col):
+        if col not in visits_df.columns:
+            raise ValueError(f"Visits table has no {col!r} column")
+    visits_df = visits_df.assign(**{id_col: visits_df[id_col].astype(str)})
+    visits_df = visits_df.sort_values([id_col, time_col], kind='stable').reset_index(drop=True)
+    features = visits_df.drop(columns=[id_col, time_col])
+    with stage('visits_encode', rows=len(features)):
+        if encoder is None:
+            encoder = ClinicalEncoder().fit(features)
+        values = np.nan_to_num(encoder.transform(features).to_numpy(dtype=np.float32), nan=0.0)
+    count('visit_rows_encoded', len(values))
+
+    # Rows are sorted by patient, so each patient is one contiguous run
+    ids, starts = np.unique(visits_df[id_col].to_numpy(), return_index=True)
+    sequences = np.split(values, starts[1:])
+    lengths = np.diff(np.append(starts, len(values)))
+    logger.info(f"Built {len(ids)} visit sequences: {lengths.min()}-{lengths.max()} visits, "
+                f"{lengths.mean():.1f} on average")
+    return ids, sequences, encoder
+
+"""## *Data Splitting and Reshaping*
 
 ### utilities
 """
 
+# Target variable
+TARGET_COL = "Recurrence event(s) - {0 = no, 1 = yes}"
+
+def find_target_column(df, target_col=TARGET_COL):
+    """Return target_col, or the first column whose name contains "Recurrence event" """
+    if target_col in df.columns:
+        return target_col
+    # Find the correct column name by looking for a substring match
+    matching_cols = [col for col in df.columns if "Recurrence event" in col]
+    if not matching_cols:
+        raise ValueError("Target column not found! Please check the column names.")
+    logger.debug(f"Found target column: {matching_cols[0]}")
+    return matching_cols[0]
 
+def split_rnn_sequences(encoded_df, target_col):
+    """
+    70/15/15 train/validation/test split of the encoded table, reshaped for the RNN
 
-"""### scripts"""
+    Parameters:
+    -----------
+    encoded_df : pandas.DataFrame
+        Output of encode_clinical_data
+    target_col : str
+        Name of the target column
 
-# Split the data into features and target
-X = encoded_df.drop(columns=[target_col]) if target_col in encoded_df.columns else encoded_df
-y = encoded_df[target_col] if target_col in encoded_df.columns else None
+    Returns:
+    --------
+    tuple
+        (X, y, (X_train_seq, y_train), (X_val_seq, y_val), (X_test_seq, y_test)) where X/y
+        are the full feature table and target and each *_seq has shape (samples, 1, features)
+    """
+    from sklearn.model_selection import train_test_split
+
+    # Split the data into features and target
+    X = encoded_df.drop(columns=[target_col]) if target_col in encoded_df.columns else encoded_df
+    y = encoded_df[target_col] if target_col in encoded_df.columns else None
 
-# Print info about target distribution
-if y is not None:
-    print(f"Target distribution:\n{y.value_counts()}")
-else:
-    print("Warning: Target column not found in encoded dataframe!")
+    # Print info about target distribution
+    if y is not None:
+        logger.info(f"Target distribution:\n{y.value_counts()}")
+    else:
+        logger.warning("Target column not found in encoded dataframe!")
 
-# Split data into train, validation, and test sets
-X_train, X_temp, y_train, y_temp = train_test_split(X, y, test_size=0.30, random_state=42)
-X_val, X_test, y_val, y_test = train_test_split(X_temp, y_temp, test_size=0.50, random_state=42)
+    # Split data into train, validation, and test sets
+    X_train, X_temp, y_train, y_temp = train_test_split(X, y, test_size=0.30, random_state=42)
+    X_val, X_test, y_val, y_test = train_test_split(X_temp, y_temp, test_size=0.50, random_state=42)
 
-print("Training set size:", X_train.shape, y_train.shape)
-print("Validation set size:", X_val.shape, y_val.shape)
-print("Test set size:", X_test.shape, y_test.shape)
+    logger.info(f"Training set size: {X_train.shape} {y_train.shape}")
+    logger.info(f"Validation set size: {X_val.shape} {y_val.shape}")
+    logger.info(f"Test set size: {X_test.shape} {y_test.shape}")
 
-# Reshape data for RNN (sequence data)
-# RNNs expect input of shape (batch_size, time_steps, features)
-X_train_seq = np.expand_dims(X_train.values, axis=1)  # shape: (samples, 1, features)
-X_val_seq = np.expand_dims(X_val.values, axis=1)
-X_test_seq = np.expand_dims(X_test.values, axis=1)
+    # Reshape data for RNN (sequence data)
+    # RNNs expect input of shape (batch_size, time_steps, features)
+    X_train_seq = np.expand_dims(X_train.values, axis=1)  # shape: (samples, 1, features)
+    X_val_seq = np.expand_dims(X_val.values, axis=1)
+    X_test_seq = np.expand_dims(X_test.values, axis=1)
 
 
-# Check for NaN values using np.isnan for NumPy arrays
-if np.isnan(X_test_seq).any():
-    print("Warning: NaN values found in test data! Filling with 0...")
-    X_test_seq = np.nan_to_num(X_test_seq, nan=0.0)
+    # Check for NaN values using np.isnan for NumPy arrays
+    if np.isnan(X_test_seq).any():
+        logger.warning("NaN values found in test data! Filling with 0...")
+        X_test_seq = np.nan_to_num(X_test_seq, nan=0.0)
 
-X_train_seq = np.nan_to_num(X_train_seq, nan=0.0)
-X_val_seq = np.nan_to_num(X_val_seq, nan=0.0)
+    X_train_seq = np.nan_to_num(X_train_seq, nan=0.0)
+    X_val_seq = np.nan_to_num(X_val_seq, nan=0.0)
 
-print("Sequence shapes:")
-print("X_train_seq:", X_train_seq.shape)
-print("X_val_seq:", X_val_seq.shape)
-print("X_test_seq:", X_test_seq.shape)
+    logger.debug(f"Sequence shapes: X_train_seq {X_train_seq.shape}, X_val_seq {X_val_seq.shape}, "
+                 f"X_test_seq {X_test_seq.shape}")
+    return X, y, (X_train_seq, y_train), (X_val_seq, y_val), (X_test_seq, y_test)
 
 """# **RNN Model**
 
@@ -285,7 +473,8 @@ print("X_test_seq:", X_test_seq.shape)
 
 def build_advanced_rnn_model(input_shape, rnn_type='LSTM', units=64,
                             bidirectional=True, attention=False,
-                            dropout_rate=0.3, l1_reg=0.0001, l2_reg=0.0001):
+                            dropout_rate=0.3, l1_reg=0.0001, l2_reg=0.0001,
+                            masking=False):
     """
     Build an advanced RNN model with various architectural improvements:
     - Bidirectional RNN layers
@@ -297,7 +486,8 @@ def build_advanced_rnn_model(input_shape, rnn_type='LSTM', units=64,
     input_shape : tuple
         Shape of input data (time_steps, features)
     rnn_type : str, default='LSTM'
-        Type of RNN layer ('LSTM' or 'GRU')
+        Type of RNN layer ('LSTM' or 'GRU'), or 'Dense' for the feed-forward
+        encoder of build_dense_clinical_model
     units : int, default=64
         Number of RNN units
     bidirectional : bool, default=True
@@ -310,24 +500,43 @@ def build_advanced_rnn_model(input_shape, rnn_type='LSTM', units=64,
         L1 regularization strength
     l2_reg : float, default=0.0001
         L2 regularization strength
+    masking : bool, default=False
+        Skip padded time steps (tf_input.SEQUENCE_PAD) of variable-length visit
+        sequences; use input_shape=(None, features)
 
     Returns:
     --------
     keras.Model
         Compiled RNN model
     """
+    import tensorflow as tf
+    from tensorflow.keras.models import Sequential, Model
+    from tensorflow.keras.layers import (LSTM, GRU, Dense, Dropout, BatchNormalization, Input, Bidirectional,
+                                         Masking)
+    from tensorflow.keras.optimizers import Adam
+    from tensorflow.keras.regularizers import l1_l2
+
+    from tf_input import SEQUENCE_PAD
+
+    if rnn_type == 'Dense':
+        return build_dense_clinical_model(input_shape, units=units, dropout_rate=dropout_rate,
+                                          l1_reg=l1_reg, l2_reg=l2_reg)
+
     # Simple version for simpler architectural choices
     if not bidirectional:
         model = Sequential()
+        model.add(Input(shape=input_shape))
+        if masking:
+            model.add(Masking(mask_value=SEQUENCE_PAD))
 
         # Use specified RNN type
         if rnn_type == 'LSTM':
-            model.add(LSTM(units, input_shape=input_shape,
+            model.add(LSTM(units,
                           kernel_regularizer=l1_l2(l1=l1_reg, l2=l2_reg),
                           recurrent_regularizer=l1_l2(l1=l1_reg, l2=l2_reg),
                           return_sequences=False))
         elif rnn_type == 'GRU':
-            model.add(GRU(units, input_shape=input_shape,
+            model.add(GRU(units,
                          kernel_regularizer=l1_l2(l1=l1_reg, l2=l2_reg),
                          recurrent_regularizer=l1_l2(l1=l1_reg, l2=l2_reg),
                          return_sequences=False))
@@ -361,7 +570,7 @@ def build_advanced_rnn_model(input_shape, rnn_type='LSTM', units=64,
             raise ValueError(f"Unknown RNN type: {rnn_type}")
 
         # Add bidirectional wrapper
-        rnn_output = Bidirectional(rnn_layer)(inputs)
+        rnn_output = Bidirectional(rnn_layer)(Masking(mask_value=SEQUENCE_PAD)(inputs) if masking else inputs)
 
         # Add dense layers with regularization
         x = BatchNormalization()(rnn_output)
@@ -382,20 +591,62 @@ def build_advanced_rnn_model(input_shape, rnn_type='LSTM', units=64,
 
     return model
 
-"""### scripts"""
-
-# Build the advanced RNN model
-input_shape = (X_train_seq.shape[1], X_train_seq.shape[2])  # (time_steps, features)
-advanced_model = build_advanced_rnn_model(
-    input_shape=input_shape,
-    rnn_type='LSTM',       # 'LSTM' or 'GRU'
-    units=128,             # Number of RNN units
-    bidirectional=True,    # Use bidirectional RNN
-    attention=False,       # Attention mechanism not needed for this data
-    dropout_rate=0.3,      # Dropout rate for regularization
-    l1_reg=0.0001,         # L1 regularization strength
-    l2_reg=0.0001          # L2 regularization strength
-)
+def build_dense_clinical_model(input_shape, units=64, gated=True,
+                               dropout_rate=0.3, l1_reg=0.0001, l2_reg=0.0001):
+    """
+    Feed-forward alternative to build_advanced_rnn_model for the clinical table
+
+    Every patient is a single time step, so the LSTM/GRU gates only add cost. This
+    replaces the recurrent layer with one dense block (optionally gated, GLU style)
+    and keeps the same head, so extract_rnn_features still returns 32-d features and
+    the (samples, 1, features) inputs work unchanged.
+
+    Parameters:
+    -----------
+    input_shape : tuple
+        (time_steps, features) as for the RNN, or just (features,)
+    units : int, default=64
+        Width of the dense block
+    gated : bool, default=True
+        Multiply the block by a sigmoid gate computed from the same inputs
+    dropout_rate, l1_reg, l2_reg : float
+        Regularization, as in build_advanced_rnn_model
+
+    Returns:
+    --------
+    keras.Model
+        Compiled model
+    """
+    import tensorflow as tf
+    from tensorflow.keras.models import Model
+    from tensorflow.keras.layers import Dense, Dropout, BatchNormalization, Input, Flatten, Multiply
+    from tensorflow.keras.optimizers import Adam
+    from tensorflow.keras.regularizers import l1_l2
+
+    if None in tuple(input_shape):
+        raise ValueError("The dense clinical encoder needs fixed-length inputs, use an RNN for visit sequences")
+    inputs = Input(shape=input_shape)
+    flat = Flatten()(inputs)
+    x = Dense(units, activation='relu', kernel_regularizer=l1_l2(l1=l1_reg, l2=l2_reg))(flat)
+    if gated:
+        gate = Dense(units, activation='sigmoid', kernel_regularizer=l1_l2(l1=l1_reg, l2=l2_reg))(flat)
+        x = Multiply()([x, gate])
+
+    # Same head as the RNN, so layers[-2] is the 32-unit feature layer
+    x = BatchNormalization()(x)
+    x = Dropout(dropout_rate)(x)
+    x = Dense(32, activation='relu', kernel_regularizer=l1_l2(l1=l1_reg, l2=l2_reg))(x)
+    x = BatchNormalization()(x)
+    x = Dropout(dropout_rate)(x)
+    outputs = Dense(1, activation='sigmoid')(x)
+
+    model = Model(inputs=inputs, outputs=outputs)
+    model.compile(
+        optimizer=Adam(learning_rate=0.001),
+        loss='binary_crossentropy',
+        metrics=['accuracy', tf.keras.metrics.AUC(), tf.keras.metrics.Precision(), tf.keras.metrics.Recall()]
+    )
+    return model
 
 """## *Model Training with Callbacks*
 
@@ -415,9 +666,10 @@ def train_with_advanced_callbacks(model, X_train, y_train, X_val, y_val,
     model : keras.Model
         The compiled model to train
     X_train, y_train : array-like
-        Training data and labels
+        Training data and labels; X_train may also be a list of per-patient
+        (visits, features) arrays, which are fed length-bucketed and padded
     X_val, y_val : array-like
-        Validation data and labels
+        Validation data and labels (a list of sequences if X_train is)
     batch_size : int, default=32
         Batch size for training
     epochs : int, default=100
@@ -434,6 +686,8 @@ def train_with_advanced_callbacks(model, X_train, y_train, X_val, y_val,
     history : dict
         Training history
     """
+    from tensorflow.keras.callbacks import EarlyStopping, ModelCheckpoint, ReduceLROnPlateau
+
     # Define callbacks
     callbacks = [
         # Early stopping to prevent overfitting
@@ -460,41 +714,37 @@ def train_with_advanced_callbacks(model, X_train, y_train, X_val, y_val,
         )
     ]
 
-    # Train the model
-    history = model.fit(
-        X_train, y_train,
-        validation_data=(X_val, y_val),
-        epochs=epochs,
-        batch_size=batch_size,
-        callbacks=callbacks,
-        verbose=1
-    )
+    # Train the model on prefetched tf.data pipelines (see tf_input.py)
+    from tf_input import make_dataset, make_sequence_dataset
 
-    return history
+    if isinstance(X_train, list):
+        train_data = make_sequence_dataset(X_train, y_train, batch_size=batch_size, shuffle=True)
+        val_data = make_sequence_dataset(X_val, y_val, batch_size=batch_size)
+    else:
+        train_data = make_dataset(X_train, y_train, batch_size=batch_size, shuffle=True)
+        val_data = make_dataset(X_val, y_val, batch_size=batch_size)
+
+    with stage('keras_fit', rows=len(X_train), epochs=epochs, batch_size=batch_size):
+        history = model.fit(
+            train_data,
+            validation_data=val_data,
+            epochs=epochs,
+            callbacks=callbacks,
+            verbose=1
+        )
+    count('keras_epochs', len(history.epoch))
 
-"""### scripts"""
-
-# Train the model with advanced callbacks
-history = train_with_advanced_callbacks(
-    model=advanced_model,
-    X_train=X_train_seq,
-    y_train=y_train,
-    X_val=X_val_seq,
-    y_val=y_val,
-    batch_size=32,
-    epochs=100,
-    early_stopping_patience=10,
-    reduce_lr_patience=5
-)
+    return history
 
 """## *Model Evaluation*
 
 ### utilities
 """
 
-def evaluate_binary_classifier(model, X_test, y_test, class_names=['No Recurrence', 'Recurrence']):
+def evaluate_binary_classifier(model, X_test, y_test, class_names=['No Recurrence', 'Recurrence'], bootstrap=0,
+                               plot_prefix=None, threshold=0.5):
     """
-    Comprehensive evaluation of binary classifier with various metrics and plots
+    Comprehensive evaluation of binary classifier from a single inference pass
 
     Parameters:
     -----------
@@ -503,100 +753,291 @@ def evaluate_binary_classifier(model, X_test, y_test, class_names=['No Recurrenc
     X_test, y_test : array-like
         Test data and labels
     class_names : list, default=['No Recurrence', 'Recurrence']
-        Names of the classes for plotting
+        Names of the classes for the report and plots
+    bootstrap : int, default=0
+        Bootstrap replicates for confidence intervals (0 to skip)
+    plot_prefix : str, optional
+        Write <prefix>_confusion_matrix.png, <prefix>_roc_curve.png and <prefix>_pr_curve.png
+        (rendered off-screen, nothing is shown)
+    threshold : float, default=0.5
+        Decision threshold, rows scoring above it are predicted positive
 
     Returns:
     --------
     dict
-        Dictionary of evaluation metrics
+        Dictionary of evaluation metrics (see evaluation.binary_metrics)
     """
-    # Get predictions
-    y_pred_prob = model.predict(X_test)
-    y_pred = (y_pred_prob > 0.5).astype(int)
-
-    # Calculate metrics
-    test_loss, test_accuracy, test_auc, test_precision, test_recall = model.evaluate(X_test, y_test, verbose=0)
-
-    # Classification report
-    report = classification_report(y_test, y_pred, target_names=class_names, output_dict=True)
-    print(classification_report(y_test, y_pred, target_names=class_names))
-
-    # Confusion matrix
-    cm = confusion_matrix(y_test, y_pred)
-    plt.figure(figsize=(8, 6))
-    plt.imshow(cm, interpolation='nearest', cmap=plt.cm.Blues)
-    plt.title('Confusion Matrix')
-    plt.colorbar()
-    tick_marks = np.arange(len(class_names))
-    plt.xticks(tick_marks, class_names)
-    plt.yticks(tick_marks, class_names)
-    plt.xlabel('Predicted Label')
-    plt.ylabel('True Label')
-
-    # Add text annotations to the confusion matrix
-    thresh = cm.max() / 2
-    for i in range(cm.shape[0]):
-        for j in range(cm.shape[1]):
-            plt.text(j, i, format(cm[i, j], 'd'),
-                    horizontalalignment="center",
-                    color="white" if cm[i, j] > thresh else "black")
-    plt.tight_layout()
-    plt.savefig('confusion_matrix_advanced.png')
-    plt.show()
-
-    # ROC curve
-    fpr, tpr, _ = roc_curve(y_test, y_pred_prob)
-    roc_auc = auc(fpr, tpr)
-
-    plt.figure(figsize=(8, 6))
-    plt.plot(fpr, tpr, color='darkorange', lw=2, label=f'ROC curve (area = {roc_auc:.2f})')
-    plt.plot([0, 1], [0, 1], color='navy', lw=2, linestyle='--')
-    plt.xlim([0.0, 1.0])
-    plt.ylim([0.0, 1.05])
-    plt.xlabel('False Positive Rate')
-    plt.ylabel('True Positive Rate')
-    plt.title('Receiver Operating Characteristic')
-    plt.legend(loc="lower right")
-    plt.savefig('roc_curve_advanced.png')
-    plt.show()
-
-    # Precision-Recall curve
-    precision, recall, _ = precision_recall_curve(y_test, y_pred_prob)
-    pr_auc = auc(recall, precision)
-
-    plt.figure(figsize=(8, 6))
-    plt.plot(recall, precision, color='blue', lw=2, label=f'PR curve (area = {pr_auc:.2f})')
-    plt.xlabel('Recall')
-    plt.ylabel('Precision')
-    plt.title('Precision-Recall Curve')
-    plt.legend(loc="lower left")
-    plt.savefig('pr_curve_advanced.png')
-    plt.show()
-
-    # Return all metrics in a dictionary
-    metrics = {
-        'accuracy': test_accuracy,
-        'auc': test_auc,
-        'precision': test_precision,
-        'recall': test_recall,
-        'f1_score': report['weighted avg']['f1-score'],
-        'confusion_matrix': cm,
-        'roc_auc': roc_auc,
-        'pr_auc': pr_auc
-    }
+    from evaluation import evaluate_model, format_report
 
+    with stage('evaluate', rows=len(y_test), bootstrap=bootstrap):
+        metrics = evaluate_model(model, X_test, np.asarray(y_test), threshold=threshold, bootstrap=bootstrap,
+                                 plot_prefix=plot_prefix, class_names=class_names)
+    logger.info(format_report(metrics, class_names))
     return metrics
 
-"""### scripts"""
+def select_decision_threshold(model, X_val, y_val, model_path, objective='youden', beta=1.0,
+                              target_sensitivity=0.9):
+    """
+    Tune the decision threshold on the validation split and save it next to the model
+
+    Parameters:
+    -----------
+    model : keras.Model
+        Trained classifier
+    X_val, y_val : array-like
+        Validation data and labels
+    model_path : str
+        Saved model the threshold belongs to (written to evaluation.threshold_path(model_path))
+    objective : {'youden', 'fbeta', 'sensitivity', 'fixed'}, default='youden'
+        See evaluation.optimize_threshold; 'fixed' keeps 0.5 and saves nothing
+    beta, target_sensitivity : float
+        Parameters of the 'fbeta' and 'sensitivity' objectives
+
+    Returns:
+    --------
+    float
+        The decision threshold
+    """
+    from evaluation import tune_threshold, format_threshold, save_threshold, threshold_path
+
+    if objective == 'fixed':
+        if os.path.exists(threshold_path(model_path)):
+            # A threshold tuned for an earlier model does not apply to this one
+            os.remove(threshold_path(model_path))
+        return 0.5
+    with stage('threshold_tuning', objective=objective):
+        result = tune_threshold(model, X_val, y_val, objective, beta, target_sensitivity)
+    logger.info(format_threshold(result))
+    logger.info(f"Saved the decision threshold to {save_threshold(model_path, result)}")
+    return result['threshold']
+
+"""# **RNN Feature Export**"""
+
+def extract_rnn_features(model, X_seq, batch_size=256):
+    """
+    Activations of the last hidden block (the 32-unit dense layer after batch
+    normalization/dropout) for every row of X_seq
+
+    X_seq may be a list of variable-length (visits, features) sequences for a
+    masked model; they are batched in length order, so each batch is only padded
+    to its own longest sequence, and returned in input order.
+
+    Returns:
+    --------
+    numpy.ndarray
+        Feature matrix of shape (samples, 32)
+    """
+    from tensorflow.keras.models import Model
+
+    extractor = Model(inputs=model.inputs, outputs=model.layers[-2].output)
+    count('rnn_feature_rows', len(X_seq))
+    if not isinstance(X_seq, list):
+        with stage('rnn_features', rows=len(X_seq)):
+            return extractor.predict(X_seq, verbose=0)
+
+    from tf_input import pad_sequences
+
+    order = np.argsort([len(seq) for seq in X_seq], kind='stable')
+    features = np.empty((len(X_seq), extractor.output_shape[-1]), dtype=np.float32)
+    with stage('rnn_features', rows=len(X_seq)):
+        for start in range(0, len(order), batch_size):
+            idx = order[start:start + batch_size]
+            features[idx] = extractor.predict_on_batch(pad_sequences([X_seq[i] for i in idx]))
+    return features
+
+"""# **Command Line Entry Point**"""
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Encode the clinical sheet, train the advanced RNN and export the RNN features")
+    parser.add_argument('--input', default='./Clinical_and_Other_Features.xlsx',
+                        help="clinical spreadsheet (default: %(default)s)")
+    parser.add_argument('--output', default='rnn_features',
+                        help="feature store directory for the RNN features (default: %(default)s)")
+    parser.add_argument('--encoder', default='clinical_encoder.json',
+                        help="where to save the fitted ClinicalEncoder state (default: %(default)s)")
+    parser.add_argument('--fitted_encoder', default=None,
+                        help="encode with this saved ClinicalEncoder state instead of fitting (and saving) one")
+    parser.add_argument('--snapshot_dir', default=None,
+                        help="directory for the Parquet snapshot of the spreadsheet (default: next to --input)")
+    parser.add_argument('--epochs', type=int, default=100)
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--checkpoint', default='best_model.keras', help="best-model checkpoint path")
+    parser.add_argument('--rnn_type', choices=('LSTM', 'GRU', 'Dense'), default='LSTM',
+                        help="clinical encoder: recurrent layer type or the feed-forward 'Dense' block")
+    parser.add_argument('--visits', default=None,
+                        help="long-format visits table (CSV/Parquet/xlsx, one row per visit); trains a masked "
+                             "RNN on per-patient visit sequences, labelled from --input")
+    parser.add_argument('--visits_encoder', default='visits_encoder.json',
+                        help="where to save the fitted encoder of the visit features (default: %(default)s)")
+    parser.add_argument('--study', default=None,
+                        help="rnn_sweep.py study database; train its best configuration instead of the default")
+    parser.add_argument('--bootstrap', type=int, default=1000,
+                        help="bootstrap replicates for test-metric confidence intervals (0 to skip)")
+    parser.add_argument('--plot_prefix', default=None,
+                        help="write <prefix>_confusion_matrix/roc_curve/pr_curve.png for the test set")
+    parser.add_argument('--threshold_objective', choices=('youden', 'fbeta', 'sensitivity', 'fixed'),
+                        default='youden', help="how to pick the decision threshold on the validation split "
+                                               "('fixed' keeps 0.5)")
+    parser.add_argument('--beta', type=float, default=1.0, help="F-beta weight for --threshold_objective fbeta")
+    parser.add_argument('--target_sensitivity', type=float, default=0.9,
+                        help="minimum sensitivity for --threshold_objective sensitivity")
+    parser.add_argument('--encode_only', action='store_true',
+                        help="stop after encoding (never imports TensorFlow)")
+    instrumentation.add_arguments(parser)
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    instrumentation.setup(args.profile, args.log_level)
+
+    # --- Data Loading and Header Processing ---
+    # Parsed once, then served from the Parquet snapshot until the xlsx changes
+    clinical_df = load_clinical_table(args.input, snapshot_dir=args.snapshot_dir)
+
+    # Print column info
+    logger.info(f"Total columns: {len(clinical_df.columns)}")
+    logger.info(f"Sample size: {len(clinical_df)}")
+
+    # --- Data Encoding ---
+    target_col = find_target_column(clinical_df)
+
+    # Encode the data, keeping the fitted encoder so new patients are encoded the same way
+    clinical_df = drop_metadata_rows(clinical_df)
+    if args.fitted_encoder:
+        clinical_encoder = ClinicalEncoder.load(args.fitted_encoder)
+    else:
+        clinical_encoder = ClinicalEncoder(target_col=target_col).fit(clinical_df)
+        clinical_encoder.save(args.encoder)
+    encoded_df = encode_clinical_data(clinical_df, encoder=clinical_encoder)
+    logger.info(f"Encoded data shape: {encoded_df.shape}")
+    if args.encode_only:
+        return 0
+    if args.visits:
+        return train_on_visits(args, clinical_df[ID_COL].astype(str).tolist(), encoded_df[target_col].values)
+
+    # --- Data Splitting and Reshaping ---
+    X, y, (X_train_seq, y_train), (X_val_seq, y_val), (X_test_seq, y_test) = \
+        split_rnn_sequences(encoded_df, target_col)
+
+    # --- Model Building ---
+    # Build the advanced RNN model
+    input_shape = (X_train_seq.shape[1], X_train_seq.shape[2])  # (time_steps, features)
+    rnn_params = dict(
+        rnn_type=args.rnn_type,  # 'LSTM', 'GRU' or 'Dense'
+        units=128,             # Number of RNN units
+        bidirectional=True,    # Use bidirectional RNN
+        attention=False,       # Attention mechanism not needed for this data
+        dropout_rate=0.3,      # Dropout rate for regularization
+        l1_reg=0.0001,         # L1 regularization strength
+        l2_reg=0.0001          # L2 regularization strength
+    )
+    if args.study:
+        from rnn_sweep import best_params
+        rnn_params.update(best_params(args.study))
+        logger.info(f"Using the best configuration from {args.study}: {rnn_params}")
+    advanced_model = build_advanced_rnn_model(input_shape=input_shape, **rnn_params)
+
+    # --- Model Training with Callbacks ---
+    # Train the model with advanced callbacks
+    history = train_with_advanced_callbacks(
+        model=advanced_model,
+        X_train=X_train_seq,
+        y_train=y_train,
+        X_val=X_val_seq,
+        y_val=y_val,
+        batch_size=args.batch_size,
+        epochs=args.epochs,
+        early_stopping_patience=10,
+        reduce_lr_patience=5,
+        model_checkpoint_path=args.checkpoint
+    )
+
+    # --- Decision Threshold ---
+    # Tuned on the validation split and saved next to the checkpoint
+    threshold = select_decision_threshold(advanced_model, X_val_seq, y_val, args.checkpoint,
+                                          args.threshold_objective, args.beta, args.target_sensitivity)
+
+    # --- Model Evaluation ---
+    # Evaluate the model
+    metrics = evaluate_binary_classifier(
+        model=advanced_model,
+        X_test=X_test_seq,
+        y_test=y_test,
+        bootstrap=args.bootstrap,
+        plot_prefix=args.plot_prefix,
+        threshold=threshold
+    )
+
+    logger.info(f"Final model performance:")
+    logger.info(f"Accuracy: {metrics['accuracy']:.4f}")
+    logger.info(f"AUC: {metrics['auc']:.4f}")
+    logger.info(f"F1 Score: {metrics['f1_score']:.4f}")
+
+    # --- RNN Feature Export ---
+    from feature_store import save_features
+
+    X_all_seq = np.nan_to_num(np.expand_dims(X.values, axis=1), nan=0.0)
+    features = extract_rnn_features(advanced_model, X_all_seq)
+    save_features(args.output, features, y.values, clinical_df[ID_COL].astype(str).tolist())
+    return 0
+
+def train_on_visits(args, patient_ids, labels):
+    """--visits path of main: masked RNN over per-patient visit sequences"""
+    from sklearn.model_selection import train_test_split
+    from feature_store import save_features
+    from tf_input import pad_sequences
+
+    ids, sequences, visits_encoder = build_visit_sequences(load_visits_table(args.visits))
+    visits_encoder.save(args.visits_encoder)
+
+    # Labels come from the clinical sheet, patients without one are left out
+    label_of = dict(zip(patient_ids, labels))
+    keep = [i for i, patient in enumerate(ids) if patient in label_of]
+    if len(keep) < len(ids):
+        logger.warning(f"{len(ids) - len(keep)} patients in {args.visits} have no label, leaving them out")
+    ids = [ids[i] for i in keep]
+    sequences = [sequences[i] for i in keep]
+    y = np.asarray([label_of[patient] for patient in ids], dtype=np.float32)
+
+    # Split patients (not visits) into train, validation, and test sets
+    rows = np.arange(len(ids))
+    train_rows, temp_rows = train_test_split(rows, test_size=0.30, random_state=42)
+    val_rows, test_rows = train_test_split(temp_rows, test_size=0.50, random_state=42)
+
+    def take(part):
+        return [sequences[i] for i in part]
+
+    rnn_params = dict(rnn_type=args.rnn_type, units=128, bidirectional=True,
+                      dropout_rate=0.3, l1_reg=0.0001, l2_reg=0.0001)
+    if args.study:
+        from rnn_sweep import best_params
+        rnn_params.update(best_params(args.study))
+    model = build_advanced_rnn_model(input_shape=(None, sequences[0].shape[1]), masking=True, **rnn_params)
+
+    train_with_advanced_callbacks(
+        model=model,
+        X_train=take(train_rows), y_train=y[train_rows],
+        X_val=take(val_rows), y_val=y[val_rows],
+        batch_size=args.batch_size,
+        epochs=args.epochs,
+        model_checkpoint_path=args.checkpoint
+    )
+
+    # The validation and test splits are small, pad each once to its longest history
+    threshold = select_decision_threshold(model, pad_sequences(take(val_rows)), y[val_rows], args.checkpoint,
+                                          args.threshold_objective, args.beta, args.target_sensitivity)
+    metrics = evaluate_binary_classifier(model=model, X_test=pad_sequences(take(test_rows)), y_test=y[test_rows],
+                                         bootstrap=args.bootstrap, plot_prefix=args.plot_prefix,
+                                         threshold=threshold)
+    logger.info(f"Final model performance:")
+    logger.info(f"Accuracy: {metrics['accuracy']:.4f}")
+    logger.info(f"AUC: {metrics['auc']:.4f}")
+    logger.info(f"F1 Score: {metrics['f1_score']:.4f}")
+
+    save_features(args.output, extract_rnn_features(model, sequences), y, ids)
+    return 0
 
-# Evaluate the model
-metrics = evaluate_binary_classifier(
-    model=advanced_model,
-    X_test=X_test_seq,
-    y_test=y_test
-)
 
-print(f"Final model performance:")
-print(f"Accuracy: {metrics['accuracy']:.4f}")
-print(f"AUC: {metrics['auc']:.4f}")
-print(f"F1 Score: {metrics['f1_score']:.4f}")
\ No newline at end of file
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,422 @@
+# -*- coding: utf-8 -*-
+"""Single-pass, headless evaluation of binary classifiers.
+
+evaluate_model runs inference once and hands the scores to binary_metrics.
+binary_metrics sorts the scores once. Cumulative true/false positive counts at
+every distinct score give the ROC and PR curves and their areas. The
+confusion matrix at the decision threshold is read off the same counts with one
+searchsorted, and accuracy, precision, recall, specificity, F1 and the
+log loss follow from it.
+
+Bootstrap confidence intervals reuse that sort. A bootstrap replicate is a
+vector of per-row multiplicities, so a block of replicates is a weight matrix.
+Its row-wise cumulative sums give every replicate's curves and confusion
+matrix at once, with no per-replicate Python loop and no re-sorting.
+
+optimize_threshold replaces the fixed 0.5 cutoff. The same sorted cumulative
+counts give the confusion matrix at every candidate threshold, so picking the
+threshold by Youden's J, F-beta or a target sensitivity costs one sort, also
+across CV folds. save_threshold stores the choice next to the saved model.
+
+Plots are rendered only on request, with matplotlib's object API on an Agg
+canvas. Nothing touches pyplot's global state or needs a display, so
+evaluation runs inside batch jobs and CV workers.
+
+Usage:
+    from evaluation import evaluate_model, format_report
+    result = evaluate_model(model, X_test, y_test, bootstrap=1000, plot_prefix='rnn')
+    print(format_report(result))
+    tuned = tune_threshold(model, X_val, y_val, objective='youden')
+    save_threshold('model.keras', tuned)
+"""
+
+import os
+import json
+
+import numpy as np
+
+CLASS_NAMES = ('No Recurrence', 'Recurrence')
+
+# Metrics that get bootstrap intervals
+INTERVAL_METRICS = ('roc_auc', 'pr_auc', 'accuracy', 'precision', 'recall', 'specificity', 'f1')
+
+# Keras' binary_crossentropy clips probabilities to [eps, 1 - eps]
+_EPSILON = 1e-7
+
+
+def _sorted_scores(y_true, y_prob):
+    """Labels in descending score order and the index of the last row of each distinct score"""
+    order = np.argsort(-y_prob, kind='mergesort')
+    scores = y_prob[order]
+    ends = np.r_[np.flatnonzero(np.diff(scores)), len(scores) - 1]
+    return y_true[order], scores, ends
+
+
+def _curve_areas(tps, fps):
+    """
+    ROC and PR AUC from cumulative counts at each distinct threshold, along the last axis
+
+    PR AUC is the trapezoidal area under sklearn's precision_recall_curve (with its
+    (recall 0, precision 1) end point), which is what evaluate_binary_classifier reported.
+    """
+    positives, negatives = tps[..., -1:], fps[..., -1:]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tpr = np.concatenate([np.zeros_like(positives), tps], axis=-1) / positives
+        fpr = np.concatenate([np.zeros_like(negatives), fps], axis=-1) / negatives
+        precision = np.where(tps + fps > 0, tps / np.maximum(tps + fps, 1), 1.0)
+        recall = tps / positives
+    roc_auc = np.sum(np.diff(fpr, axis=-1) * (tpr[..., 1:] + tpr[..., :-1]) / 2, axis=-1)
+    precision = np.concatenate([np.ones_like(positives), precision], axis=-1)
+    recall = np.concatenate([np.zeros_like(positives), recall], axis=-1)
+    pr_auc = np.sum(np.diff(recall, axis=-1) * (precision[..., 1:] + precision[..., :-1]) / 2, axis=-1)
+    return roc_auc, pr_auc
+
+
+def _threshold_metrics(tp, fp, positives, negatives):
+    """Rates at one threshold from confusion counts (arrays broadcast)"""
+    tp, fp = np.asarray(tp, dtype=np.float64), np.asarray(fp, dtype=np.float64)
+    fn, tn = positives - tp, negatives - fp
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = np.where(tp + fp > 0, tp / (tp + fp), 0.0)
+        recall = np.where(positives > 0, tp / positives, 0.0)
+        specificity = np.where(negatives > 0, tn / negatives, 0.0)
+        f1 = np.where(precision + recall > 0, 2 * precision * recall / (precision + recall), 0.0)
+        # Negative class, for the support-weighted F1 classification_report calls "weighted avg"
+        npv = np.where(tn + fn > 0, tn / (tn + fn), 0.0)
+        f1_negative = np.where(npv + specificity > 0, 2 * npv * specificity / (npv + specificity), 0.0)
+        total = positives + negatives
+        return {
+            'accuracy': (tp + tn) / total,
+            'precision': precision,
+            'recall': recall,
+            'specificity': specificity,
+            'f1': f1,
+            'f1_score': (f1 * positives + f1_negative * negatives) / total,
+        }
+
+
+def binary_metrics(y_true, y_prob, threshold=0.5, bootstrap=0, confidence=0.95, seed=0, block=256):
+    """
+    Every evaluation metric of a binary classifier from one sort of its scores
+
+    Parameters:
+    -----------
+    y_true : array-like
+        0/1 labels
+    y_prob : array-like
+        Predicted probabilities of the positive class
+    threshold : float, default=0.5
+        Rows scoring strictly above it are predicted positive
+    bootstrap : int, default=0
+        Number of bootstrap replicates for confidence intervals (0 to skip)
+    confidence : float, default=0.95
+        Coverage of the percentile intervals
+    seed : int, default=0
+        Seed of the bootstrap resampling
+    block : int, default=256
+        Replicates evaluated per vectorized block (bounds memory at block x rows)
+
+    Returns:
+    --------
+    dict
+        accuracy, precision, recall, specificity, f1 (positive class), f1_score
+        (support-weighted, as classification_report's "weighted avg"), roc_auc, auc
+        (same), pr_auc, loss (binary cross-entropy), confusion_matrix [[tn, fp], [fn, tp]],
+        threshold, n, and the curves roc (fpr, tpr, thresholds) and pr (recall, precision).
+        With bootstrap, also intervals {metric: (low, high)} for INTERVAL_METRICS.
+    """
+    y_true = np.asarray(y_true, dtype=np.float64).ravel()
+    y_prob = np.asarray(y_prob, dtype=np.float64).ravel()
+    if y_true.shape != y_prob.shape:
+        raise ValueError(f"y_true has {y_true.size} rows but y_prob has {y_prob.size}")
+
+    labels, scores, ends = _sorted_scores(y_true, y_prob)
+    tps = np.cumsum(labels)[ends]
+    fps = (ends + 1) - tps
+    positives, negatives = tps[-1], fps[-1]
+    roc_auc, pr_auc = _curve_areas(tps, fps)
+
+    # Rows predicted positive are a prefix of the descending order
+    k = int(np.searchsorted(-scores, -threshold, side='left'))
+    tp = np.float64(labels[:k].sum())
+    fp = k - tp
+    metrics = {name: float(value) for name, value in _threshold_metrics(tp, fp, positives, negatives).items()}
+
+    clipped = np.clip(y_prob, _EPSILON, 1 - _EPSILON)
+    metrics.update({
+        'roc_auc': float(roc_auc),
+        'auc': float(roc_auc),
+        'pr_auc': float(pr_auc),
+        'loss': float(-np.mean(y_true * np.log(clipped) + (1 - y_true) * np.log(1 - clipped))),
+        'confusion_matrix': np.array([[negatives - fp, fp], [positives - tp, tp]], dtype=int),
+        'threshold': threshold,
+        'n': int(y_true.size),
+        'roc': (np.r_[0.0, fps / max(negatives, 1)], np.r_[0.0, tps / max(positives, 1)],
+                np.r_[np.inf, scores[ends]]),
+        'pr': (np.r_[0.0, tps / max(positives, 1)], np.r_[1.0, tps / (ends + 1)]),
+    })
+    if bootstrap:
+        metrics['intervals'] = bootstrap_intervals(labels, ends, k, bootstrap, confidence, seed, block)
+    return metrics
+
+
+def bootstrap_intervals(labels, ends, k, n_boot, confidence=0.95, seed=0, block=256):
+    """
+    Percentile intervals of INTERVAL_METRICS over n_boot bootstrap replicates
+
+    labels, ends and k come from binary_metrics' sort. Each replicate draws rows with
+    replacement and is represented by its row counts, so its cumulative counts are
+    a weighted cumsum over the already sorted labels. Replicates without both
+    classes have undefined AUCs and are left out of those intervals.
+    """
+    rng = np.random.default_rng(seed)
+    n = len(labels)
+    samples = {name: [] for name in INTERVAL_METRICS}
+    for start in range(0, n_boot, block):
+        size = min(block, n_boot - start)
+        weights = rng.multinomial(n, np.full(n, 1.0 / n), size=size).astype(np.float64)
+        positive_weights = np.cumsum(weights * labels, axis=1)
+        all_weights = np.cumsum(weights, axis=1)
+        tps, fps = positive_weights[:, ends], (all_weights - positive_weights)[:, ends]
+        positives, negatives = tps[:, -1], fps[:, -1]
+
+        roc_auc, pr_auc = _curve_areas(tps, fps)
+        valid = (positives > 0) & (negatives > 0)
+        samples['roc_auc'].append(np.where(valid, roc_auc, np.nan))
+        samples['pr_auc'].append(np.where(positives > 0, pr_auc, np.nan))
+
+        tp = positive_weights[:, k - 1] if k else np.zeros(size)
+        fp = all_weights[:, k - 1] - tp if k else np.zeros(size)
+        for name, values in _threshold_metrics(tp, fp, positives, negatives).items():
+            if name in samples:
+                samples[name].append(values)
+
+    tail = 100 * (1 - confidence) / 2
+    intervals = {}
+    for name, values in samples.items():
+        values = np.concatenate(values)
+        values = values[~np.isnan(values)]
+        intervals[name] = tuple(float(v) for v in np.percentile(values, [tail, 100 - tail])) if values.size \
+            else (float('nan'), float('nan'))
+    return intervals
+
+
+"""Decision Thresholds"""
+
+THRESHOLD_OBJECTIVES = ('youden', 'fbeta', 'sensitivity')
+
+
+def confusion_counts(y_true, y_prob, thresholds):
+    """
+    tp, fp, fn, tn at every threshold (rows scoring strictly above one are positive)
+
+    One sort of the scores, then a searchsorted per threshold into the cumulative
+    label counts: O((n + m) log n) for n rows and m thresholds.
+    """
+    y_true = np.asarray(y_true, dtype=np.float64).ravel()
+    y_prob = np.asarray(y_prob, dtype=np.float64).ravel()
+    labels, scores, _ = _sorted_scores(y_true, y_prob)
+    k = np.searchsorted(-scores, -np.asarray(thresholds, dtype=np.float64), side='left')
+    tp = np.r_[0.0, np.cumsum(labels)][k]
+    fp = k - tp
+    positives = labels.sum()
+    return tp, fp, positives - tp, (len(labels) - positives) - fp
+
+
+def candidate_thresholds(y_prob):
+    """
+    Descending thresholds that realize every distinct cut of the scores
+
+    Midpoints between adjacent distinct scores, plus the top score (nothing
+    positive) and just below the lowest one (everything positive).
+    """
+    scores = np.unique(np.asarray(y_prob, dtype=np.float64).ravel())[::-1]
+    return np.r_[scores[0], (scores[:-1] + scores[1:]) / 2, np.nextafter(scores[-1], -np.inf)]
+
+
+def optimize_threshold(y_true, y_prob, objective='youden', beta=1.0, target_sensitivity=0.9):
+    """
+    Decision threshold that maximizes an objective over every candidate cut
+
+    Parameters:
+    -----------
+    y_true, y_prob : array-like, or list of array-like
+        Labels and positive-class probabilities. Pass one array per CV fold (e.g. the
+        y_true/y_prob of fusion_layer.cross_validate) to tune across folds: every
+        candidate is scored on every fold and the best mean over the folds wins.
+    objective : {'youden', 'fbeta', 'sensitivity'}, default='youden'
+        'youden' maximizes sensitivity + specificity - 1, 'fbeta' the F-beta score,
+        'sensitivity' the specificity among thresholds reaching target_sensitivity
+    beta : float, default=1.0
+        Weight of recall in F-beta
+    target_sensitivity : float, default=0.9
+        Minimum (mean) sensitivity for objective='sensitivity'
+
+    Returns:
+    --------
+    dict
+        threshold, objective, score, sensitivity, specificity (means over the folds at
+        the threshold), fold_scores and n_folds. Ties go to the highest threshold.
+    """
+    if objective not in THRESHOLD_OBJECTIVES:
+        raise ValueError(f"objective must be one of {THRESHOLD_OBJECTIVES}, got {objective!r}")
+    if objective == 'sensitivity' and not 0 <= target_sensitivity <= 1:
+        raise ValueError(f"target_sensitivity must be in [0, 1], got {target_sensitivity}")
+    folds = list(zip(y_true, y_prob)) if isinstance(y_prob, (list, tuple)) else [(y_true, y_prob)]
+
+    candidates = candidate_thresholds(np.concatenate([np.ravel(prob) for _, prob in folds]))
+    # (folds, 4, candidates)
+    tp, fp, fn, tn = np.moveaxis(np.array([confusion_counts(t, p, candidates) for t, p in folds]), 1, 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sensitivity = np.where(tp + fn > 0, tp / (tp + fn), 0.0)
+        specificity = np.where(tn + fp > 0, tn / (tn + fp), 0.0)
+        if objective == 'youden':
+            scores = sensitivity + specificity - 1
+        elif objective == 'fbeta':
+            weighted = (1 + beta ** 2) * tp
+            scores = np.where(weighted + fp > 0, weighted / (weighted + beta ** 2 * fn + fp), 0.0)
+        else:
+            scores = specificity
+    mean_scores = scores.mean(axis=0)
+    if objective == 'sensitivity':
+        # Everything-positive always reaches the target, so some candidate is feasible
+        mean_scores = np.where(sensitivity.mean(axis=0) >= target_sensitivity, mean_scores, -np.inf)
+    best = int(np.argmax(mean_scores))
+    return {
+        'threshold': float(candidates[best]),
+        'objective': objective,
+        'score': float(mean_scores[best]),
+        'sensitivity': float(sensitivity[:, best].mean()),
+        'specificity': float(specificity[:, best].mean()),
+        'fold_scores': [float(v) for v in scores[:, best]],
+        'n_folds': len(folds),
+        **({'beta': beta} if objective == 'fbeta' else {}),
+        **({'target_sensitivity': target_sensitivity} if objective == 'sensitivity' else {}),
+    }
+
+
+def tune_threshold(model, x, y_true, objective='youden', beta=1.0, target_sensitivity=0.9, batch_size=256):
+    """Score a Keras model once on tuning data (e.g. the validation split) and optimize_threshold"""
+    if not isinstance(x, dict):
+        x = np.asarray(x)
+    y_prob = np.asarray(model.predict(x, batch_size=batch_size, verbose=0)).ravel()
+    return optimize_threshold(np.asarray(y_true), y_prob, objective, beta, target_sensitivity)
+
+
+def threshold_path(model_path):
+    """Where the decision threshold of a saved model lives: model.keras -> model.threshold.json"""
+    return os.path.splitext(model_path)[0] + '.threshold.json'
+
+
+def save_threshold(model_path, result):
+    """Write an optimize_threshold result next to the saved model (atomically)"""
+    path = threshold_path(model_path)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(result, f, indent=2)
+    os.replace(tmp_path, path)
+    return path
+
+
+def load_threshold(model_path, default=0.5):
+    """Decision threshold saved with model_path, or default if it has none"""
+    path = threshold_path(model_path)
+    if not os.path.exists(path):
+        return default
+    with open(path) as f:
+        return float(json.load(f)['threshold'])
+
+
+def format_threshold(result):
+    """One-line summary of an optimize_threshold result"""
+    folds = f" over {result['n_folds']} folds" if result['n_folds'] > 1 else ""
+    name = {'youden': "Youden's J", 'fbeta': f"F{result.get('beta', 1.0):g}",
+            'sensitivity': f"specificity at sensitivity >= {result.get('target_sensitivity', 0):g}"}[result['objective']]
+    return (f"Decision threshold {result['threshold']:.4f} ({name} = {result['score']:.4f}{folds}; "
+            f"sensitivity {result['sensitivity']:.4f}, specificity {result['specificity']:.4f})")
+
+
+def evaluate_model(model, x, y_true, threshold=0.5, bootstrap=0, plot_prefix=None, class_names=CLASS_NAMES,
+                   batch_size=256, seed=0):
+    """
+    Score a Keras model once and compute binary_metrics (and optionally the plots)
+
+    x is whatever model.predict accepts (an array, or a dict for the fusion model).
+    plot_prefix, if given, writes <prefix>_confusion_matrix.png, <prefix>_roc_curve.png
+    and <prefix>_pr_curve.png. The returned dict also holds the scores under 'y_prob'.
+    """
+    if not isinstance(x, dict):
+        # Plain arrays: after fitting on tf.data, Keras' pandas adapter fails on DataFrames
+        x = np.asarray(x)
+    y_prob = np.asarray(model.predict(x, batch_size=batch_size, verbose=0)).ravel()
+    metrics = binary_metrics(y_true, y_prob, threshold=threshold, bootstrap=bootstrap, seed=seed)
+    metrics['y_prob'] = y_prob
+    if plot_prefix:
+        metrics['plots'] = plot_evaluation(metrics, plot_prefix, class_names)
+    return metrics
+
+
+def plot_evaluation(metrics, prefix, class_names=CLASS_NAMES):
+    """Write the confusion matrix, ROC and PR plots of binary_metrics output; returns the file paths"""
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    paths = []
+
+    def save(fig, name):
+        FigureCanvasAgg(fig)
+        path = f"{prefix}_{name}.png"
+        fig.savefig(path)
+        paths.append(path)
+
+    cm = metrics['confusion_matrix']
+    fig = Figure(figsize=(8, 6), tight_layout=True)
+    ax = fig.add_subplot()
+    image = ax.imshow(cm, interpolation='nearest', cmap='Blues')
+    fig.colorbar(image, ax=ax)
+    ax.set(title='Confusion Matrix', xlabel='Predicted Label', ylabel='True Label',
+           xticks=range(len(class_names)), yticks=range(len(class_names)),
+           xticklabels=class_names, yticklabels=class_names)
+    for i in range(cm.shape[0]):
+        for j in range(cm.shape[1]):
+            ax.text(j, i, format(cm[i, j], 'd'), horizontalalignment="center",
+                    color="white" if cm[i, j] > cm.max() / 2 else "black")
+    save(fig, 'confusion_matrix')
+
+    fpr, tpr, _ = metrics['roc']
+    fig = Figure(figsize=(8, 6))
+    ax = fig.add_subplot()
+    ax.plot(fpr, tpr, color='darkorange', lw=2, label=f"ROC curve (area = {metrics['roc_auc']:.2f})")
+    ax.plot([0, 1], [0, 1], color='navy', lw=2, linestyle='--')
+    ax.set(xlim=(0.0, 1.0), ylim=(0.0, 1.05), xlabel='False Positive Rate', ylabel='True Positive Rate',
+           title='Receiver Operating Characteristic')
+    ax.legend(loc="lower right")
+    save(fig, 'roc_curve')
+
+    recall, precision = metrics['pr']
+    fig = Figure(figsize=(8, 6))
+    ax = fig.add_subplot()
+    ax.plot(recall, precision, color='blue', lw=2, label=f"PR curve (area = {metrics['pr_auc']:.2f})")
+    ax.set(xlabel='Recall', ylabel='Precision', title='Precision-Recall Curve')
+    ax.legend(loc="lower left")
+    save(fig, 'pr_curve')
+    return paths
+
+
+def format_report(metrics, class_names=CLASS_NAMES):
+    """Text summary of binary_metrics output, with intervals when they were computed"""
+    (tn, fp), (fn, tp) = metrics['confusion_matrix']
+    intervals = metrics.get('intervals', {})
+    lines = [
+        f"n = {metrics['n']}, threshold = {metrics['threshold']:g}",
+        f"Confusion matrix (rows true, columns predicted; {class_names[0]}, {class_names[1]}):",
+        f"  [[{tn:>5} {fp:>5}]",
+        f"   [{fn:>5} {tp:>5}]]",
+    ]
+    for name in ('accuracy', 'precision', 'recall', 'specificity', 'f1', 'f1_score', 'roc_auc', 'pr_auc', 'loss'):
+        line = f"{name:<12} {metrics[name]:.4f}"
+        if name in intervals:
+            low, high = intervals[name]
+            line += f"  [{low:.4f}, {high:.4f}]"
+        lines.append(line)
+    return "\n".join(lines)
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""Append-only, per-patient feature shards for resumable CNN extraction.
+
+Every patient's feature vector is written to its own small .npz shard (atomically)
+together with the fingerprint of the sources it was computed from. A re-run skips
+any patient whose shard exists with a matching fingerprint, so a crash only loses
+the batch in flight and adding new patients only extracts the new ones. compact()
+consolidates the shards into the feature store fusion_layer.py consumes.
+"""
+
+import os
+import re
+
+import numpy as np
+
+from feature_store import save_features
+from instrumentation import get_logger, stage
+
+logger = get_logger('feature_shards')
+
+
+def _shard_name(patient):
+    # Patient ids are folder names, keep them readable but filesystem safe
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', str(patient)) + ".npz"
+
+
+class FeatureShardStore:
+    def __init__(self, shard_dir):
+        """shard_dir: directory holding one <patient>.npz shard per extracted patient"""
+        self.shard_dir = shard_dir
+        os.makedirs(shard_dir, exist_ok=True)
+
+    def _path(self, patient):
+        return os.path.join(self.shard_dir, _shard_name(patient))
+
+    def __contains__(self, patient):
+        return os.path.exists(self._path(patient))
+
+    def ids(self):
+        """Ids of every patient with a shard on disk"""
+        ids = []
+        for name in sorted(os.listdir(self.shard_dir)):
+            if name.endswith(".npz"):
+                with np.load(os.path.join(self.shard_dir, name), allow_pickle=False) as shard:
+                    ids.append(str(shard['id']))
+        return ids
+
+    def fingerprint(self, patient):
+        """Fingerprint the stored shard was computed from, or None if there is no readable shard"""
+        path = self._path(patient)
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path, allow_pickle=False) as shard:
+                return str(shard['fingerprint'])
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def is_current(self, patient, fingerprint):
+        return self.fingerprint(patient) == fingerprint
+
+    def write(self, patient, features, label, fingerprint):
+        path = self._path(patient)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, id=str(patient), features=np.asarray(features, dtype=np.float32),
+                     label=np.float32(label), fingerprint=fingerprint)
+        os.replace(tmp_path, path)
+
+    def read(self, patient):
+        """Return (features, label) for a patient"""
+        with np.load(self._path(patient), allow_pickle=False) as shard:
+            return shard['features'], float(shard['label'])
+
+    def compact(self, ids=None, output="cnn_features"):
+        """
+        Consolidate shards into the feature store directory fusion_layer.py loads
+
+        ids: patients to include, in row order (defaults to every shard, sorted by id).
+        Patients without a shard are skipped with a warning.
+        """
+        if ids is None:
+            ids = sorted(self.ids())
+        features, labels, kept = [], [], []
+        with stage('shard_compact', shards=len(ids)):
+            for patient in ids:
+                if patient not in self:
+                    logger.warning(f"No feature shard for {patient}, leaving it out")
+                    continue
+                feature, label = self.read(patient)
+                features.append(feature)
+                labels.append(label)
+                kept.append(patient)
+
+        save_features(output, np.stack(features) if features else np.empty((0, 0), dtype=np.float32),
+                      labels, kept)
+        logger.info(f"Compacted {len(kept)} feature shards into {output}")
+        return kept
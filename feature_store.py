@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""Columnar, memory-mappable feature store for the CNN and RNN features.
+
+A feature store is a directory holding one .npy file per column plus a small
+metadata file:
+
+    cnn_features/
+        features.npy   float32 (n_rows, n_features)
+        labels.npy     float32 (n_rows,)
+        ids.npy        unicode (n_rows,)
+        meta.json      format version, row/feature counts, dtype
+
+Columns load through np.load(mmap_mode='r'), so opening even a very large cohort
+only maps the files, and nothing is unpickled. join_features aligns two stores
+on their ids with a single vectorized intersection instead of a DataFrame round trip
+(join_rows gives just the row positions, for readers that stream the rows).
+
+Usage (one-off migration of the old pickles):
+    python feature_store.py cnn_features.pkl cnn_features
+"""
+
+import os
+import sys
+import json
+import shutil
+import argparse
+
+import numpy as np
+
+import instrumentation
+from instrumentation import get_logger, stage, count
+
+FORMAT_VERSION = 1
+FEATURE_DTYPE = np.float32
+
+logger = get_logger('feature_store')
+
+
+class FeatureSet:
+    def __init__(self, features, labels, ids):
+        self.features = features
+        self.labels = labels
+        self.ids = ids
+        self._rows = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def n_features(self):
+        return self.features.shape[1]
+
+    def rows(self, ids):
+        """Row positions of the given ids (KeyError if one is missing)"""
+        if self._rows is None:
+            self._rows = {patient: row for row, patient in enumerate(self.ids.tolist())}
+        return np.asarray([self._rows[patient] for patient in ids], dtype=np.intp)
+
+    def take(self, ids):
+        """New in-memory FeatureSet with only the given ids, in that order"""
+        rows = self.rows(ids)
+        return FeatureSet(self.features[rows], self.labels[rows], self.ids[rows])
+
+
+def validate(features, labels, ids):
+    """Raise ValueError unless the three columns form a consistent feature table"""
+    if features.ndim != 2:
+        raise ValueError(f"features must be 2D (n_rows, n_features), got shape {features.shape}")
+    if features.dtype != FEATURE_DTYPE:
+        raise ValueError(f"features must be {np.dtype(FEATURE_DTYPE).name}, got {features.dtype}")
+    if labels.ndim != 1 or ids.ndim != 1:
+        raise ValueError(f"labels and ids must be 1D, got {labels.shape} and {ids.shape}")
+    if not (len(features) == len(labels) == len(ids)):
+        raise ValueError(f"row counts differ: features={len(features)}, labels={len(labels)}, ids={len(ids)}")
+
+
+def save_features(path, features, labels, ids):
+    """Write a feature store directory, replacing any existing store at path"""
+    features = np.ascontiguousarray(features, dtype=FEATURE_DTYPE)
+    if features.ndim == 1 and features.size == 0:
+        features = features.reshape(0, 0)
+    labels = np.asarray(labels, dtype=FEATURE_DTYPE)
+    ids = np.asarray([str(patient) for patient in ids], dtype=str)
+    validate(features, labels, ids)
+    if len(np.unique(ids)) != len(ids):
+        raise ValueError("ids must be unique")
+
+    tmp_path = path.rstrip(os.sep) + ".tmp"
+    with stage('feature_store_write', path=path, rows=int(features.shape[0])):
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        np.save(os.path.join(tmp_path, "features.npy"), features, allow_pickle=False)
+        np.save(os.path.join(tmp_path, "labels.npy"), labels, allow_pickle=False)
+        np.save(os.path.join(tmp_path, "ids.npy"), ids, allow_pickle=False)
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump({
+                'version': FORMAT_VERSION,
+                'n_rows': int(features.shape[0]),
+                'n_features': int(features.shape[1]),
+                'dtype': np.dtype(FEATURE_DTYPE).name,
+            }, f, indent=1)
+
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+    count('feature_bytes_written', features.nbytes + labels.nbytes + ids.nbytes)
+    logger.info(f"Saved {features.shape[0]} x {features.shape[1]} features to {path}")
+
+
+def load_features(path, mmap=True):
+    """Open a feature store; columns are read-only memory maps unless mmap=False"""
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    if meta.get('version') != FORMAT_VERSION:
+        raise ValueError(f"Unsupported feature store version in {path}: {meta.get('version')}")
+
+    mmap_mode = 'r' if mmap else None
+    with stage('feature_store_read', path=path, mmap=mmap):
+        features = np.load(os.path.join(path, "features.npy"), mmap_mode=mmap_mode, allow_pickle=False)
+        labels = np.load(os.path.join(path, "labels.npy"), mmap_mode=mmap_mode, allow_pickle=False)
+        ids = np.load(os.path.join(path, "ids.npy"), mmap_mode=mmap_mode, allow_pickle=False)
+    validate(features, labels, ids)
+    if features.shape != (meta['n_rows'], meta['n_features']):
+        raise ValueError(f"{path}: features shape {features.shape} does not match meta.json "
+                         f"({meta['n_rows']}, {meta['n_features']})")
+    return FeatureSet(features, labels, ids)
+
+
+def join_rows(left, right):
+    """
+    Row positions of the ids both FeatureSets share, in left's row order
+
+    Returns (left_rows, right_rows, ids) without reading any feature data.
+    """
+    ids, left_rows, right_rows = np.intersect1d(left.ids, right.ids, assume_unique=True, return_indices=True)
+    order = np.argsort(left_rows, kind='stable')
+    return left_rows[order], right_rows[order], ids[order]
+
+
+def join_features(left, right):
+    """
+    Inner-join two FeatureSets on id, keeping left's row order
+
+    Returns (left_features, right_features, labels, ids), labels taken from left.
+    """
+    left_rows, right_rows, ids = join_rows(left, right)
+    return left.features[left_rows], right.features[right_rows], left.labels[left_rows], ids
+
+
+def convert_pickle(pkl_path, path):
+    """Migrate a legacy {'features', 'labels', 'ids'} pickle (only run this on files you trust)"""
+    import pickle
+    with stage('pickle_read', path=pkl_path), open(pkl_path, "rb") as f:
+        legacy = pickle.load(f)
+    count('pickle_bytes_read', os.path.getsize(pkl_path))
+    save_features(path, legacy['features'], legacy['labels'], legacy['ids'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert a legacy features pickle into a feature store")
+    parser.add_argument('pickle', help="legacy .pkl with features, labels and ids")
+    parser.add_argument('output', help="feature store directory to write")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args(argv)
+    instrumentation.setup(args.profile, args.log_level)
+    convert_pickle(args.pickle, args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -13,50 +13,48 @@ Original file is located at
 # **Environment Setup and Imports**
 """
 
-import pickle
-import numpy as np
-import pandas as pd
+import os
+import sys
+import time
+import argparse
 from collections import Counter
-from sklearn.model_selection import train_test_split, StratifiedKFold
-from sklearn.metrics import confusion_matrix, classification_report, roc_auc_score
-import tensorflow as tf
-from tensorflow.keras import Input, Model
-from tensorflow.keras.layers import (
-    Dense, Dropout, BatchNormalization,
-    Concatenate, Multiply, Activation
-)
+
+import numpy as np
+
+import instrumentation
+from instrumentation import get_logger, stage, count
+from feature_store import load_features, join_features
+from tf_input import make_dataset
+from tf_workers import tf_process_pool
+
+# TensorFlow/Keras and scikit-learn are imported inside the functions that use them,
+# so importing this module and --help stay fast
+
+logger = get_logger('fusion_layer')
 
 """# **Data Preprocessing**
 
 ## *Data Loading*
 """
 
-# --- Data Loading & Alignment ---
-with open('rnn_features.pkl','rb') as f: rnn = pickle.load(f)
-with open('cnn_features.pkl','rb') as f: cnn = pickle.load(f)
-
-df_rnn = pd.DataFrame(rnn['features'], index=rnn['ids'])
-df_rnn['label'] = rnn['labels']
-df_cnn = pd.DataFrame(cnn['features'], index=cnn['ids'])
-df_cnn['label'] = cnn['labels']
+def load_aligned_features(cnn_path='cnn_features', rnn_path='rnn_features'):
+    """Load both feature stores and align them on patient id (labels come from the RNN side)"""
+    # --- Data Loading & Alignment ---
+    rnn = load_features(rnn_path)
+    cnn = load_features(cnn_path)
 
-common = df_rnn.index.intersection(df_cnn.index)
-df_rnn = df_rnn.loc[common]
-df_cnn = df_cnn.loc[common]
+    X_rnn, X_cnn, y, common = join_features(rnn, cnn)
 
-X_rnn = df_rnn.drop(columns='label').values
-X_cnn = df_cnn.drop(columns='label').values
-y     = df_rnn['label'].values
-
-print('Feature shapes:', 'CNN:', X_cnn.shape, 'RNN:', X_rnn.shape)
-print('Label distribution:', Counter(y))
+    logger.info(f"Feature shapes: CNN: {X_cnn.shape} RNN: {X_rnn.shape}")
+    logger.info(f"Label distribution: {Counter(y)}")
+    return X_cnn, X_rnn, y, common
 
 """## *Feature Merging*
 single-input vs dual-input (choose which one to run)
 
 plan:
 
-*   single‑input fusion for baseline  
+*   single‑input fusion for baseline
 *   dual‑input gated fusion for fine tuning
 
 ### dual-input
@@ -64,98 +62,289 @@ plan:
 ## *Data Splitting*
 """
 
-# --- Train/Validation/Test Split ---
-Xc_train, Xc_temp, Xr_train, Xr_temp, y_train, y_temp = train_test_split(
-    X_cnn, X_rnn, y,
-    test_size=0.30, random_state=42, stratify=y
-)
-try:
-    Xc_val, Xc_test, Xr_val, Xr_test, y_val, y_test = train_test_split(
-        Xc_temp, Xr_temp, y_temp,
-        test_size=0.50, random_state=42, stratify=y_temp
-    )
-except ValueError:
-    Xc_val, Xc_test, Xr_val, Xr_test, y_val, y_test = train_test_split(
-        Xc_temp, Xr_temp, y_temp,
-        test_size=0.50, random_state=42
+def split_features(X_cnn, X_rnn, y):
+    """Stratified 70/15/15 train/validation/test split of the aligned features"""
+    from sklearn.model_selection import train_test_split
+
+    # --- Train/Validation/Test Split ---
+    Xc_train, Xc_temp, Xr_train, Xr_temp, y_train, y_temp = train_test_split(
+        X_cnn, X_rnn, y,
+        test_size=0.30, random_state=42, stratify=y
     )
-print('Split sizes:', Counter(y_train), Counter(y_val), Counter(y_test))
+    try:
+        Xc_val, Xc_test, Xr_val, Xr_test, y_val, y_test = train_test_split(
+            Xc_temp, Xr_temp, y_temp,
+            test_size=0.50, random_state=42, stratify=y_temp
+        )
+    except ValueError:
+        Xc_val, Xc_test, Xr_val, Xr_test, y_val, y_test = train_test_split(
+            Xc_temp, Xr_temp, y_temp,
+            test_size=0.50, random_state=42
+        )
+    logger.info(f"Split sizes: {Counter(y_train)} {Counter(y_val)} {Counter(y_test)}")
+    return (Xc_train, Xr_train, y_train), (Xc_val, Xr_val, y_val), (Xc_test, Xr_test, y_test)
 
 """# **Fusion Model**
 
 ## *Model Building*
 """
 
-# --- Build gated fusion model ---
-input_cnn = Input(shape=(X_cnn.shape[1],), name='cnn_in')
-input_rnn = Input(shape=(X_rnn.shape[1],), name='rnn_in')
-
-# Modality-specific projections
-proj_cnn = Dense(128, activation='relu')(input_cnn)
-proj_cnn = BatchNormalization()(proj_cnn)
-proj_cnn = Dropout(0.3)(proj_cnn)
-
-proj_rnn = Dense(128, activation='relu')(input_rnn)
-proj_rnn = BatchNormalization()(proj_rnn)
-proj_rnn = Dropout(0.3)(proj_rnn)
-
-# Gating mechanism
-gate = Concatenate()([proj_cnn, proj_rnn])
-gate = Dense(128, activation='sigmoid', name='fusion_gate')(gate)
-
-# Elementwise fusion
-fused_cnn = Multiply()([gate, proj_cnn])
-inv_gate = Activation('linear')(1.0 - gate)
-fused_rnn = Multiply()([inv_gate, proj_rnn])
-fused = tf.keras.layers.Add()([fused_cnn, fused_rnn])
-
-# Joint MLP
-x = Dense(64, activation='relu')(fused)
-x = BatchNormalization()(x)
-x = Dropout(0.3)(x)
-x = Dense(32, activation='relu')(x)
-x = Dropout(0.3)(x)
-output = Dense(1, activation='sigmoid', name='out')(x)
-
-model = Model(inputs=[input_cnn, input_rnn], outputs=output, name='gated_fusion_model')
-model.compile(optimizer='adam', loss='binary_crossentropy', metrics=['accuracy', tf.keras.metrics.AUC(name='auc')])
-model.summary()
-
-"""## *Model Training*"""
-
-# --- Training ---
-history = model.fit(
-    {'cnn_in': Xc_train, 'rnn_in': Xr_train},
-    y_train,
-    validation_data=({'cnn_in': Xc_val, 'rnn_in': Xr_val}, y_val),
-    epochs=50, batch_size=32, verbose=2
-)
+def build_gated_fusion_model(cnn_dim, rnn_dim):
+    """Gated fusion of the CNN and RNN feature vectors, compiled for binary classification"""
+    import tensorflow as tf
+    from tensorflow.keras import Input, Model
+    from tensorflow.keras.layers import (
+        Dense, Dropout, BatchNormalization,
+        Concatenate, Multiply, Activation
+    )
+
+    # --- Build gated fusion model ---
+    input_cnn = Input(shape=(cnn_dim,), name='cnn_in')
+    input_rnn = Input(shape=(rnn_dim,), name='rnn_in')
+
+    # Modality-specific projections
+    proj_cnn = Dense(128, activation='relu')(input_cnn)
+    proj_cnn = BatchNormalization()(proj_cnn)
+    proj_cnn = Dropout(0.3)(proj_cnn)
+
+    proj_rnn = Dense(128, activation='relu')(input_rnn)
+    proj_rnn = BatchNormalization()(proj_rnn)
+    proj_rnn = Dropout(0.3)(proj_rnn)
+
+    # Gating mechanism
+    gate = Concatenate()([proj_cnn, proj_rnn])
+    gate = Dense(128, activation='sigmoid', name='fusion_gate')(gate)
+
+    # Elementwise fusion
+    fused_cnn = Multiply()([gate, proj_cnn])
+    inv_gate = Activation('linear')(1.0 - gate)
+    fused_rnn = Multiply()([inv_gate, proj_rnn])
+    fused = tf.keras.layers.Add()([fused_cnn, fused_rnn])
+
+    # Joint MLP
+    x = Dense(64, activation='relu')(fused)
+    x = BatchNormalization()(x)
+    x = Dropout(0.3)(x)
+    x = Dense(32, activation='relu')(x)
+    x = Dropout(0.3)(x)
+    output = Dense(1, activation='sigmoid', name='out')(x)
+
+    model = Model(inputs=[input_cnn, input_rnn], outputs=output, name='gated_fusion_model')
+    model.compile(optimizer='adam', loss='binary_crossentropy', metrics=['accuracy', tf.keras.metrics.AUC(name='auc')])
+    return model
 
 """## *Model Evaluation*"""
 
-# --- Evaluation on Test Set ---
-y_test_prob = model.predict({'cnn_in': Xc_test, 'rnn_in': Xr_test}).ravel()
-y_test_pred = (y_test_prob >= 0.5).astype(int)
-print('Confusion matrix on test set:')
-print(confusion_matrix(y_test, y_test_pred))
-print(classification_report(y_test, y_test_pred))
-print('Test ROC AUC:', roc_auc_score(y_test, y_test_prob))
-
-# --- Stratified K-Fold Cross-Validation ---
-skf = StratifiedKFold(n_splits=5, shuffle=True, random_state=42)
-auc_scores = []
-for train_idx, test_idx in skf.split(X_cnn, y):
-    Xc_tr, Xc_te = X_cnn[train_idx], X_cnn[test_idx]
-    Xr_tr, Xr_te = X_rnn[train_idx], X_rnn[test_idx]
-    y_tr, y_te = y[train_idx], y[test_idx]
-    # Reinitialize model for each fold
-    m = tf.keras.models.clone_model(model)
-    m.compile(optimizer='adam', loss='binary_crossentropy')
-    m.fit(
-        {'cnn_in': Xc_tr, 'rnn_in': Xr_tr},
-        y_tr,
-        epochs=30, batch_size=32, verbose=0
-    )
-    prob = m.predict({'cnn_in': Xc_te, 'rnn_in': Xr_te}).ravel()
-    auc_scores.append(roc_auc_score(y_te, prob))
-print('Stratified K-Fold mean ROC AUC:', np.mean(auc_scores))
\ No newline at end of file
+def evaluate_fusion_model(model, Xc_test, Xr_test, y_test, bootstrap=0, plot_prefix=None, threshold=None):
+    """
+    Print the test-set metrics (one inference pass, optional bootstrap intervals/plots) and return the ROC AUC
+
+    threshold is the decision threshold (rows scoring above it are positive), e.g. from
+    tune_fusion_threshold; by default rows at or above 0.5.
+    """
+    from evaluation import evaluate_model, format_report
+
+    if threshold is None:
+        # evaluation thresholds strictly above
+        threshold = np.nextafter(0.5, 0)
+    # --- Evaluation on Test Set ---
+    with stage('evaluate', rows=len(y_test), bootstrap=bootstrap):
+        metrics = evaluate_model(model, {'cnn_in': Xc_test, 'rnn_in': Xr_test}, y_test,
+                                 threshold=threshold, bootstrap=bootstrap, plot_prefix=plot_prefix)
+    logger.info('Metrics on test set:')
+    logger.info(format_report(metrics))
+    return metrics['roc_auc']
+
+def tune_fusion_threshold(model, Xc_val, Xr_val, y_val, objective='youden', beta=1.0, target_sensitivity=0.9,
+                          cv_results=None):
+    """
+    Decision threshold of the fusion model, tuned on the validation split or, given
+    cross_validate's results, on the held-out predictions of all its folds at once
+
+    Returns:
+    --------
+    dict
+        evaluation.optimize_threshold result
+    """
+    from evaluation import optimize_threshold, tune_threshold, format_threshold
+
+    with stage('threshold_tuning', objective=objective, folds=len(cv_results or ())):
+        if cv_results:
+            result = optimize_threshold([r['y_true'] for r in cv_results], [r['y_prob'] for r in cv_results],
+                                        objective, beta, target_sensitivity)
+        else:
+            result = tune_threshold(model, {'cnn_in': Xc_val, 'rnn_in': Xr_val}, y_val, objective, beta,
+                                    target_sensitivity)
+    logger.info(format_threshold(result))
+    return result
+
+# Fold data shared by every task of a CV worker, set once by _init_cv_worker
+_cv_data = None
+
+def _init_cv_worker(X_cnn, X_rnn, y):
+    global _cv_data
+    _cv_data = (X_cnn, X_rnn, y)
+
+def _run_fold(fold, train_idx, test_idx, epochs, batch_size, seed):
+    """Train a fresh fusion model on one fold and score its held-out rows"""
+    import tensorflow as tf
+
+    from evaluation import binary_metrics
+
+    X_cnn, X_rnn, y = _cv_data
+    start = time.perf_counter()
+    with stage('cv_fold', fold=fold, rows=len(train_idx), epochs=epochs):
+        # Fresh graph state and a per-fold seed, so results don't depend on fold order or worker
+        tf.keras.backend.clear_session()
+        tf.keras.utils.set_random_seed(seed + fold)
+
+        Xc_tr, Xc_te = X_cnn[train_idx], X_cnn[test_idx]
+        Xr_tr, Xr_te = X_rnn[train_idx], X_rnn[test_idx]
+        y_tr, y_te = y[train_idx], y[test_idx]
+        # Reinitialize model for each fold
+        m = build_gated_fusion_model(X_cnn.shape[1], X_rnn.shape[1])
+        m.compile(optimizer='adam', loss='binary_crossentropy')
+        with stage('keras_fit', rows=len(train_idx), epochs=epochs, batch_size=batch_size):
+            m.fit(
+                make_dataset({'cnn_in': Xc_tr, 'rnn_in': Xr_tr}, y_tr, batch_size=batch_size, shuffle=True),
+                epochs=epochs, verbose=0
+            )
+        prob = m.predict({'cnn_in': Xc_te, 'rnn_in': Xr_te}, verbose=0).ravel()
+        count('keras_epochs', epochs)
+    return {
+        'fold': fold,
+        'auc': binary_metrics(y_te, prob)['roc_auc'],
+        'seconds': time.perf_counter() - start,
+        'test_idx': test_idx,
+        'y_true': y_te,
+        'y_prob': prob,
+    }
+
+def cross_validate(X_cnn, X_rnn, y, n_splits=5, epochs=30, batch_size=32, n_jobs=None, seed=42):
+    """
+    Stratified K-fold cross-validation of the gated fusion model, folds run in parallel
+
+    Each fold trains in its own spawned process with TensorFlow limited to its share
+    of the cores (cores // n_jobs threads), so the folds split the machine instead of
+    oversubscribing it. n_jobs=1 runs the folds serially in this process.
+
+    Returns:
+    --------
+    list of dict
+        One entry per fold: fold, auc, seconds, test_idx, y_true, y_prob
+    """
+    from sklearn.model_selection import StratifiedKFold
+
+    n_jobs = min(n_jobs or os.cpu_count() or 1, n_splits)
+    X_cnn, X_rnn, y = np.asarray(X_cnn), np.asarray(X_rnn), np.asarray(y)
+
+    # --- Stratified K-Fold Cross-Validation ---
+    skf = StratifiedKFold(n_splits=n_splits, shuffle=True, random_state=seed)
+    folds = list(skf.split(X_cnn, y))
+    start = time.perf_counter()
+    with stage('cross_validate', folds=n_splits, jobs=n_jobs):
+        if n_jobs == 1:
+            _init_cv_worker(X_cnn, X_rnn, y)
+            results = [_run_fold(fold, train_idx, test_idx, epochs, batch_size, seed)
+                       for fold, (train_idx, test_idx) in enumerate(folds)]
+        else:
+            with tf_process_pool(n_jobs, initializer=_init_cv_worker, initargs=(X_cnn, X_rnn, y)) as pool:
+                futures = [pool.submit(_run_fold, fold, train_idx, test_idx, epochs, batch_size, seed)
+                           for fold, (train_idx, test_idx) in enumerate(folds)]
+                results = [future.result() for future in futures]
+    wall_time = time.perf_counter() - start
+
+    for result in results:
+        logger.info(f"Fold {result['fold']}: ROC AUC {result['auc']:.4f} ({result['seconds']:.1f}s)")
+    logger.info(f"Stratified K-Fold mean ROC AUC: {np.mean([result['auc'] for result in results]):.4f}")
+    logger.info(f"{n_splits} folds in {wall_time:.1f}s wall time with {n_jobs} workers "
+                f"({sum(result['seconds'] for result in results):.1f}s of fold time)")
+    return results
+
+"""# **Command Line Entry Point**"""
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Train and evaluate the gated CNN+RNN fusion model")
+    parser.add_argument('--cnn_features', default='cnn_features',
+                        help="CNN feature store directory (default: %(default)s)")
+    parser.add_argument('--rnn_features', default='rnn_features',
+                        help="RNN feature store directory (default: %(default)s)")
+    parser.add_argument('--epochs', type=int, default=50)
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--folds', type=int, default=5, help="cross-validation folds, 0 to skip")
+    parser.add_argument('--cv_epochs', type=int, default=30)
+    parser.add_argument('--save_model', default='fusion_model.keras',
+                        help="where to save the trained fusion model (default: %(default)s)")
+    parser.add_argument('--jobs', type=int, default=None, help="parallel CV folds (default: one per fold, up to the core count)")
+    parser.add_argument('--bootstrap', type=int, default=1000,
+                        help="bootstrap replicates for test-metric confidence intervals (0 to skip)")
+    parser.add_argument('--plot_prefix', default=None,
+                        help="write <prefix>_confusion_matrix/roc_curve/pr_curve.png for the test set")
+    parser.add_argument('--threshold_objective', choices=('youden', 'fbeta', 'sensitivity', 'fixed'),
+                        default='youden', help="how to pick the decision threshold ('fixed' keeps 0.5)")
+    parser.add_argument('--beta', type=float, default=1.0, help="F-beta weight for --threshold_objective fbeta")
+    parser.add_argument('--target_sensitivity', type=float, default=0.9,
+                        help="minimum sensitivity for --threshold_objective sensitivity")
+    parser.add_argument('--tune_on', choices=('val', 'cv'), default='val',
+                        help="tune the threshold on the validation split or on the held-out predictions of CV "
+                             "folds over the train+val rows")
+    instrumentation.add_arguments(parser)
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    instrumentation.setup(args.profile, args.log_level)
+
+    X_cnn, X_rnn, y, common = load_aligned_features(args.cnn_features, args.rnn_features)
+    (Xc_train, Xr_train, y_train), (Xc_val, Xr_val, y_val), (Xc_test, Xr_test, y_test) = \
+        split_features(X_cnn, X_rnn, y)
+
+    model = build_gated_fusion_model(X_cnn.shape[1], X_rnn.shape[1])
+    model.summary()
+
+    # --- Training ---
+    with stage('keras_fit', rows=len(y_train), epochs=args.epochs, batch_size=args.batch_size):
+        history = model.fit(
+            make_dataset({'cnn_in': Xc_train, 'rnn_in': Xr_train}, y_train, batch_size=args.batch_size,
+                         shuffle=True),
+            validation_data=make_dataset({'cnn_in': Xc_val, 'rnn_in': Xr_val}, y_val, batch_size=args.batch_size),
+            epochs=args.epochs, verbose=2
+        )
+    count('keras_epochs', len(history.epoch))
+
+    cv_results = None
+    if args.tune_on == 'cv':
+        if not args.folds:
+            raise SystemExit("--tune_on cv needs --folds")
+        # Only the train+val rows, so the threshold evaluated on the test split never saw its labels
+        cv_results = cross_validate(np.concatenate([Xc_train, Xc_val]), np.concatenate([Xr_train, Xr_val]),
+                                    np.concatenate([y_train, y_val]), n_splits=args.folds, epochs=args.cv_epochs,
+                                    n_jobs=args.jobs)
+
+    # --- Decision Threshold ---
+    threshold = None
+    if args.threshold_objective != 'fixed':
+        threshold = tune_fusion_threshold(model, Xc_val, Xr_val, y_val, args.threshold_objective, args.beta,
+                                          args.target_sensitivity, cv_results)
+    evaluate_fusion_model(model, Xc_test, Xr_test, y_test, bootstrap=args.bootstrap, plot_prefix=args.plot_prefix,
+                          threshold=threshold and threshold['threshold'])
+
+    from evaluation import save_threshold, threshold_path
+
+    with stage('model_save', path=args.save_model):
+        model.save(args.save_model)
+    logger.info(f"Saved fusion model to {args.save_model}")
+    if threshold:
+        logger.info(f"Saved its decision threshold to {save_threshold(args.save_model, threshold)}")
+    elif os.path.exists(threshold_path(args.save_model)):
+        # A threshold tuned for an earlier model does not apply to this one
+        os.remove(threshold_path(args.save_model))
+    if args.folds and cv_results is None:
+        # All rows, test split included: this is only a model-selection estimate and nothing
+        # from it feeds the threshold or the test evaluation above
+        cross_validate(X_cnn, X_rnn, y, n_splits=args.folds, epochs=args.cv_epochs, n_jobs=args.jobs)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+"""Local single-patient inference server for the end-to-end fusion pipeline.
+
+Loads TumorFeatureCNN, the fitted ClinicalEncoder, the RNN feature extractor and
+the gated fusion model once at start-up and warms them, then answers
+
+    POST /predict   {"series_dir": "...", "mask_path": "..." (optional),
+                     "clinical": {"<sheet column>": value, ...}}
+                    -> {"probability": p, "recurrence": p > threshold, "latency_ms": ..., "batch_size": n}
+    GET  /stats     latency percentiles (p50/p90/p99) and batching counters
+    GET  /health
+
+over HTTP (--port) or a Unix socket (--socket). Each request's DICOM decoding and
+clinical encoding run on its own handler thread. The model work is micro-batched:
+requests arriving within --max_wait_ms of each other (up to --max_batch) share one
+CNN forward pass and one Keras call. The RNN extractor and the fusion model are
+fused into a single Keras graph for that call. Batches are padded to a power of two,
+so the graph is traced for a handful of shapes at warm-up and never during serving.
+
+The clinical row uses the same column names as Clinical_and_Other_Features.xlsx
+after header merging (see clinical_encoder.json); missing columns are imputed.
+The decision threshold is the one fusion_layer.py saved next to the fusion model
+(fusion_model.threshold.json), or 0.5 without one.
+
+Usage:
+    python inference_server.py --cnn_weights cnn_weights.pt --encoder clinical_encoder.json \\
+        --rnn_model best_model.keras --fusion_model fusion_model.keras --port 8080
+    python benchmarks/load_generator.py --url http://127.0.0.1:8080 --requests patients.jsonl --concurrency 8
+"""
+
+import os
+import sys
+import json
+import time
+import queue
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+
+import numpy as np
+import pandas as pd
+import torch
+
+import instrumentation
+from instrumentation import get_logger
+from mri_images_cnn import (TumorFeatureCNN, TumorFeatureCNN3D, load_cnn, load_dicom_series, load_nrrd_mask,
+                            load_roi_box, crop_to_box)
+from evaluation import load_threshold
+from volume_cache import VolumeCache
+
+logger = get_logger('inference_server')
+
+"""Models"""
+
+class FusionPredictor:
+    def __init__(self, encoder_path, rnn_model_path, fusion_model_path, cnn_weights=None, use_mask=False,
+                 target_size=(224, 224), max_batch=16, cache_dir=None, roi_margin=None):
+        """
+        encoder_path: clinical_encoder.json written by clinical_data_rnn.py
+        rnn_model_path: RNN checkpoint (best_model.keras), its layers[-2] is the feature layer
+        fusion_model_path: fusion_model.keras written by fusion_layer.py
+        cnn_weights: cnn_weights.pt or an --export .pt2 archive written by mri_images_cnn.py
+                     (default: its seeded initial weights)
+        target_size, roi_margin: must match the mri_images_cnn.py run (--input_size, --roi_margin)
+        """
+        # torchvision (through triton) must be imported before TensorFlow: loading it
+        # after TF's shared libraries are mapped segfaults the process
+        from torchvision.transforms import Resize, Compose
+        os.environ.setdefault('TF_CPP_MIN_LOG_LEVEL', '2')
+        import tensorflow as tf
+
+        from clinical_data_rnn import ClinicalEncoder
+
+        self.encoder = ClinicalEncoder.load(encoder_path)
+        if cnn_weights:
+            self.cnn = load_cnn(cnn_weights)
+            if isinstance(self.cnn, TumorFeatureCNN3D):
+                raise ValueError(f"{cnn_weights} is a volumetric (--volumetric) CNN, the server embeds mean slices")
+        else:
+            # Same seeded weights mri_images_cnn.main extracts with
+            torch.manual_seed(42)
+            self.cnn = TumorFeatureCNN(use_mask=use_mask, in_channels=1).eval()
+        self.transform = Compose([Resize(tuple(target_size))])
+        self.target_size = tuple(target_size)
+        self.cache = VolumeCache(cache_dir=cache_dir) if cache_dir else None
+        self.roi_margin = roi_margin
+        self.max_batch = max_batch
+
+        # One graph: clinical row -> RNN features -> fusion, next to the CNN features
+        rnn = tf.keras.models.load_model(rnn_model_path, compile=False)
+        fusion = tf.keras.models.load_model(fusion_model_path, compile=False)
+        # Without a tuned threshold, match evaluate_fusion_model's ">= 0.5" rule under the handler's strict ">"
+        self.threshold = load_threshold(fusion_model_path, default=float(np.nextafter(0.5, 0)))
+        extractor = tf.keras.Model(inputs=rnn.inputs, outputs=rnn.layers[-2].output)
+        cnn_in = tf.keras.Input(shape=fusion.inputs[0].shape[1:], name='cnn_features')
+        clinical_in = tf.keras.Input(shape=rnn.inputs[0].shape[1:], name='clinical')
+        self.head = tf.keras.Model([cnn_in, clinical_in], fusion([cnn_in, extractor(clinical_in)]))
+        self.clinical_shape = tuple(rnn.inputs[0].shape[1:])
+        self.n_clinical = self.clinical_shape[-1]
+        if len(self.encoder.columns_) != self.n_clinical:
+            raise ValueError(f"{encoder_path} encodes {len(self.encoder.columns_)} columns but "
+                             f"{rnn_model_path} expects {self.n_clinical}")
+
+    def preprocess(self, request):
+        """Decode one request into (image, mask or None, clinical vector); runs on the handler thread"""
+        box = None
+        if self.roi_margin is not None:
+            box = load_roi_box(request.get('mask_path'), self.roi_margin, cache=self.cache)
+        image = self.transform(load_dicom_series(request['series_dir'], target_size=self.target_size,
+                                                 cache=self.cache, roi=box))
+        mask = None
+        if self.cnn.use_mask and request.get('mask_path'):
+            mask = load_nrrd_mask(request['mask_path'])
+            if mask is not None:
+                mask = self.transform(mask if box is None else crop_to_box(mask, box))
+
+        # A label in the request (e.g. a row copied from the sheet) is ignored
+        row = pd.DataFrame([request.get('clinical', {})]).drop(columns=[self.encoder.target_col], errors='ignore')
+        clinical = self.encoder.transform(row).to_numpy(dtype=np.float32, na_value=0.0)[0]
+        return image, mask, np.nan_to_num(clinical, nan=0.0)
+
+    def predict_batch(self, items):
+        """Recurrence probabilities for a list of preprocessed items, one model pass each"""
+        n = len(items)
+        # Pad to a power of two so only a few batch shapes are ever traced
+        padded = 1 << (n - 1).bit_length()
+        images = torch.stack([image for image, _, _ in items])
+        masks = torch.stack([mask if mask is not None else torch.zeros_like(image) for image, mask, _ in items])
+        with torch.inference_mode():
+            cnn_features = self.cnn(images, masks).numpy()
+
+        clinical = np.stack([vector for _, _, vector in items]).reshape((n,) + self.clinical_shape)
+        if padded > n:
+            cnn_features = np.concatenate([cnn_features, np.zeros((padded - n,) + cnn_features.shape[1:], np.float32)])
+            clinical = np.concatenate([clinical, np.zeros((padded - n,) + clinical.shape[1:], np.float32)])
+        probs = np.asarray(self.head.predict_on_batch([cnn_features, clinical])).ravel()
+        return probs[:n].tolist()
+
+    def warm_up(self):
+        """Trace every padded batch shape once so the first real requests are not slow"""
+        item = (torch.zeros((1,) + self.target_size), None, np.zeros(self.n_clinical, np.float32))
+        size = 1
+        while size <= self.max_batch:
+            self.predict_batch([item] * size)
+            size *= 2
+        if size // 2 < self.max_batch:
+            self.predict_batch([item] * self.max_batch)
+
+"""Micro-batching"""
+
+class MicroBatcher:
+    def __init__(self, fn, max_batch=16, max_wait_ms=2.0):
+        """
+        fn: called with a list of items and returns one result per item
+        Items submitted within max_wait_ms of the first item of a batch share its call.
+        """
+        self.fn = fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self.queue = queue.Queue()
+        self.batch_sizes = deque(maxlen=10000)
+        self._thread = threading.Thread(target=self._loop, name="micro-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, item):
+        """Block until item's result is ready; returns (result, batch size)"""
+        future = Future()
+        self.queue.put((item, future))
+        return future.result()
+
+    def close(self):
+        self.queue.put(None)
+        self._thread.join()
+
+    def _loop(self):
+        while True:
+            first = self.queue.get()
+            if first is None:
+                return
+            batch = [first]
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.perf_counter()
+                try:
+                    entry = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if entry is None:
+                    self.queue.put(None)
+                    break
+                batch.append(entry)
+
+            self.batch_sizes.append(len(batch))
+            try:
+                results = self.fn([item for item, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result((result, len(batch)))
+
+"""Latency Report"""
+
+class LatencyStats:
+    def __init__(self, window=10000):
+        """Rolling window of the last `window` request latencies (seconds)"""
+        self.latencies = deque(maxlen=window)
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        with self.lock:
+            self.latencies.append(seconds)
+
+    def report(self, batch_sizes=()):
+        with self.lock:
+            latencies = np.asarray(self.latencies) * 1000.0
+            errors = self.errors
+        report = {'requests': int(latencies.size), 'errors': errors}
+        if latencies.size:
+            p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+            report.update(p50_ms=float(p50), p90_ms=float(p90), p99_ms=float(p99),
+                          mean_ms=float(latencies.mean()), max_ms=float(latencies.max()))
+        if len(batch_sizes):
+            report['mean_batch_size'] = float(np.mean(batch_sizes))
+        return report
+
+"""Server"""
+
+class PredictHandler(BaseHTTPRequestHandler):
+    # Set on the server: predictor, batcher, stats
+    protocol_version = "HTTP/1.1"
+
+    def address_string(self):
+        # Unix socket clients have no (host, port) address
+        return self.client_address[0] if isinstance(self.client_address, tuple) and self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status, error):
+        with self.server.stats.lock:
+            self.server.stats.errors += 1
+        self._send_json(status, {'error': f"{type(error).__name__}: {error}" if status >= 500 else str(error)})
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(200, {'status': 'ok'})
+        elif self.path == "/stats":
+            self._send_json(200, self.server.stats.report(list(self.server.batcher.batch_sizes)))
+        else:
+            self._send_json(404, {'error': f"unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/predict":
+            self._send_json(404, {'error': f"unknown path {self.path}"})
+            return
+        # Loaded by preprocess anyway, imported here so the module import stays light
+        from pydicom.errors import InvalidDicomError
+
+        start = time.perf_counter()
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            if not isinstance(request, dict):
+                raise ValueError("request body must be a JSON object")
+            if 'series_dir' not in request:
+                raise ValueError("request needs a series_dir")
+            item = self.server.predictor.preprocess(request)
+        except (ValueError, KeyError, TypeError, OSError, RuntimeError, InvalidDicomError) as e:
+            # Bad JSON, a malformed request or unreadable/non-DICOM inputs
+            self._send_error(400, e)
+            return
+        except Exception as e:
+            self._send_error(500, e)
+            return
+        try:
+            probability, batch_size = self.server.batcher.submit(item)
+        except Exception as e:
+            # Model failures (e.g. a TF OpError, set on every future of the batch) still get an answer
+            self._send_error(500, e)
+            return
+        latency = time.perf_counter() - start
+        self.server.stats.add(latency)
+        self._send_json(200, {'probability': probability,
+                              'recurrence': probability > self.server.predictor.threshold,
+                              'latency_ms': latency * 1000.0, 'batch_size': batch_size})
+
+
+class UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(predictor, host='127.0.0.1', port=8080, unix_socket=None, max_batch=16, max_wait_ms=2.0,
+                verbose=False):
+    """HTTP server (or Unix-socket server if unix_socket is given) wired to predictor"""
+    if unix_socket:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = UnixHTTPServer(unix_socket, PredictHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), PredictHandler)
+        server.daemon_threads = True
+    server.predictor = predictor
+    server.batcher = MicroBatcher(predictor.predict_batch, max_batch=max_batch, max_wait_ms=max_wait_ms)
+    server.stats = LatencyStats()
+    server.verbose = verbose
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve single-patient recurrence predictions from warm models")
+    parser.add_argument('--cnn_weights', default=None, help="cnn_weights.pt or exported .pt2 from mri_images_cnn.py "
+                                                            "(default: its seeded initial weights)")
+    parser.add_argument('--use_mask', action='store_true', help="without --cnn_weights: CNN takes the mask channel")
+    parser.add_argument('--input_size', type=int, default=224, help="CNN input size used at extraction")
+    parser.add_argument('--roi_margin', type=float, default=None, help="ROI crop margin used at extraction")
+    parser.add_argument('--encoder', default='clinical_encoder.json')
+    parser.add_argument('--rnn_model', default='best_model.keras')
+    parser.add_argument('--fusion_model', default='fusion_model.keras')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--socket', default=None, help="serve on this Unix socket instead of TCP")
+    parser.add_argument('--max_batch', type=int, default=16, help="largest micro-batch")
+    parser.add_argument('--max_wait_ms', type=float, default=2.0,
+                        help="how long the first request of a batch waits for company")
+    parser.add_argument('--threads', type=int, default=None, help="torch intra-op threads")
+    parser.add_argument('--cache_dir', default=None, help="optional VolumeCache for decoded series")
+    parser.add_argument('--verbose', action='store_true', help="log every request")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args(argv)
+    instrumentation.setup(args.profile, args.log_level)
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    start = time.perf_counter()
+    predictor = FusionPredictor(args.encoder, args.rnn_model, args.fusion_model, cnn_weights=args.cnn_weights,
+                                use_mask=args.use_mask, target_size=(args.input_size, args.input_size),
+                                max_batch=args.max_batch, cache_dir=args.cache_dir, roi_margin=args.roi_margin)
+    predictor.warm_up()
+    logger.info(f"Models loaded and warmed in {time.perf_counter() - start:.1f}s")
+
+    server = make_server(predictor, args.host, args.port, args.socket, args.max_batch, args.max_wait_ms,
+                         args.verbose)
+    logger.info(f"Serving on {args.socket or f'http://{args.host}:{args.port}'}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.batcher.close()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+        logger.info("Latency report: " + json.dumps(server.stats.report(list(server.batcher.batch_sizes)), indent=1))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
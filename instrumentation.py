@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+"""Stage timers, memory tracking, counters and leveled logging for the pipeline scripts.
+
+Profiling is off unless a script gets --profile PATH or PIPELINE_PROFILE=PATH is
+set. While it is off, stage() and count() return after a single check. While it
+is on, every stage records its wall time, its thread and the process's resident
+memory: current RSS at entry and exit, and the peak so far at exit. Counters
+(DICOM slices and bytes decoded, CNN images, ...) accumulate alongside.
+
+At exit the run is written to PATH as a Chrome trace, which opens in
+chrome://tracing or ui.perfetto.dev. Each stage is an "X" event, and RSS and the
+counters are "C" tracks. The "otherData" object holds a per-stage summary
+(calls, total/mean/max seconds, peak RSS) and the final counter values, so the
+same file is also the JSON report.
+
+Worker processes (tensor_store ingest, CV folds, DataLoader workers) inherit
+PIPELINE_PROFILE. Each worker appends its new events to PATH.<pid> whenever an
+outermost stage ends. The parent folds those files into its trace at exit.
+
+setup() also configures logging for the scripts' "pipeline.*" loggers. The level
+comes from --log_level or PIPELINE_LOG_LEVEL, INFO by default. INFO messages
+print as bare lines, like the old print output. DEBUG adds the per-step detail,
+and WARNING keeps only problems.
+
+Usage:
+    python fusion_layer.py --profile fusion_trace.json --log_level DEBUG
+    PIPELINE_PROFILE=cnn_trace.json python mri_images_cnn.py --images_dir ...
+
+    from instrumentation import stage, count
+    with stage('dicom_decode', series=series_dir):
+        ...
+        count('dicom_slices', len(files))
+"""
+
+import os
+import re
+import sys
+import glob
+import json
+import time
+import atexit
+import logging
+import functools
+import threading
+import contextlib
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+PROFILE_ENV = 'PIPELINE_PROFILE'
+# pid of the process that owns the trace, every other process writing to it is a worker
+_OWNER_ENV = 'PIPELINE_PROFILE_OWNER'
+LOG_LEVEL_ENV = 'PIPELINE_LOG_LEVEL'
+LOG_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR')
+
+_MB = 1024 * 1024
+# ru_maxrss is in KiB on Linux and in bytes on macOS
+_MAXRSS_BYTES = 1 if sys.platform == 'darwin' else 1024
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+logger = logging.getLogger('pipeline.instrumentation')
+
+
+def get_logger(name):
+    """Logger of a pipeline module, configured by setup() ("pipeline.<name>")"""
+    return logging.getLogger(f'pipeline.{name}')
+
+
+def peak_rss():
+    """Peak resident set size of this process so far, in bytes (0 where unknown)"""
+    if resource is None:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * _MAXRSS_BYTES
+
+
+def current_rss():
+    """Resident set size of this process in bytes (the peak where /proc is unavailable)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return peak_rss()
+
+
+def _now_us():
+    # perf_counter is CLOCK_MONOTONIC on Linux, shared by the parent and its workers
+    return time.perf_counter_ns() / 1000
+
+
+class Profiler:
+    """Stage events and counters of one process, see stage() and count()"""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.events = []
+        self.flushed = 0
+        self.counters = {}
+        self.local = threading.local()
+        self.pid = os.getpid()
+
+    @property
+    def is_worker(self):
+        # multiprocessing.parent_process() is still None while a spawned worker imports its modules
+        return os.environ.get(_OWNER_ENV, str(os.getpid())) != str(os.getpid())
+
+    def add(self, name, value):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def record(self, name, args, start, end, rss_start, error):
+        rss, peak = current_rss(), peak_rss()
+        args = dict(args, rss_start_mb=rss_start / _MB, rss_end_mb=rss / _MB, peak_rss_mb=peak / _MB)
+        if error is not None:
+            args['error'] = error.__name__
+        with self.lock:
+            self.events.append({'name': name, 'ph': 'X', 'ts': start, 'dur': end - start, 'pid': self.pid,
+                                'tid': threading.get_native_id(), 'args': args})
+            self.events.append({'name': 'memory', 'ph': 'C', 'ts': end, 'pid': self.pid,
+                                'args': {'rss_mb': rss / _MB, 'peak_rss_mb': peak / _MB}})
+            if self.counters:
+                self.events.append({'name': 'counters', 'ph': 'C', 'ts': end, 'pid': self.pid,
+                                    'args': dict(self.counters)})
+
+    def flush_worker(self):
+        """Append this worker's new events and its counters to PATH.<pid> for the parent to merge"""
+        with self.lock:
+            state = {'events': self.events[self.flushed:], 'counters': dict(self.counters)}
+            self.flushed = len(self.events)
+        with open(f"{self.path}.{self.pid}", 'a') as f:
+            f.write(json.dumps(state, default=str) + '\n')
+
+    def write(self, path=None):
+        """Write the Chrome trace (with worker files merged in); returns its summary"""
+        path = path or self.path
+        with self.lock:
+            events, counters = list(self.events), dict(self.counters)
+        pids = {self.pid: os.path.basename(sys.argv[0]) or 'python'}
+        for worker_path in _worker_files(path):
+            worker_counters = {}
+            with open(worker_path) as f:
+                for line in f:
+                    try:
+                        state = json.loads(line)
+                    except ValueError:
+                        # A worker killed mid-write leaves a partial last line
+                        continue
+                    events.extend(state['events'])
+                    pids.update({event['pid']: 'worker' for event in state['events'][:1]})
+                    # Counters are cumulative, the last line has the worker's totals
+                    worker_counters = state['counters']
+            for name, value in worker_counters.items():
+                counters[name] = counters.get(name, 0) + value
+            os.remove(worker_path)
+
+        summary = {
+            'argv': sys.argv,
+            'pid': self.pid,
+            'peak_rss_mb': peak_rss() / _MB,
+            'stages': summarize(events),
+            'counters': counters,
+        }
+        metadata = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': name}}
+                    for pid, name in pids.items()]
+        _write_json(path, {'traceEvents': metadata + sorted(events, key=lambda e: e['ts']),
+                           'displayTimeUnit': 'ms', 'otherData': summary})
+        return summary
+
+
+class _Stage:
+    __slots__ = ('profiler', 'name', 'args', 'start', 'rss')
+
+    def __init__(self, profiler, name, args):
+        self.profiler, self.name, self.args = profiler, name, args
+
+    def __enter__(self):
+        local = self.profiler.local
+        local.depth = getattr(local, 'depth', 0) + 1
+        self.rss = current_rss()
+        self.start = _now_us()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        profiler = self.profiler
+        profiler.record(self.name, self.args, self.start, _now_us(), self.rss, exc_type)
+        profiler.local.depth -= 1
+        if profiler.local.depth == 0 and profiler.is_worker:
+            profiler.flush_worker()
+        return False
+
+
+_profiler = Profiler(os.environ.get(PROFILE_ENV) or None)
+_NO_STAGE = contextlib.nullcontext()
+_exit_hook = []
+
+if hasattr(os, 'register_at_fork'):
+    # Forked workers (DataLoader) start with an empty trace of their own
+    os.register_at_fork(after_in_child=_profiler.reset)
+
+
+def is_enabled():
+    return _profiler.path is not None
+
+
+def stage(name, **args):
+    """Context manager timing a named pipeline stage; args (JSON-serializable) are kept in the trace"""
+    if _profiler.path is None:
+        return _NO_STAGE
+    return _Stage(_profiler, name, args)
+
+
+def profiled(name=None):
+    """Decorator running each call of the function as a stage (named after it by default)"""
+    def decorate(fn):
+        label = name or fn.__name__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _profiler.path is None:
+                return fn(*args, **kwargs)
+            with _Stage(_profiler, label, {}):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def count(name, value=1):
+    """Add value to the named counter (no-op unless profiling)"""
+    if _profiler.path is not None:
+        _profiler.add(name, value)
+
+
+def summarize(events):
+    """Per-stage calls, total/mean/max seconds and peak RSS of trace events, slowest total first"""
+    stages = {}
+    for event in events:
+        if event['ph'] != 'X':
+            continue
+        s = stages.setdefault(event['name'], {'calls': 0, 'total_s': 0.0, 'max_s': 0.0, 'peak_rss_mb': 0.0})
+        seconds = event['dur'] / 1e6
+        s['calls'] += 1
+        s['total_s'] += seconds
+        s['max_s'] = max(s['max_s'], seconds)
+        s['peak_rss_mb'] = max(s['peak_rss_mb'], event['args'].get('peak_rss_mb', 0.0))
+    for s in stages.values():
+        s['mean_s'] = s['total_s'] / s['calls']
+    return dict(sorted(stages.items(), key=lambda item: -item[1]['total_s']))
+
+
+def format_summary(summary, limit=15):
+    """Text table of a write()/summarize() summary"""
+    lines = [f"{'stage':<28} {'calls':>6} {'total s':>9} {'mean s':>9} {'max s':>9} {'peak MB':>8}"]
+    for name, s in list(summary['stages'].items())[:limit]:
+        lines.append(f"{name:<28} {s['calls']:>6} {s['total_s']:>9.3f} {s['mean_s']:>9.4f} {s['max_s']:>9.3f} "
+                     f"{s['peak_rss_mb']:>8.0f}")
+    lines.extend(f"{name:<28} {value:>16,}" for name, value in sorted(summary['counters'].items()))
+    lines.append(f"peak RSS {summary['peak_rss_mb']:.0f} MB")
+    return "\n".join(lines)
+
+
+def enable(path):
+    """Start profiling this process (and the workers it starts from now on) into path"""
+    path = os.path.abspath(path)
+    _profiler.path = path
+    # Spawned workers pick the path up from the environment
+    os.environ[PROFILE_ENV] = path
+    if not _profiler.is_worker:
+        os.environ[_OWNER_ENV] = str(os.getpid())
+        for stale in _worker_files(path):
+            os.remove(stale)
+        if not _exit_hook:
+            _exit_hook.append(atexit.register(_write_at_exit))
+
+
+def write_profile(path=None):
+    """Write the trace now (profiling must be enabled); returns its summary"""
+    return _profiler.write(path)
+
+
+def _write_at_exit():
+    if _profiler.path is None or _profiler.is_worker:
+        return
+    summary = _profiler.write()
+    logger.info(f"Profile written to {_profiler.path}")
+    logger.info(format_summary(summary))
+
+
+def _worker_files(path):
+    pattern = re.compile(re.escape(path) + r'\.\d+$')
+    return [p for p in glob.glob(glob.escape(path) + '.*') if pattern.match(p)]
+
+
+def _write_json(path, payload):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(payload, f, default=str)
+    os.replace(tmp_path, path)
+
+
+class _LevelFormatter(logging.Formatter):
+    """INFO messages as bare lines (as the scripts used to print them), other levels prefixed"""
+
+    def format(self, record):
+        message = super().format(record)
+        return message if record.levelno == logging.INFO else f"{record.levelname}: {message}"
+
+
+def setup_logging(level=None):
+    """Send the pipeline.* loggers to stdout at level (default: PIPELINE_LOG_LEVEL or INFO)"""
+    level = (level or os.environ.get(LOG_LEVEL_ENV) or 'INFO').upper()
+    root = logging.getLogger('pipeline')
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(_LevelFormatter('%(message)s'))
+    root.addHandler(handler)
+    root.setLevel(level)
+    # Leave third-party loggers alone
+    root.propagate = False
+
+
+def add_arguments(parser):
+    """Add --profile and --log_level to a script's argument parser"""
+    parser.add_argument('--profile', default=None, metavar='PATH',
+                        help=f"write a Chrome-trace/JSON profile of the run to PATH (or set {PROFILE_ENV})")
+    parser.add_argument('--log_level', choices=LOG_LEVELS, default=None,
+                        help=f"console log level (default: ${LOG_LEVEL_ENV} or INFO)")
+    return parser
+
+
+def setup(profile=None, log_level=None):
+    """Configure logging and, given a path here or in PIPELINE_PROFILE, profiling; call once from main"""
+    setup_logging(log_level)
+    path = profile or os.environ.get(PROFILE_ENV)
+    if path:
+        enable(path)
+
+
+if _profiler.path is not None and not _profiler.is_worker:
+    # PIPELINE_PROFILE set in the shell: this process owns the trace
+    enable(_profiler.path)
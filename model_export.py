@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""Export the trained Keras models to TFLite for low-latency CPU inference.
+
+model.predict builds a data adapter and steps a tf.function per call, which costs
+tens of milliseconds before any math happens. That dominates the single-patient
+batches scored online. export_tflite freezes a trained model (best_model.keras
+from clinical_data_rnn.py, fusion_model.keras from fusion_layer.py) into a
+.tflite flatbuffer. A TFLite interpreter runs it in well under a millisecond.
+
+Quantization (--quantize):
+    none     float32 weights and math, matches Keras to float rounding
+    float16  float16 weights (half the size), float32 math
+    int8     int8 weights with dynamic-range quantized kernels (about a quarter of the size)
+
+The batch dimension (and, for visit-sequence models, the time dimension) is
+frozen at export, because the TFLite LSTM lowering needs static shapes.
+TFLiteModel.predict splits larger inputs into chunks of that batch size and pads
+the last chunk. --with_features adds the RNN's penultimate layer as a second
+'features' output. This is the 32-d vector extract_rnn_features hands to the
+fusion model.
+
+After writing the file, the CLI checks parity (check_parity) on --parity_rows
+seeded standard-normal rows. The clinical features are standardized, and the
+fusion inputs are unit-scale activations, so these rows cover the working range.
+The CLI exits with status 1 if any output differs from Keras by more than
+--atol (default depends on --quantize).
+
+Usage:
+    python model_export.py --model best_model.keras --output best_model.tflite --with_features
+    python model_export.py --model fusion_model.keras --output fusion_model.int8.tflite --quantize int8
+    python benchmarks/bench_export_latency.py --rnn_model best_model.keras --fusion_model fusion_model.keras
+"""
+
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import warnings
+
+import numpy as np
+
+import instrumentation
+from instrumentation import get_logger
+
+logger = get_logger('model_export')
+
+QUANTIZATION_MODES = ('none', 'float16', 'int8')
+
+# Parity tolerance (max absolute difference) per quantization mode
+DEFAULT_ATOL = {'none': 1e-5, 'float16': 1e-2, 'int8': 5e-2}
+
+
+def _export_signature(model, batch_size, timesteps):
+    """Static TensorSpecs for the model inputs, named after the Keras inputs"""
+    import tensorflow as tf
+
+    specs = []
+    for tensor in model.inputs:
+        shape = list(tensor.shape[1:])
+        if None in shape:
+            if len(shape) != 2 or shape[0] is not None or timesteps is None:
+                raise ValueError(f"Input {tensor.name} has shape {tuple(tensor.shape)}; "
+                                 f"give timesteps to freeze its time dimension")
+            shape[0] = timesteps
+        specs.append(tf.TensorSpec([batch_size] + shape, tf.float32, name=tensor.name.split(':')[0]))
+    return specs
+
+
+def export_tflite(model, path, quantize='none', batch_size=1, timesteps=None, with_features=False):
+    """
+    Convert a Keras model into a TFLite flatbuffer
+
+    Parameters:
+    -----------
+    model : tf.keras.Model or str
+        Trained model, or the path of a saved .keras model
+    path : str
+        Output .tflite path (written atomically)
+    quantize : str, default='none'
+        One of QUANTIZATION_MODES
+    batch_size : int, default=1
+        Static batch dimension of the exported graph
+    timesteps : int, optional
+        Static time dimension for models with variable-length sequence input
+    with_features : bool, default=False
+        Also output layers[-2] (the RNN feature layer) as 'features'
+
+    Returns:
+    --------
+    int
+        Size of the written file in bytes
+    """
+    if quantize not in QUANTIZATION_MODES:
+        raise ValueError(f"quantize must be one of {QUANTIZATION_MODES}, got {quantize!r}")
+    os.environ.setdefault('TF_CPP_MIN_LOG_LEVEL', '2')
+    import tensorflow as tf
+
+    if isinstance(model, str):
+        model = tf.keras.models.load_model(model, compile=False)
+    outputs = {'probability': model.outputs[0]}
+    if with_features:
+        outputs['features'] = model.layers[-2].output
+    wrapped = tf.keras.Model(model.inputs, outputs)
+
+    specs = _export_signature(model, batch_size, timesteps)
+    saved_dir = tempfile.mkdtemp(prefix="tflite_export_")
+    try:
+        # Going through a SavedModel freezes the variables; converting the Keras
+        # model's concrete function directly leaves READ_VARIABLE ops in the LSTM loop
+        wrapped.export(saved_dir, input_signature=[specs] if len(specs) > 1 else specs, verbose=False)
+        converter = tf.lite.TFLiteConverter.from_saved_model(saved_dir)
+        if quantize != 'none':
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        if quantize == 'float16':
+            converter.target_spec.supported_types = [tf.float16]
+        flatbuffer = converter.convert()
+    finally:
+        shutil.rmtree(saved_dir, ignore_errors=True)
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(flatbuffer)
+    os.replace(tmp_path, path)
+    return len(flatbuffer)
+
+
+class TFLiteModel:
+    """
+    Single-signature TFLite model with a Keras-like predict
+
+    Uses the LiteRT interpreter (ai_edge_litert) when it is installed and falls back
+    to tf.lite.Interpreter otherwise.
+    """
+
+    def __init__(self, path, num_threads=None):
+        try:
+            from ai_edge_litert.interpreter import Interpreter
+        except ImportError:
+            os.environ.setdefault('TF_CPP_MIN_LOG_LEVEL', '2')
+            import tensorflow as tf
+            Interpreter = tf.lite.Interpreter
+
+        with warnings.catch_warnings():
+            # tf.lite.Interpreter warns about its move to ai_edge_litert on every construction
+            warnings.simplefilter("ignore")
+            self.interpreter = Interpreter(model_path=path, num_threads=num_threads)
+        self.runner = self.interpreter.get_signature_runner()
+        inputs = self.runner.get_input_details()
+        self.input_names = list(inputs)
+        self.input_shapes = {name: tuple(details['shape']) for name, details in inputs.items()}
+        self.output_names = sorted(self.runner.get_output_details())
+        self.batch_size = self.input_shapes[self.input_names[0]][0]
+
+    def __call__(self, *xs):
+        """Run one static-size batch; returns {output name: array}"""
+        return self.runner(**{name: np.asarray(x, dtype=np.float32) for name, x in zip(self.input_names, xs)})
+
+    def predict(self, x, output='probability'):
+        """
+        Outputs for any number of rows
+
+        x is an array for single-input models and a list (in input order) or dict
+        (by input name) for multi-input ones, like Keras' predict. Rows are run in
+        chunks of the exported batch size, and the last chunk is zero-padded.
+        """
+        if isinstance(x, dict):
+            xs = [np.asarray(x[name], dtype=np.float32) for name in self.input_names]
+        elif isinstance(x, (list, tuple)):
+            xs = [np.asarray(a, dtype=np.float32) for a in x]
+        else:
+            xs = [np.asarray(x, dtype=np.float32)]
+        n = len(xs[0])
+        results = []
+        for start in range(0, n, self.batch_size):
+            chunk = [a[start:start + self.batch_size] for a in xs]
+            short = self.batch_size - len(chunk[0])
+            if short:
+                chunk = [np.concatenate([a, np.zeros((short,) + a.shape[1:], np.float32)]) for a in chunk]
+            results.append(self(*chunk)[output][:self.batch_size - short])
+        return np.concatenate(results)
+
+
+def check_parity(keras_model, tflite_path, n_rows=256, seed=0):
+    """
+    Max absolute difference between Keras and TFLite outputs on seeded N(0, 1) rows
+
+    Returns:
+    --------
+    dict
+        {output name: max abs difference}
+    """
+    import tensorflow as tf
+
+    if isinstance(keras_model, str):
+        keras_model = tf.keras.models.load_model(keras_model, compile=False)
+    lite = TFLiteModel(tflite_path)
+    rng = np.random.default_rng(seed)
+    xs = [rng.standard_normal((n_rows,) + lite.input_shapes[name][1:]).astype(np.float32)
+          for name in lite.input_names]
+
+    expected = {'probability': keras_model.predict(xs if len(xs) > 1 else xs[0], verbose=0)}
+    if 'features' in lite.output_names:
+        extractor = tf.keras.Model(inputs=keras_model.inputs, outputs=keras_model.layers[-2].output)
+        expected['features'] = extractor.predict(xs if len(xs) > 1 else xs[0], verbose=0)
+    return {name: float(np.max(np.abs(lite.predict(xs, output=name) - np.asarray(expected[name]))))
+            for name in lite.output_names}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export a trained Keras model to TFLite and check parity")
+    parser.add_argument('--model', required=True, help="trained .keras model (best_model.keras, fusion_model.keras)")
+    parser.add_argument('--output', default=None, help="output .tflite path (default: next to --model)")
+    parser.add_argument('--quantize', choices=QUANTIZATION_MODES, default='none')
+    parser.add_argument('--batch_size', type=int, default=1, help="static batch size of the exported graph")
+    parser.add_argument('--timesteps', type=int, default=None,
+                        help="static sequence length for variable-length (visit) models")
+    parser.add_argument('--with_features', action='store_true',
+                        help="also export the RNN feature layer (layers[-2]) as a 'features' output")
+    parser.add_argument('--parity_rows', type=int, default=256, help="rows for the parity check, 0 to skip")
+    parser.add_argument('--atol', type=float, default=None, help="parity tolerance (default depends on --quantize)")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args(argv)
+    instrumentation.setup(args.profile, args.log_level)
+
+    output = args.output or f"{os.path.splitext(args.model)[0]}.{args.quantize}.tflite"
+    os.environ.setdefault('TF_CPP_MIN_LOG_LEVEL', '2')
+    import tensorflow as tf
+
+    model = tf.keras.models.load_model(args.model, compile=False)
+    size = export_tflite(model, output, quantize=args.quantize, batch_size=args.batch_size,
+                         timesteps=args.timesteps, with_features=args.with_features)
+    keras_size = os.path.getsize(args.model)
+    logger.info(f"Wrote {output} ({size / 1024:.0f} KiB, {args.model} is {keras_size / 1024:.0f} KiB)")
+
+    if not args.parity_rows:
+        return 0
+    atol = args.atol if args.atol is not None else DEFAULT_ATOL[args.quantize]
+    diffs = check_parity(model, output, n_rows=args.parity_rows)
+    ok = all(diff <= atol for diff in diffs.values())
+    for name, diff in diffs.items():
+        log = logger.info if diff <= atol else logger.warning
+        log(f"parity {name}: max |keras - tflite| = {diff:.2e} ({'ok' if diff <= atol else 'FAIL'}, atol {atol:g})")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
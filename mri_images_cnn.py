@@ -11,38 +11,106 @@ Importing Relevant Libraries
 
 import sys
 import os
+import time
+import json
+import hashlib
+import zipfile
+import argparse
 
-import pydicom
 import pandas as pd
-import SimpleITK as sitk
 import numpy as np
 import torch
-from torch.utils.data import Dataset
-from torchvision import transforms
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.data import Dataset, DataLoader
+
+# pydicom, SimpleITK and torchvision are imported where they are used so that importing
+# this module (e.g. from tensor_store.py) and --help don't pay for them
+
+import instrumentation
+from instrumentation import get_logger, stage, count
+from volume_cache import VolumeCache, fingerprint_files
+from feature_shards import FeatureShardStore
+
+logger = get_logger('mri_images_cnn')
 
 """Helper functions for Loading Series
 TODO: EXPAND TO FULL SET
 """
 
+# Function to list the slices of a DICOM series in load order
+def list_dicom_files(series_dir):
+    return [os.path.join(series_dir, file) for file in sorted(os.listdir(series_dir)) if file.endswith('.dcm')]
+
+# DICOM elements needed to decode PixelData, everything else in the header is skipped when pixels_only=True
+PIXEL_TAGS = [
+    'SamplesPerPixel', 'PhotometricInterpretation', 'PlanarConfiguration', 'NumberOfFrames',
+    'Rows', 'Columns', 'BitsAllocated', 'BitsStored', 'HighBit', 'PixelRepresentation', 'PixelData',
+]
+
+def read_dicom_slice(file, pixels_only=False):
+    """Read a single DICOM file and return its pixels as float32 (H, W)"""
+    import pydicom
+
+    dcm = pydicom.dcmread(file, specific_tags=PIXEL_TAGS if pixels_only else None)
+    pixels = dcm.pixel_array
+    count('dicom_slices')
+    count('dicom_bytes_decoded', pixels.nbytes)
+    return pixels.astype(np.float32)
+
+# Function to collapse Z of a DICOM series into its mean slice
+def mean_dicom_slices(files, streaming=True, pixels_only=False):
+    """Return the mean over Z of the slices in files as float32 (H, W)"""
+    """    #streaming=True keeps one running-sum accumulator, so peak memory is about two slices regardless of Z depth.
+    #Slices are added in the same order np.mean(np.stack(...), axis=0) reduces them, so the result is identical.
+"""
+    if not streaming:
+        volume = np.stack([read_dicom_slice(file, pixels_only) for file in files], axis=0)
+        return np.mean(volume, axis=0)
+
+    if not files:
+        raise ValueError("need at least one DICOM slice to load a series")
+    total = None
+    for file in files:
+        pixels = read_dicom_slice(file, pixels_only)
+        if total is None:
+            total = pixels
+        elif pixels.shape != total.shape:
+            raise ValueError(f"slice {file} has shape {pixels.shape}, expected {total.shape}")
+        else:
+            np.add(total, pixels, out=total)
+    return np.divide(total, np.float32(len(files)), out=total)
+
 # Function to load DICOM series
-def load_dicom_series(series_dir, target_size=(224, 224)):
+# cache is an optional VolumeCache, hits are keyed on the slice files (names, sizes, mtimes) and target_size and skip pydicom entirely
+# roi is an optional (top, left, bottom, right) box from load_roi_box, the slice is cropped to it before normalizing and resizing
+def load_dicom_series(series_dir, target_size=(224, 224), cache=None, streaming=True, pixels_only=False, roi=None):
     """Load and normalize a DICOM series, return (1, H, W)"""
     """    #This is within the single folder-- this is within a single series (ex. 01-01-1990-NA-MRI BREAST BILATERAL WWO-97538\26.000000-ax t1 tse c-58582)
 """
-    slices = []
-    for file in sorted(os.listdir(series_dir)):
-        if file.endswith('.dcm'):
-            dcm = pydicom.dcmread(os.path.join(series_dir, file))
-            slices.append(dcm.pixel_array.astype(np.float32))
-    volume = np.stack(slices, axis=0)
-
-    # Collapse Z
-    image = np.mean(volume, axis=0)
-    image = (image - np.min(image)) / (np.max(image) - np.min(image) + 1e-5)
-
-    image = torch.tensor(image).unsqueeze(0)  # (1, H, W)
-    image = torch.nn.functional.interpolate(image.unsqueeze(0), size=target_size, mode='bilinear', align_corners=False)
-    return image.squeeze(0)  # (1, H, W)
+    files = list_dicom_files(series_dir)
+    if cache is not None:
+        params = (tuple(target_size),) if roi is None else (tuple(target_size), tuple(roi))
+        key = fingerprint_files(files, *params)
+        cached = cache.get(key)
+        if cached is not None:
+            count('volume_cache_hits')
+            return torch.tensor(cached)  # copy, cache entries are read-only
+
+    with stage('dicom_decode', slices=len(files)):
+        # Collapse Z
+        image = mean_dicom_slices(files, streaming=streaming, pixels_only=pixels_only)
+        if roi is not None:
+            image = crop_to_box(image, roi)
+        image = (image - np.min(image)) / (np.max(image) - np.min(image) + 1e-5)
+
+        image = torch.tensor(image).unsqueeze(0)  # (1, H, W)
+        image = torch.nn.functional.interpolate(image.unsqueeze(0), size=target_size, mode='bilinear',
+                                                align_corners=False)
+        image = image.squeeze(0)  # (1, H, W)
+    if cache is not None:
+        cache.put(key, image.numpy())
+    return image
 
 # Function to load DICOM series seg
 def load_nrrd_mask(nrrd_path):
@@ -50,8 +118,13 @@ def load_nrrd_mask(nrrd_path):
     """Load NRRD segmentation mask and return binary mask tensor (1, H, W)"""
     if not os.path.exists(nrrd_path):
         return None
-    image = sitk.ReadImage(nrrd_path)
-    array = sitk.GetArrayFromImage(image)  # shape: (Z, H, W)
+    import SimpleITK as sitk
+
+    with stage('nrrd_read'):
+        image = sitk.ReadImage(nrrd_path)
+        array = sitk.GetArrayFromImage(image)  # shape: (Z, H, W)
+    count('nrrd_masks')
+    count('nrrd_bytes_decoded', array.nbytes)
     mask = (array > 0).astype(np.float32)
     if mask.shape[0] > 1:
         mask = np.mean(mask, axis=0)
@@ -59,41 +132,175 @@ def load_nrrd_mask(nrrd_path):
         mask = mask[0]
     return torch.tensor(mask).unsqueeze(0)  # shape: (1, H, W)
 
-#Sanity check for dicom paths being real
-test_dicom_path = r"D:\brc\image\manifest-1654812109500\Duke-Breast-Cancer-MRI\Breast_MRI_001\01-01-1990-NA-MRI BREAST BILATERAL WWO-97538\26.000000-ax t1 tse c-58582"
-print(os.path.exists(test_dicom_path))
-testSeriesLoadStack = load_dicom_series(test_dicom_path)
-print(testSeriesLoadStack)
+"""Region of Interest Cropping"""
 
-#Sanity check for seg data
-test_dicom_seg_path = r"D:\brc\seg\3dtest\PKG - Duke-Breast-Cancer-MRI-Supplement-v3\Duke-Breast-Cancer-MRI-Supplement-v3\Segmentation_Masks_NRRD\Breast_MRI_002\Segmentation_Breast_MRI_002_Breast.seg.nrrd"
-print(os.path.exists(test_dicom_seg_path))
-testDicomLoadSeries = load_nrrd_mask(test_dicom_seg_path)
-print(testDicomLoadSeries)
+def mask_bounding_box(mask, margin=0.1):
+    """
+    Bounding box of the nonzero pixels of a (1, H, W) or (H, W) mask, or None if the mask is empty
+
+    The box is (top, left, bottom, right) as fractions of the image height/width, so it applies to the
+    DICOM slice whatever its resolution. Each side is grown by margin times the box size and clipped.
+    """
+    mask = np.asarray(mask).reshape(np.shape(mask)[-2:])
+    rows, cols = np.any(mask > 0, axis=1), np.any(mask > 0, axis=0)
+    if not rows.any():
+        return None
+    height, width = mask.shape
+    top, bottom = np.argmax(rows), height - np.argmax(rows[::-1])
+    left, right = np.argmax(cols), width - np.argmax(cols[::-1])
+    pad_y, pad_x = margin * (bottom - top), margin * (right - left)
+    # Plain floats: the box is part of cache keys (via repr) and must read back identically
+    return (float(max(0.0, (top - pad_y) / height)), float(max(0.0, (left - pad_x) / width)),
+            float(min(1.0, (bottom + pad_y) / height)), float(min(1.0, (right + pad_x) / width)))
+
+def crop_to_box(array, box):
+    """Crop the last two axes of an array or tensor to a fractional (top, left, bottom, right) box"""
+    height, width = array.shape[-2:]
+    top, left = int(np.floor(box[0] * height)), int(np.floor(box[1] * width))
+    bottom = max(top + 1, int(np.ceil(box[2] * height)))
+    right = max(left + 1, int(np.ceil(box[3] * width)))
+    return array[..., top:bottom, left:right]
+
+def load_roi_box(mask_path, margin=0.1, cache=None):
+    """
+    mask_bounding_box of the NRRD mask at mask_path, or None without a (non-empty) mask
+
+    cache is an optional VolumeCache; the box is keyed on the mask file and margin, so each patient's
+    mask is read once per margin rather than on every epoch.
+    """
+    if mask_path is None or not os.path.exists(mask_path):
+        return None
+    if cache is not None:
+        key = fingerprint_files([mask_path], 'roi', margin)
+        cached = cache.get(key)
+        if cached is not None:
+            # Empty masks are cached as NaNs
+            return None if np.isnan(cached).any() else tuple(float(v) for v in cached)
+
+    box = mask_bounding_box(load_nrrd_mask(mask_path), margin)
+    if cache is not None:
+        cache.put(key, np.asarray(box if box is not None else [np.nan] * 4, dtype=np.float64))
+    return box
+
+"""Volumetric Loading"""
+
+def load_dicom_volume(series_dir, target_size=(224, 224), cache=None, pixels_only=False, roi=None):
+    """Load a DICOM series without collapsing Z, return (1, Z, H, W) normalized to [0, 1]"""
+    """    #Slices are read and resized one at a time, so the full-resolution stack is never in memory at once
+    #(about 0.2 MB per slice at 224x224 instead of 1 MB at 512x512). cache and roi work as in load_dicom_series.
+"""
+    files = list_dicom_files(series_dir)
+    if not files:
+        raise ValueError("need at least one DICOM slice to load a series")
+    if cache is not None:
+        key = fingerprint_files(files, 'volume', tuple(target_size), None if roi is None else tuple(roi))
+        cached = cache.get(key)
+        if cached is not None:
+            count('volume_cache_hits')
+            return torch.tensor(cached)
+
+    with stage('dicom_volume_decode', slices=len(files)):
+        volume = np.empty((len(files),) + tuple(target_size), dtype=np.float32)
+        for z, file in enumerate(files):
+            pixels = read_dicom_slice(file, pixels_only)
+            if roi is not None:
+                pixels = crop_to_box(pixels, roi)
+            volume[z] = F.interpolate(torch.from_numpy(pixels)[None, None], size=tuple(target_size),
+                                      mode='bilinear', align_corners=False)[0, 0].numpy()
+        volume -= volume.min()
+        volume /= volume.max() + 1e-5
+    if cache is not None:
+        cache.put(key, volume[None])
+    return torch.from_numpy(volume).unsqueeze(0)
+
+def load_nrrd_volume(nrrd_path, depth, target_size=(224, 224), roi=None):
+    """Load an NRRD mask as a (1, depth, H, W) volume resampled to match load_dicom_volume, or None if missing"""
+    if nrrd_path is None or not os.path.exists(nrrd_path):
+        return None
+    import SimpleITK as sitk
+
+    with stage('nrrd_read'):
+        array = sitk.GetArrayFromImage(sitk.ReadImage(nrrd_path))  # (Z, H, W)
+    count('nrrd_masks')
+    count('nrrd_bytes_decoded', array.nbytes)
+    if roi is not None:
+        array = crop_to_box(array, roi)
+
+    def resized(z):
+        # One source slice, binarized and resized in-plane, never the full-resolution stack in float32
+        pixels = torch.from_numpy((array[z] > 0).astype(np.float32))
+        return F.interpolate(pixels[None, None], size=tuple(target_size), mode='bilinear',
+                             align_corners=False)[0, 0]
+
+    # Trilinear resampling, done as bilinear per slice then linear along Z (it is separable), so the
+    # mask is built one output slice at a time. It also lines up masks whose slice count differs from
+    # the series. Z coordinates follow F.interpolate(align_corners=False).
+    mask = torch.empty((1, depth) + tuple(target_size))
+    scale = array.shape[0] / depth
+    slices = {}
+    for z in range(depth):
+        source = max(scale * (z + 0.5) - 0.5, 0.0)
+        lower = int(source)
+        upper = min(lower + 1, array.shape[0] - 1)
+        weight = source - lower
+        for index in list(slices):
+            if index < lower:
+                del slices[index]
+        for index in (lower, upper):
+            if index not in slices:
+                slices[index] = resized(index)
+        mask[0, z] = slices[lower] * (1 - weight) + slices[upper] * weight
+    return mask
+
+def slab_starts(depth, slab_depth=16, overlap=4):
+    """Start indices of equal-depth Z-slabs covering depth slices, consecutive slabs sharing overlap slices"""
+    if not 0 <= overlap < slab_depth:
+        raise ValueError(f"overlap must be in [0, slab_depth), got {overlap} for slab_depth {slab_depth}")
+    if depth <= slab_depth:
+        return [0]
+    starts = list(range(0, depth - slab_depth + 1, slab_depth - overlap))
+    # The last slab is shifted back rather than padded, so every slab has the same shape
+    if starts[-1] + slab_depth < depth:
+        starts.append(depth - slab_depth)
+    return starts
 
 """Test Dataset Class"""
 
 class BreastMRIDataset(Dataset):
-    def __init__(self, series_dirs, mask_paths, labels, transform=None, use_mask=True):
+    def __init__(self, series_dirs, mask_paths, labels, transform=None, use_mask=True, cache=None,
+                 roi_margin=None, target_size=(224, 224)):
         """
         series_dirs: list of directories with DICOM series
         mask_paths: list of NRRD mask file paths (can be None)
         labels: list of outcome labels
+        cache: optional VolumeCache so decoded series (and ROI boxes) are reused across epochs
+        roi_margin: if set, crop image and mask to the mask's bounding box grown by this fraction
+                    (patients without a mask keep the full slice)
+        target_size: size load_dicom_series resizes to
         """
         self.series_dirs = series_dirs
         self.mask_paths = mask_paths
         self.labels = labels
         self.transform = transform
         self.use_mask = use_mask
+        self.cache = cache
+        self.roi_margin = roi_margin
+        self.target_size = tuple(target_size)
 
     def __len__(self):
         return len(self.series_dirs)
 
     def __getitem__(self, idx):
-        image = load_dicom_series(self.series_dirs[idx])  # (1, H, W)
+        box = None
+        if self.roi_margin is not None:
+            box = load_roi_box(self.mask_paths[idx], self.roi_margin, cache=self.cache)
+        image = load_dicom_series(self.series_dirs[idx], target_size=self.target_size, cache=self.cache,
+                                  roi=box)  # (1, H, W)
         mask = None
         if self.use_mask and self.mask_paths[idx] is not None:
             mask = load_nrrd_mask(self.mask_paths[idx])  # (1, H, W)
+            if mask is not None and box is not None:
+                mask = crop_to_box(mask, box)
 
         if self.transform:
             image = self.transform(image)
@@ -103,6 +310,72 @@ class BreastMRIDataset(Dataset):
         label = torch.tensor(self.labels[idx], dtype=torch.float32)
         return image, mask, label
 
+class BreastMRIVolumeDataset(Dataset):
+    def __init__(self, series_dirs, mask_paths, labels, target_size=(224, 224), use_mask=True, cache=None,
+                 roi_margin=None):
+        """
+        Like BreastMRIDataset but yields whole volumes: (image (1, Z, H, W), mask (1, Z, H, W) or None, label)
+
+        Z differs between patients, so batch these one patient at a time (TumorFeatureCNN3D batches slabs instead).
+        """
+        self.series_dirs = series_dirs
+        self.mask_paths = mask_paths
+        self.labels = labels
+        self.target_size = tuple(target_size)
+        self.use_mask = use_mask
+        self.cache = cache
+        self.roi_margin = roi_margin
+
+    def __len__(self):
+        return len(self.series_dirs)
+
+    def __getitem__(self, idx):
+        box = None
+        if self.roi_margin is not None:
+            box = load_roi_box(self.mask_paths[idx], self.roi_margin, cache=self.cache)
+        volume = load_dicom_volume(self.series_dirs[idx], target_size=self.target_size, cache=self.cache, roi=box)
+        mask = None
+        if self.use_mask:
+            mask = load_nrrd_volume(self.mask_paths[idx], volume.shape[1], self.target_size, roi=box)
+        label = torch.tensor(self.labels[idx], dtype=torch.float32)
+        return volume, mask, label
+
+"""Batching for Multi-Worker Loading"""
+
+def collate_mri_batch(batch):
+    """Collate (image, mask or None, label) items into (images, masks, labels, mask_present)"""
+    """    #Missing masks are filled with zeros shaped like the present masks (or the image when none are present),
+    #mask_present is a bool bitmap of which items had a real mask. Replaces default_collate, which can't batch None.
+"""
+    images, masks, labels = zip(*batch)
+    mask_present = torch.tensor([mask is not None for mask in masks], dtype=torch.bool)
+    reference = next((mask for mask in masks if mask is not None), images[0])
+    masks = [mask if mask is not None else torch.zeros_like(reference) for mask in masks]
+    return torch.stack(images), torch.stack(masks), torch.stack(labels), mask_present
+
+def mri_worker_init(worker_id):
+    # Each DataLoader worker decodes with a single thread so workers x threads doesn't oversubscribe the CPU
+    import SimpleITK as sitk
+
+    torch.set_num_threads(1)
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(1)
+
+def make_mri_loader(dataset, batch_size=8, num_workers=0, shuffle=False, pin_memory=None, prefetch_factor=2):
+    """DataLoader over a BreastMRIDataset/MemmapMRIDataset that is safe for num_workers > 0"""
+    if pin_memory is None:
+        pin_memory = torch.cuda.is_available()
+    return DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=shuffle,
+        num_workers=num_workers,
+        collate_fn=collate_mri_batch,
+        pin_memory=pin_memory,
+        worker_init_fn=mri_worker_init if num_workers > 0 else None,
+        persistent_workers=num_workers > 0,
+        prefetch_factor=prefetch_factor if num_workers > 0 else None,
+    )
+
 """Functions for Accessing Training and Test"""
 
 #pipeline:
@@ -115,16 +388,17 @@ baselineLocation = "D:\\brc\\ids"
 baselineLocationImgs = "D:\\brc\\image\\manifest-1654812109500\\Duke-Breast-Cancer-MRI"
 baselineLocationSeg = "D:\\brc\\seg\\3dtest\\PKG - Duke-Breast-Cancer-MRI-Supplement-v3\\Duke-Breast-Cancer-MRI-Supplement-v3\\Segmentation_Masks_NRRD"
 locationOfClin = "D:\\brc\\clin\\clinical.csv"
-print(os.path.exists(locationOfClin))
+locationOfVolumeCache = "D:\\brc\\cache\\volumes"
+locationOfFeatureShards = "D:\\brc\\cache\\cnn_shards"
 
-def trawlIdFile():
-    dir_list = os.listdir(baselineLocationSeg)
-    print(dir_list)
+def trawlIdFile(segLocation=None):
+    dir_list = os.listdir(segLocation or baselineLocationSeg)
+    logger.debug(dir_list)
     df = pd.DataFrame(dir_list, columns=['Name'])
     return df
 
-def buildPathToSeries(patient):
-    currentDir = os.path.join(baselineLocationImgs, patient)
+def buildPathToSeries(patient, imgsLocation=None):
+    currentDir = os.path.join(imgsLocation or baselineLocationImgs, patient)
     folders = [f for f in os.listdir(currentDir) if os.path.isdir(os.path.join(currentDir, f))]
         # Check if there is at least one folder
     if folders:
@@ -134,21 +408,19 @@ def buildPathToSeries(patient):
         currentDir = os.path.join(currentDir, "T1_IMGS")
     return currentDir
 
-def buildPathToNrrd(patient):
-    currentDir = os.path.join(baselineLocationSeg, patient)
+def buildPathToNrrd(patient, segLocation=None):
+    currentDir = os.path.join(segLocation or baselineLocationSeg, patient)
     #Segmentation_Breast_MRI_018_Breast.seg.nrrd
     string = "Segmentation_" + patient + "_Breast.seg.nrrd"
     currentDir = os.path.join(currentDir, string)
     return currentDir
 
-def trawlMyRecurrences():
-    df = pd.read_csv(locationOfClin)
+def trawlMyRecurrences(clinLocation=None):
+    df = pd.read_csv(clinLocation or locationOfClin)
     df['Recurrence'] = pd.to_numeric(df['Recurrence'], downcast='integer', errors='coerce')
-    print(df)
+    logger.debug(df)
     return df
 
-trawlMyRecurrences()
-
 def constructSeriesDirAndMaskPaths():
     series_dirs=[]
     mask_paths=[]
@@ -156,7 +428,7 @@ def constructSeriesDirAndMaskPaths():
     recurrencedf = trawlMyRecurrences()
     filtered_rec = recurrencedf[recurrencedf['Name'].isin(df['Name'])]
     labels = filtered_rec['Recurrence'].values.tolist()
-    print(labels)
+    logger.debug(labels)
     for index, row in df.iterrows():
         patient = row['Name']
         #construct path to series
@@ -166,30 +438,25 @@ def constructSeriesDirAndMaskPaths():
             mask_paths.append(buildPathToNrrd(patient))
     return series_dirs, mask_paths, labels
 
-constructSeriesDirAndMaskPaths()
-
-from torchvision.transforms import Resize, Compose
-from torch.utils.data import DataLoader
-
-transform = Compose([
-    Resize((224, 224)),  # need to see if architecture allows for this
-])
-series, masks, recLabels = constructSeriesDirAndMaskPaths()
-dataset = BreastMRIDataset(
-    series_dirs=series,
-    mask_paths=masks,
-    labels=recLabels,
-    transform=transform,
-    use_mask=True,
-)
-
-loader = DataLoader(dataset, batch_size=8, shuffle=True)
-
-#put in pickl file  post-architecture so this isnt a pain for anyone
-
-import torch
-import torch.nn as nn
-import torch.nn.functional as F
+def collect_patients(images_dir=None, masks_dir=None, clinical_csv=None):
+    """Return [(patient, series_dir, mask_path, label)] for every patient with a series on disk"""
+    ids = trawlIdFile(masks_dir)['Name'].tolist()
+    recurrences = trawlMyRecurrences(clinical_csv)
+    label_by_id = dict(zip(recurrences['Name'], recurrences['Recurrence']))
+
+    patients = []
+    for patient in ids:
+        if patient not in label_by_id:
+            continue
+        series_dir = buildPathToSeries(patient, images_dir)
+        if not os.path.exists(series_dir):
+            continue
+        mask_path = buildPathToNrrd(patient, masks_dir)
+        patients.append((patient, series_dir, mask_path if os.path.exists(mask_path) else None,
+                         float(label_by_id[patient])))
+    return patients
+
+"""Feature Extraction Model"""
 
 class TumorFeatureCNN(nn.Module):
     def __init__(self, use_mask=False, in_channels=1):
@@ -213,48 +480,415 @@ class TumorFeatureCNN(nn.Module):
         x = x.view(x.size(0), -1)  # flatten to (B, features)
         return x  # features to send to RNN or FC layers
 
-# Create model instance
-model = TumorFeatureCNN(use_mask=False, in_channels=1)  # adjust if needed
-
-# Move to GPU if available
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-model = model.to(device)
-
-df = trawlIdFile()
-recurrencedf = trawlMyRecurrences()
-filtered_rec = recurrencedf[recurrencedf['Name'].isin(df['Name'])]
-patient_ids = filtered_rec['Name'].values.tolist()
-print(patient_ids)
-
-import pickle
+class TumorFeatureCNN3D(nn.Module):
+    """
+    Volumetric TumorFeatureCNN: the same three conv layers as Conv3d, run over overlapping Z-slabs
+
+    forward takes a batch of slabs (B, C, D, H, W). forward_volume splits whole (B, C, Z, H, W)
+    volumes into slabs of slab_depth slices (slab_overlap shared between neighbours), runs slab_batch
+    slabs at a time and averages their features into the same 128-d vector as the 2D model, so peak
+    memory is set by the slab size rather than by Z. Unlike the 2D model it max-pools by 2 after the
+    first two convs; without that, a 150-slice series at 224x224 costs teraflops per patient.
+    """
+    def __init__(self, use_mask=False, in_channels=1, slab_depth=16, slab_overlap=4, slab_batch=2):
+        super().__init__()
+        self.use_mask = use_mask
+        self.slab_depth = slab_depth
+        self.slab_overlap = slab_overlap
+        self.slab_batch = slab_batch
+        total_in = in_channels + (1 if use_mask else 0)
 
-# Put model in evaluation mode
-model.eval()
+        self.conv1 = nn.Conv3d(total_in, 32, kernel_size=3, padding=1)
+        self.conv2 = nn.Conv3d(32, 64, kernel_size=3, padding=1)
+        self.conv3 = nn.Conv3d(64, 128, kernel_size=3, padding=1)
+        self.down = nn.MaxPool3d(2, ceil_mode=True)
+        self.pool = nn.AdaptiveAvgPool3d((1, 1, 1))
 
+    def forward(self, x, mask=None):
+        if self.use_mask:
+            x = torch.cat([x, mask if mask is not None else torch.zeros_like(x)], dim=1)
 
-all_features = []
-all_labels = []
-print("BEGIN TORCH")
-with torch.no_grad():
-    for inputs, masks, labels in loader:
-        masks = masks.to(device)
-        labels = labels.to(device)
+        x = self.down(F.relu(self.conv1(x)))
+        x = self.down(F.relu(self.conv2(x)))
+        x = F.relu(self.conv3(x))
+        x = self.pool(x)
+        return x.view(x.size(0), -1)
+
+    def forward_volume(self, volume, mask=None):
+        """Mean of the slab features of (B, C, Z, H, W) volumes, returns (B, 128)"""
+        batch = volume.size(0)
+        starts = slab_starts(volume.size(2), self.slab_depth, self.slab_overlap)
+        total = None
+        for group in range(0, len(starts), self.slab_batch):
+            chunk = starts[group:group + self.slab_batch]
+            slabs = torch.cat([volume[:, :, z:z + self.slab_depth] for z in chunk])
+            masks = None if mask is None else torch.cat([mask[:, :, z:z + self.slab_depth] for z in chunk])
+            features = self(slabs, masks).view(len(chunk), batch, -1).sum(dim=0)
+            total = features if total is None else total + features
+        return total / len(starts)
+
+def save_cnn(model, path):
+    """Save a TumorFeatureCNN's (or TumorFeatureCNN3D's) constructor arguments and weights (atomically)"""
+    checkpoint = {
+        'use_mask': model.use_mask,
+        'in_channels': model.conv1.in_channels - (1 if model.use_mask else 0),
+        'state_dict': model.state_dict(),
+    }
+    if isinstance(model, TumorFeatureCNN3D):
+        checkpoint['volumetric'] = {'slab_depth': model.slab_depth, 'slab_overlap': model.slab_overlap,
+                                    'slab_batch': model.slab_batch}
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    torch.save(checkpoint, tmp_path)
+    os.replace(tmp_path, path)
+
+def load_cnn(path, device='cpu'):
+    """Rebuild a TumorFeatureCNN saved by save_cnn, in eval mode (.pt2 archives from export_cnn are loaded as ExportedCNN)"""
+    if path.endswith('.pt2'):
+        return load_cnn_export(path, device)
+    checkpoint = torch.load(path, map_location=device, weights_only=True)
+    if checkpoint.get('volumetric'):
+        model = TumorFeatureCNN3D(use_mask=checkpoint['use_mask'], in_channels=checkpoint['in_channels'],
+                                  **checkpoint['volumetric'])
+    else:
+        model = TumorFeatureCNN(use_mask=checkpoint['use_mask'], in_channels=checkpoint['in_channels'])
+    model.load_state_dict(checkpoint['state_dict'])
+    return model.to(device).eval()
 
-        outputs = model(inputs, masks)  # Get feature vector
-        all_features.append(outputs.cpu())
-        all_labels.append(labels.cpu())
+"""Compiled Export"""
 
-# Stack all tensors
-features_tensor = torch.cat(all_features)
-labels_tensor = torch.cat(all_labels)
-print("pickle time")
-# Save with pickle
-with open("cnn_features.pkl", "wb") as f:
-    pickle.dump({
-      'features': features_tensor.numpy(),
-      'labels':   labels_tensor.numpy(),
-      'ids':      patient_ids,
-    }, f)
+class ExportedCNN(nn.Module):
+    """
+    A TumorFeatureCNN loaded from an export_cnn archive, without the class definition
 
-print("Saved all CNN features and labels to cnn_features.pkl")
+    Called like TumorFeatureCNN (x, mask). The use_mask branch was resolved at
+    export time, and a missing mask is passed as zeros.
+    """
+    def __init__(self, program, meta):
+        super().__init__()
+        self.program = program
+        self.use_mask = meta['use_mask']
+        self.in_channels = meta['in_channels']
+        self.target_size = tuple(meta['target_size'])
+        # Fingerprint of the eager model it was exported from, so both share feature shards
+        self.fingerprint = meta['fingerprint']
 
+    def forward(self, x, mask=None):
+        if mask is None:
+            mask = torch.zeros_like(x)
+        return self.program(x, mask)
+
+def export_cnn(model, path, target_size=(224, 224), compiled=True, max_batch=1024):
+    """
+    Export a TumorFeatureCNN for the fixed target_size, loadable without the class
+
+    The model is captured with torch.export at (batch, C, H, W) with only the batch
+    dimension dynamic. compiled=True packages it with AOTInductor: Inductor generates
+    C++ kernels for this shape with conv+ReLU fused, and no Python is needed at load.
+    compiled=False saves the portable ExportedProgram instead, which runs on the
+    eager kernels.
+    The archive (.pt2) is written atomically and loaded by load_cnn_export.
+    """
+    if isinstance(model, TumorFeatureCNN3D):
+        raise ValueError("export_cnn supports the 2D TumorFeatureCNN only")
+    model = model.eval()
+    device = next(model.parameters()).device
+    in_channels = model.conv1.in_channels - (1 if model.use_mask else 0)
+    example = torch.zeros((2, in_channels) + tuple(target_size), device=device)
+    mask = torch.zeros((2, 1) + tuple(target_size), device=device)
+    batch = torch.export.Dim('batch', min=1, max=max_batch)
+    program = torch.export.export(model, (example, mask), dynamic_shapes=({0: batch}, {0: batch}))
+
+    meta = json.dumps({'use_mask': model.use_mask, 'in_channels': in_channels,
+                       'target_size': list(target_size), 'fingerprint': model_fingerprint(model)})
+    # Both writers need the .pt2 suffix
+    tmp_path = f"{path}.{os.getpid()}.tmp.pt2"
+    if compiled:
+        torch._inductor.aoti_compile_and_package(
+            program, package_path=tmp_path, inductor_configs={'aot_inductor.metadata': {'tumor_cnn': meta}})
+    else:
+        torch.export.save(program, tmp_path, extra_files={'tumor_cnn.json': meta})
+    os.replace(tmp_path, path)
+
+def load_cnn_export(path, device='cpu'):
+    """Load an export_cnn archive as an ExportedCNN (AOTInductor packages run on the device they were built for)"""
+    with zipfile.ZipFile(path) as archive:
+        compiled = any('/aotinductor/' in name for name in archive.namelist())
+    if compiled:
+        program = torch._inductor.aoti_load_package(path)
+        meta = program.get_metadata()['tumor_cnn']
+    else:
+        extra_files = {'tumor_cnn.json': ''}
+        program = torch.export.load(path, extra_files=extra_files).module().to(device)
+        meta = extra_files['tumor_cnn.json']
+    return ExportedCNN(program, json.loads(meta))
+
+"""Feature Extraction Engine"""
+
+def extract_features(model, dataset, batch_size=32, device=None, num_workers=0,
+                     num_threads=None, interop_threads=None, channels_last=False, bf16=False, compile=False,
+                     on_batch=None):
+    """Run model over dataset in inference mode, in dataset order, and return (features, labels, stats)"""
+    """    #num_threads/interop_threads set torch's intra-op and inter-op pools (inter-op can only be set once per process)
+    #channels_last converts the model and inputs to NHWC, bf16 enables bfloat16 autocast (CPU or CUDA)
+    #compile wraps the model in torch.compile (Inductor kernels, conv+relu fused; the first batches pay the compile)
+    #on_batch(start, features, labels) is called after every batch, start being the dataset index of its first item
+    #stats holds the image count, wall/compute seconds and images/sec so CPU nodes can be sized for the full cohort
+"""
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if interop_threads:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError:
+            logger.warning(f"Inter-op pool already started, keeping {torch.get_num_interop_threads()} threads")
+
+    if device is None:
+        # An AOTInductor ExportedCNN has no parameters and runs on CPU
+        device = next(model.parameters(), torch.empty(0)).device
+    device = torch.device(device)
+    memory_format = torch.channels_last if channels_last else torch.contiguous_format
+    model = model.to(device, memory_format=memory_format).eval()
+    if compile:
+        model = torch.compile(model)
+
+    # No shuffling: rows must line up with the dataset's patient order
+    loader = make_mri_loader(dataset, batch_size=batch_size, num_workers=num_workers, shuffle=False,
+                             pin_memory=device.type == 'cuda')
+
+    all_features = []
+    all_labels = []
+    compute_time = 0.0
+    seen = 0
+    start = time.perf_counter()
+    with torch.inference_mode(), torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=bf16):
+        for inputs, masks, labels, _ in loader:
+            batch_start = time.perf_counter()
+            inputs = inputs.to(device, memory_format=memory_format, non_blocking=True)
+            masks = masks.to(device, memory_format=memory_format, non_blocking=True)
+
+            with stage('cnn_forward', batch=len(inputs)):
+                outputs = model(inputs, masks)  # Get feature vector
+                all_features.append(outputs.float().cpu())
+            count('cnn_images', len(outputs))
+            all_labels.append(labels.cpu())
+            compute_time += time.perf_counter() - batch_start
+            if on_batch is not None:
+                on_batch(seen, all_features[-1], all_labels[-1])
+            seen += len(outputs)
+    wall_time = time.perf_counter() - start
+
+    features = torch.cat(all_features) if all_features else torch.empty(0)
+    labels = torch.cat(all_labels) if all_labels else torch.empty(0)
+    stats = {
+        'images': len(features),
+        'wall_seconds': wall_time,
+        'compute_seconds': compute_time,
+        'images_per_sec': len(features) / wall_time if wall_time > 0 else 0.0,
+        'compute_images_per_sec': len(features) / compute_time if compute_time > 0 else 0.0,
+    }
+    logger.info(f"Extracted {stats['images']} images in {wall_time:.2f}s: "
+                f"{stats['images_per_sec']:.1f} img/s end-to-end, "
+                f"{stats['compute_images_per_sec']:.1f} img/s model only")
+    return features, labels, stats
+
+def extract_volume_features(model, dataset, device=None, num_workers=0, num_threads=None, on_batch=None):
+    """extract_features for TumorFeatureCNN3D over a BreastMRIVolumeDataset, one patient (and slab_batch slabs) at a time"""
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if device is None:
+        device = next(model.parameters()).device
+    device = torch.device(device)
+    model = model.to(device).eval()
+    loader = make_mri_loader(dataset, batch_size=1, num_workers=num_workers, shuffle=False,
+                             pin_memory=device.type == 'cuda')
+
+    all_features = []
+    all_labels = []
+    compute_time = 0.0
+    start = time.perf_counter()
+    with torch.inference_mode():
+        for seen, (volumes, masks, labels, present) in enumerate(loader):
+            batch_start = time.perf_counter()
+            volumes = volumes.to(device, non_blocking=True)
+            masks = masks.to(device, non_blocking=True) if present.all() else None
+            with stage('cnn3d_forward', slices=volumes.shape[2]):
+                all_features.append(model.forward_volume(volumes, masks).float().cpu())
+            count('cnn_volumes')
+            all_labels.append(labels.cpu())
+            compute_time += time.perf_counter() - batch_start
+            if on_batch is not None:
+                on_batch(seen, all_features[-1], all_labels[-1])
+    wall_time = time.perf_counter() - start
+
+    features = torch.cat(all_features) if all_features else torch.empty(0)
+    labels = torch.cat(all_labels) if all_labels else torch.empty(0)
+    stats = {
+        'images': len(features),
+        'wall_seconds': wall_time,
+        'compute_seconds': compute_time,
+        'images_per_sec': len(features) / wall_time if wall_time > 0 else 0.0,
+        'compute_images_per_sec': len(features) / compute_time if compute_time > 0 else 0.0,
+    }
+    logger.info(f"Extracted {stats['images']} volumes in {wall_time:.2f}s: "
+                f"{stats['images_per_sec']:.2f} volumes/s end-to-end, "
+                f"{stats['compute_images_per_sec']:.2f} volumes/s model only")
+    return features, labels, stats
+
+"""Incremental Extraction"""
+
+def model_fingerprint(model):
+    """Hash of the model's class, config and weights, so changing the CNN invalidates its features"""
+    if isinstance(model, ExportedCNN):
+        return model.fingerprint
+    config = f"{type(model).__name__}|{getattr(model, 'use_mask', None)}"
+    if isinstance(model, TumorFeatureCNN3D):
+        # Slab geometry changes the pooled features (slab_batch only changes memory use)
+        config += f"|{model.slab_depth}|{model.slab_overlap}"
+    h = hashlib.sha1(config.encode())
+    for name, tensor in model.state_dict().items():
+        h.update(name.encode())
+        h.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return h.hexdigest()
+
+def patient_fingerprint(series_dir, mask_path, model_key, target_size=(224, 224), roi_margin=None):
+    files = list_dicom_files(series_dir)
+    if mask_path is not None and os.path.exists(mask_path):
+        files.append(mask_path)
+    if roi_margin is None:
+        return fingerprint_files(files, tuple(target_size), model_key)
+    return fingerprint_files(files, tuple(target_size), model_key, ('roi', roi_margin))
+
+def extract_features_incremental(model, patients, shard_dir, transform=None, use_mask=True, cache=None,
+                                 roi_margin=None, target_size=(224, 224), **kwargs):
+    """
+    Extract features only for patients whose shard is missing or stale, writing one shard per patient
+
+    patients: list of (patient, series_dir, mask_path or None, label) as from collect_patients
+    roi_margin/target_size are passed to BreastMRIDataset and are part of each shard's fingerprint.
+    Remaining keyword arguments go to extract_features (extract_volume_features for a TumorFeatureCNN3D,
+    which reads whole volumes through BreastMRIVolumeDataset). Returns the FeatureShardStore.
+    """
+    store = FeatureShardStore(shard_dir)
+    model_key = model_fingerprint(model)
+    fingerprints = {patient: patient_fingerprint(series_dir, mask_path, model_key, target_size, roi_margin)
+                    for patient, series_dir, mask_path, _ in patients}
+    todo = [p for p in patients if not store.is_current(p[0], fingerprints[p[0]])]
+    logger.info(f"{len(patients) - len(todo)} patients up to date, extracting {len(todo)}")
+    if not todo:
+        return store
+
+    sources = dict(
+        series_dirs=[series_dir for _, series_dir, _, _ in todo],
+        mask_paths=[mask_path for _, _, mask_path, _ in todo],
+        labels=[label for _, _, _, label in todo],
+    )
+    if isinstance(model, TumorFeatureCNN3D):
+        dataset = BreastMRIVolumeDataset(**sources, target_size=target_size, use_mask=use_mask, cache=cache,
+                                         roi_margin=roi_margin)
+        extract = extract_volume_features
+    else:
+        dataset = BreastMRIDataset(**sources, transform=transform, use_mask=use_mask, cache=cache,
+                                   roi_margin=roi_margin, target_size=target_size)
+        extract = extract_features
+
+    def write_batch(start, features, labels):
+        # Shards land as soon as their batch finishes, a crash loses at most the batch in flight
+        for offset, (feature, label) in enumerate(zip(features, labels)):
+            patient = todo[start + offset][0]
+            store.write(patient, feature.numpy(), float(label), fingerprints[patient])
+
+    with stage('cnn_extraction', patients=len(todo)):
+        extract(model, dataset, on_batch=write_batch, **kwargs)
+    return store
+
+"""Script"""
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Extract TumorFeatureCNN features for every patient with a DICOM series")
+    parser.add_argument('--images_dir', default=baselineLocationImgs, help="root of the DICOM series")
+    parser.add_argument('--masks_dir', default=baselineLocationSeg, help="root of the NRRD masks (also lists the patients)")
+    parser.add_argument('--clinical_csv', default=locationOfClin, help="CSV with Name,Recurrence columns")
+    parser.add_argument('--output', default='cnn_features', help="feature store directory to write (default: %(default)s)")
+    parser.add_argument('--shard_dir', default=locationOfFeatureShards, help="per-patient feature shards (resume state)")
+    parser.add_argument('--cache_dir', default=locationOfVolumeCache, help="decoded-volume cache directory")
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--num_workers', type=int, default=0, help="DataLoader worker processes")
+    parser.add_argument('--threads', type=int, default=None, help="torch intra-op threads")
+    parser.add_argument('--use_mask', action='store_true', help="feed the segmentation mask as a second channel")
+    parser.add_argument('--roi_margin', type=float, default=None,
+                        help="crop each slice to its mask's bounding box grown by this fraction (e.g. 0.1)")
+    parser.add_argument('--input_size', type=int, default=224, help="CNN input height/width (default: %(default)s)")
+    parser.add_argument('--volumetric', action='store_true',
+                        help="keep the Z axis: TumorFeatureCNN3D over overlapping Z-slabs instead of the mean slice")
+    parser.add_argument('--slab_depth', type=int, default=16, help="slices per slab with --volumetric")
+    parser.add_argument('--slab_overlap', type=int, default=4, help="slices shared by neighbouring slabs")
+    parser.add_argument('--slab_batch', type=int, default=2, help="slabs per forward pass (bounds peak memory)")
+    parser.add_argument('--weights', default='cnn_weights.pt',
+                        help="where to save the CNN weights the features were extracted with (default: %(default)s)")
+    parser.add_argument('--export', default=None,
+                        help="also write the CNN as a class-free .pt2 archive (AOTInductor-compiled for --input_size)")
+    parser.add_argument('--portable_export', action='store_true',
+                        help="with --export: save the uncompiled ExportedProgram instead of an AOTInductor package")
+    parser.add_argument('--compile', action='store_true', help="run extraction through torch.compile")
+    instrumentation.add_arguments(parser)
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    instrumentation.setup(args.profile, args.log_level)
+    if args.volumetric and (args.export or args.compile):
+        raise SystemExit("--export and --compile support the 2D model only, drop them or --volumetric")
+    from torchvision.transforms import Resize, Compose
+
+    target_size = (args.input_size, args.input_size)
+    transform = Compose([
+        Resize(target_size),  # need to see if architecture allows for this
+    ])
+    patients = collect_patients(args.images_dir, args.masks_dir, args.clinical_csv)
+
+    #put in pickl file  post-architecture so this isnt a pain for anyone
+
+    # Create model instance (seeded so re-runs produce the same weights and existing shards stay valid)
+    torch.manual_seed(42)
+    if args.volumetric:
+        model = TumorFeatureCNN3D(use_mask=args.use_mask, in_channels=1, slab_depth=args.slab_depth,
+                                  slab_overlap=args.slab_overlap, slab_batch=args.slab_batch)
+    else:
+        model = TumorFeatureCNN(use_mask=args.use_mask, in_channels=1)  # adjust if needed
+    # Saved so inference_server.py embeds new patients with exactly these weights
+    save_cnn(model, args.weights)
+    if args.export:
+        with stage('cnn_export', compiled=not args.portable_export):
+            export_cnn(model, args.export, target_size=target_size, compiled=not args.portable_export)
+        logger.info(f"Exported CNN to {args.export}")
+
+    # Move to GPU if available
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model = model.to(device)
+
+    patient_ids = [patient for patient, _, _, _ in patients]
+    logger.debug(patient_ids)
+
+    logger.debug("BEGIN TORCH")
+    # One shard per patient, patients already extracted from the same sources and weights are skipped
+    shards = extract_features_incremental(
+        model, patients, args.shard_dir,
+        transform=transform,
+        use_mask=True,
+        cache=VolumeCache(cache_dir=args.cache_dir) if args.cache_dir else None,
+        roi_margin=args.roi_margin,
+        target_size=target_size,
+        num_workers=args.num_workers,
+        num_threads=args.threads,
+        device=device,
+        # Volumes go one patient at a time, --slab_batch sets the batch instead
+        **({} if args.volumetric else {'batch_size': args.batch_size, 'compile': args.compile}),
+    )
+    shards.compact(patient_ids, args.output)
+
+    logger.info(f"Saved all CNN features and labels to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,458 @@
+# -*- coding: utf-8 -*-
+"""Content-hashed stage DAG over the pipeline scripts.
+
+The workflow is five stages, each building one artifact directory:
+
+    ingest ---------> cnn_features --+
+                                     +--> fusion
+    clinical_encode -> rnn_features -+
+
+    ingest           scans the images/masks/labels and records each patient's source fingerprint
+    cnn_features     mri_images_cnn.py: TumorFeatureCNN feature store and weights
+    clinical_encode  clinical_data_rnn.py --encode_only: the fitted ClinicalEncoder
+    rnn_features     clinical_data_rnn.py with that encoder: RNN feature store, checkpoint, threshold
+    fusion           fusion_layer.py: fusion model, threshold, evaluation plots and log
+
+A stage's key is the hash of its code (the contents of the modules it runs), its
+parameters (the extra command-line arguments it is given), the external files it
+reads (including any file or directory named in those arguments, such as
+--rnn_args="--visits visits.csv") and the output digests of the stages it depends on. Artifacts live in
+<work_dir>/<stage>/<key prefix>/ and are only built when no artifact with that
+key exists, so changing a fusion hyperparameter only re-runs fusion, and going
+back to earlier settings reuses their artifacts. Because dependencies enter the
+key through their output digest, a stage that is rebuilt with identical output
+does not invalidate what comes after it.
+
+Stages run as subprocesses of the scripts, up to --jobs at a time, so the CNN
+branch and the clinical branch build in parallel. Each stage's console output is
+kept in its artifact as stage.log. <work_dir>/latest.json points at the artifacts
+of the last run; the fusion model ends up in <work_dir>/fusion/<key>/fusion_model.keras.
+
+Usage:
+    python pipeline.py --images_dir data/images/ --masks_dir data/masks/ --clinical_csv data/clinical.csv \\
+        --clinical_xlsx Clinical_and_Other_Features.xlsx --work_dir runs/
+    python pipeline.py ... --fusion_args="--epochs 80 --folds 0" --dry_run
+    python pipeline.py ... --cnn_args="--use_mask --roi_margin 0.1" --force cnn_features --prune
+"""
+
+import os
+import sys
+import json
+import time
+import shlex
+import shutil
+import hashlib
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import instrumentation
+from instrumentation import get_logger, stage
+
+logger = get_logger('runner')
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+# Bump when the way stages are keyed or built changes so every artifact is rebuilt
+PIPELINE_VERSION = 1
+RECORD = "stage.json"
+LOG = "stage.log"
+LATEST = "latest.json"
+
+
+def file_sha1(path, chunk_size=1 << 20):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def artifact_digest(path, outputs):
+    """Hash of the relative paths and contents of the given files/directories under path"""
+    h = hashlib.sha1()
+    for output in sorted(outputs):
+        full = os.path.join(path, output)
+        files = [full] if os.path.isfile(full) else sorted(
+            os.path.join(root, name) for root, _, names in os.walk(full) for name in names)
+        if not files:
+            raise FileNotFoundError(f"Stage output {output} was not written")
+        for file in files:
+            h.update(f"{os.path.relpath(file, path)}|{file_sha1(file)};".encode())
+    return h.hexdigest()
+
+
+def path_digest(path):
+    """Content hash of a file, or of every file (and its relative path) under a directory"""
+    if os.path.isfile(path):
+        return file_sha1(path)
+    h = hashlib.sha1()
+    for root, dirs, names in os.walk(path):
+        dirs.sort()
+        for name in sorted(names):
+            full = os.path.join(root, name)
+            h.update(f"{os.path.relpath(full, path)}|{file_sha1(full)};".encode())
+    return h.hexdigest()
+
+
+def argument_files(script_args):
+    """Digests of the existing files/directories named in extra script arguments (e.g. --visits visits.csv)"""
+    digests = {}
+    for arg in script_args:
+        value = arg.split('=', 1)[1] if arg.startswith('-') and '=' in arg else arg
+        if value and not value.startswith('-') and os.path.exists(value):
+            digests[value] = path_digest(value)
+    return digests
+
+
+def _write_json(path, payload):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(payload, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+"""Stages"""
+
+class Stage:
+    def __init__(self, name, outputs, deps=(), code=(), params=None, inputs=None, command=None, build=None):
+        """
+        name: stage and artifact directory name
+        outputs: the files/directories of the artifact later stages read; their contents are its digest
+        deps: names of the stages whose artifacts this one reads
+        code: repo modules whose contents version the stage
+        params: JSON-serializable parameters that change its result (e.g. extra script arguments)
+        inputs: callable returning a digest of the external files it reads
+        command: callable(out_dir, dep_dirs) returning the script and arguments that build the artifact
+        build: callable(out_dir, dep_dirs) building the artifact in this process instead (cheap stages)
+        """
+        self.name = name
+        self.outputs = tuple(outputs)
+        self.deps = tuple(deps)
+        self.code = tuple(code)
+        self.params = params
+        self.inputs = inputs
+        self.command = command
+        self.build = build
+
+    def key_payload(self, dep_digests):
+        """Everything the stage's key is computed from, kept in the artifact's record"""
+        return {
+            'version': PIPELINE_VERSION,
+            'stage': self.name,
+            'code': {module: file_sha1(os.path.join(ROOT, module)) for module in self.code},
+            'params': self.params,
+            'inputs': self.inputs() if self.inputs else None,
+            'deps': {dep: dep_digests[dep] for dep in self.deps},
+        }
+
+
+def stage_key(payload):
+    return hashlib.sha1(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+def explain(old, new):
+    """Why a stage is stale, comparing its last record's key payload with the new one"""
+    if old is None:
+        return "no earlier artifact"
+    reasons = []
+    changed_code = sorted(m for m in set(old['code']) | set(new['code']) if old['code'].get(m) != new['code'].get(m))
+    if changed_code:
+        reasons.append(f"code changed ({', '.join(changed_code)})")
+    if old['params'] != new['params']:
+        reasons.append("parameters changed")
+    if old['inputs'] != new['inputs']:
+        reasons.append("inputs changed")
+    changed_deps = sorted(d for d in new['deps'] if old['deps'].get(d) != new['deps'][d])
+    if changed_deps:
+        reasons.append(f"upstream changed ({', '.join(changed_deps)})")
+    if old['version'] != new['version']:
+        reasons.append("pipeline version changed")
+    return ", ".join(reasons) or "artifact missing"
+
+
+def scan_sources(args):
+    """Per-patient fingerprints of the series, masks and labels the CNN stage will read"""
+    from mri_images_cnn import collect_patients, list_dicom_files
+    from volume_cache import fingerprint_files
+
+    patients = []
+    for patient, series_dir, mask_path, label in collect_patients(args.images_dir, args.masks_dir,
+                                                                  args.clinical_csv):
+        files = list_dicom_files(series_dir) + ([mask_path] if mask_path else [])
+        patients.append({'patient': patient, 'label': label, 'has_mask': mask_path is not None,
+                         'fingerprint': fingerprint_files(files)})
+    return patients
+
+
+def build_stages(args):
+    """The pipeline DAG for these arguments, in a valid run order"""
+    sources = {}
+
+    def ingest_inputs():
+        sources['patients'] = scan_sources(args)
+        return hashlib.sha1(json.dumps(sources['patients'], sort_keys=True).encode()).hexdigest()
+
+    def ingest(out_dir, dep_dirs):
+        _write_json(os.path.join(out_dir, 'patients.json'), sources['patients'])
+        logger.info(f"ingest: {len(sources['patients'])} patients")
+
+    def xlsx_inputs():
+        return file_sha1(args.clinical_xlsx)
+
+    def rnn_inputs():
+        return {'xlsx': xlsx_inputs(), 'args': argument_files(args.rnn_args)}
+
+    def data_args():
+        paths = [('--images_dir', args.images_dir), ('--masks_dir', args.masks_dir),
+                 ('--clinical_csv', args.clinical_csv)]
+        return [a for flag, path in paths if path for a in (flag, path)]
+
+    def cnn_command(out_dir, dep_dirs):
+        return ['mri_images_cnn.py', *data_args(),
+                '--output', os.path.join(out_dir, 'cnn_features'),
+                '--weights', os.path.join(out_dir, 'cnn_weights.pt'),
+                # Shards and decoded volumes are fingerprinted themselves, so every key shares them
+                '--shard_dir', os.path.join(args.work_dir, 'cache', 'cnn_shards'),
+                '--cache_dir', os.path.join(args.work_dir, 'cache', 'volumes'),
+                *args.cnn_args]
+
+    def encode_command(out_dir, dep_dirs):
+        return ['clinical_data_rnn.py', '--input', args.clinical_xlsx, '--encode_only',
+                '--encoder', os.path.join(out_dir, 'clinical_encoder.json'),
+                '--snapshot_dir', os.path.join(args.work_dir, 'cache', 'clinical')]
+
+    def rnn_command(out_dir, dep_dirs):
+        return ['clinical_data_rnn.py', '--input', args.clinical_xlsx,
+                '--fitted_encoder', os.path.join(dep_dirs['clinical_encode'], 'clinical_encoder.json'),
+                '--snapshot_dir', os.path.join(args.work_dir, 'cache', 'clinical'),
+                '--output', os.path.join(out_dir, 'rnn_features'),
+                '--checkpoint', os.path.join(out_dir, 'best_model.keras'),
+                '--visits_encoder', os.path.join(out_dir, 'visits_encoder.json'),
+                *args.rnn_args]
+
+    def fusion_command(out_dir, dep_dirs):
+        return ['fusion_layer.py',
+                '--cnn_features', os.path.join(dep_dirs['cnn_features'], 'cnn_features'),
+                '--rnn_features', os.path.join(dep_dirs['rnn_features'], 'rnn_features'),
+                '--save_model', os.path.join(out_dir, 'fusion_model.keras'),
+                '--plot_prefix', os.path.join(out_dir, 'fusion'),
+                *args.fusion_args]
+
+    return [
+        Stage('ingest', ['patients.json'], code=('mri_images_cnn.py', 'volume_cache.py'),
+              inputs=ingest_inputs, build=ingest),
+        Stage('clinical_encode', ['clinical_encoder.json'], code=('clinical_data_rnn.py',),
+              inputs=xlsx_inputs, command=encode_command),
+        Stage('cnn_features', ['cnn_features'], deps=('ingest',),
+              code=('mri_images_cnn.py', 'volume_cache.py', 'feature_shards.py', 'feature_store.py'),
+              params=args.cnn_args, inputs=lambda: argument_files(args.cnn_args), command=cnn_command),
+        Stage('rnn_features', ['rnn_features'], deps=('clinical_encode',),
+              code=('clinical_data_rnn.py', 'tf_input.py', 'evaluation.py', 'feature_store.py'),
+              params=args.rnn_args, inputs=rnn_inputs, command=rnn_command),
+        Stage('fusion', ['fusion_model.keras'], deps=('cnn_features', 'rnn_features'),
+              code=('fusion_layer.py', 'tf_input.py', 'tf_workers.py', 'evaluation.py', 'feature_store.py'),
+              params=args.fusion_args, inputs=lambda: argument_files(args.fusion_args), command=fusion_command),
+    ]
+
+
+"""Running"""
+
+def artifact_dir(work_dir, name, key):
+    return os.path.join(work_dir, name, key[:16])
+
+
+def is_built(out_dir, key):
+    record = _read_json(os.path.join(out_dir, RECORD))
+    return record is not None and record['key'] == key
+
+
+def build_artifact(stage_, key, payload, out_dir, dep_dirs):
+    """Build one stage into a temporary directory and move it into place; return its record"""
+    tmp_dir = f"{out_dir}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    start = time.perf_counter()
+    with stage(f"build_{stage_.name}", key=key[:16]):
+        if stage_.build is not None:
+            stage_.build(tmp_dir, dep_dirs)
+        else:
+            script, *script_args = stage_.command(tmp_dir, dep_dirs)
+            with open(os.path.join(tmp_dir, LOG), 'w') as log:
+                result = subprocess.run([sys.executable, os.path.join(ROOT, script), *script_args],
+                                        stdout=log, stderr=subprocess.STDOUT)
+            if result.returncode != 0:
+                failed_log = os.path.join(os.path.dirname(out_dir), f"failed-{key[:16]}.log")
+                os.replace(os.path.join(tmp_dir, LOG), failed_log)
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                raise RuntimeError(f"{script} exited with status {result.returncode}, see {failed_log}")
+    record = {
+        'key': key,
+        'payload': payload,
+        'digest': artifact_digest(tmp_dir, stage_.outputs),
+        'seconds': time.perf_counter() - start,
+        'built': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+    _write_json(os.path.join(tmp_dir, RECORD), record)
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.replace(tmp_dir, out_dir)
+    return record
+
+
+def run_pipeline(stages, work_dir, jobs=2, force=(), dry_run=False):
+    """
+    Build every stale stage, dependencies first and up to jobs at a time
+
+    Returns {stage: {'status', 'dir', 'seconds', 'reason'}}, status being one of
+    'up to date', 'built', 'failed', 'skipped' (a dependency failed) or, with
+    dry_run, 'stale' and 'pending' (waits on a stale dependency).
+    """
+    latest = (_read_json(os.path.join(work_dir, LATEST)) or {}).get('stages', {})
+    pending = {s.name: s for s in stages}
+    results = {}
+    digests = {}
+    dirs = {}
+    running = {}
+
+    def previous_payload(name):
+        if name not in latest:
+            return None
+        record = _read_json(os.path.join(latest[name], RECORD))
+        return record and record['payload']
+
+    def schedule(pool):
+        progress = True
+        while progress:
+            progress = False
+            for name, stage_ in list(pending.items()):
+                if any(results.get(dep, {}).get('status') in ('failed', 'skipped') for dep in stage_.deps):
+                    results[name] = {'status': 'skipped', 'reason': 'a dependency failed'}
+                elif any(results.get(dep, {}).get('status') in ('stale', 'pending') for dep in stage_.deps):
+                    results[name] = {'status': 'pending', 'reason': 'waits on a stale dependency'}
+                elif all(dep in digests for dep in stage_.deps):
+                    payload = stage_.key_payload(digests)
+                    key = stage_key(payload)
+                    out_dir = artifact_dir(work_dir, name, key)
+                    dep_dirs = {dep: dirs[dep] for dep in stage_.deps}
+                    if name not in force and is_built(out_dir, key):
+                        record = _read_json(os.path.join(out_dir, RECORD))
+                        digests[name], dirs[name] = record['digest'], out_dir
+                        results[name] = {'status': 'up to date', 'dir': out_dir}
+                        logger.info(f"{name}: up to date ({out_dir})")
+                    else:
+                        reason = "forced" if name in force else explain(previous_payload(name), payload)
+                        if dry_run:
+                            results[name] = {'status': 'stale', 'dir': out_dir, 'reason': reason}
+                        else:
+                            logger.info(f"{name}: building ({reason})")
+                            future = pool.submit(build_artifact, stage_, key, payload, out_dir, dep_dirs)
+                            running[future] = (name, out_dir, reason)
+                else:
+                    continue
+                del pending[name]
+                progress = True
+
+    with ThreadPoolExecutor(max(1, jobs)) as pool:
+        schedule(pool)
+        while running:
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name, out_dir, reason = running.pop(future)
+                try:
+                    record = future.result()
+                except Exception as e:
+                    results[name] = {'status': 'failed', 'reason': str(e)}
+                    logger.error(f"{name}: failed: {e}")
+                    continue
+                digests[name], dirs[name] = record['digest'], out_dir
+                results[name] = {'status': 'built', 'dir': out_dir, 'seconds': record['seconds'], 'reason': reason}
+                logger.info(f"{name}: built in {record['seconds']:.1f}s ({out_dir})")
+            schedule(pool)
+
+    if not dry_run:
+        latest.update({name: dirs[name] for name in dirs})
+        os.makedirs(work_dir, exist_ok=True)
+        _write_json(os.path.join(work_dir, LATEST), {'stages': latest})
+    return results
+
+
+def prune(work_dir, stage_names, keep):
+    """Remove every artifact of the given stages except the directories in keep"""
+    removed = 0
+    for name in stage_names:
+        stage_dir = os.path.join(work_dir, name)
+        if not os.path.isdir(stage_dir):
+            continue
+        for entry in os.listdir(stage_dir):
+            path = os.path.join(stage_dir, entry)
+            if path not in keep:
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+                removed += 1
+    return removed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the CNN/RNN/fusion pipeline, rebuilding only stale stages")
+    parser.add_argument('--images_dir', default=None, help="root of the DICOM series (mri_images_cnn default if unset)")
+    parser.add_argument('--masks_dir', default=None, help="root of the NRRD masks (also lists the patients)")
+    parser.add_argument('--clinical_csv', default=None, help="CSV with Name,Recurrence columns")
+    parser.add_argument('--clinical_xlsx', default='./Clinical_and_Other_Features.xlsx',
+                        help="clinical spreadsheet (default: %(default)s)")
+    parser.add_argument('--work_dir', default='pipeline_runs', help="artifact and cache root (default: %(default)s)")
+    parser.add_argument('--cnn_args', default='',
+                        help="extra mri_images_cnn.py arguments, e.g. --cnn_args=\"--use_mask\"")
+    parser.add_argument('--rnn_args', default='',
+                        help="extra clinical_data_rnn.py arguments, e.g. --rnn_args=\"--epochs 50\"")
+    parser.add_argument('--fusion_args', default='',
+                        help="extra fusion_layer.py arguments, e.g. --fusion_args=\"--folds 0\"")
+    parser.add_argument('--jobs', type=int, default=2, help="stages built at the same time (default: %(default)s)")
+    parser.add_argument('--force', nargs='+', default=[], metavar='STAGE', help="rebuild these stages regardless")
+    parser.add_argument('--dry_run', action='store_true', help="only report which stages are stale")
+    parser.add_argument('--prune', action='store_true',
+                        help="after a successful run, delete the artifacts the run did not use")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args(argv)
+    instrumentation.setup(args.profile, args.log_level)
+    if args.log_level:
+        # The stage scripts read it from the environment
+        os.environ[instrumentation.LOG_LEVEL_ENV] = args.log_level
+
+    for name in ('images_dir', 'masks_dir', 'clinical_csv', 'clinical_xlsx', 'work_dir'):
+        if getattr(args, name):
+            setattr(args, name, os.path.abspath(getattr(args, name)))
+    args.cnn_args, args.rnn_args, args.fusion_args = (shlex.split(a) for a in
+                                                      (args.cnn_args, args.rnn_args, args.fusion_args))
+
+    stages = build_stages(args)
+    names = [s.name for s in stages]
+    unknown = set(args.force) - set(names)
+    if unknown:
+        raise SystemExit(f"Unknown stage(s) {', '.join(sorted(unknown))}, choose from {', '.join(names)}")
+
+    results = run_pipeline(stages, args.work_dir, jobs=args.jobs, force=set(args.force), dry_run=args.dry_run)
+
+    logger.info(f"{'stage':<16} {'status':<11} {'seconds':>8}  detail")
+    for name in names:
+        r = results[name]
+        seconds = f"{r['seconds']:.1f}" if 'seconds' in r else ''
+        logger.info(f"{name:<16} {r['status']:<11} {seconds:>8}  {r.get('reason') or r.get('dir', '')}")
+
+    ok = all(r['status'] in ('up to date', 'built', 'stale', 'pending') for r in results.values())
+    if args.prune and ok and not args.dry_run:
+        keep = {r['dir'] for r in results.values()}
+        logger.info(f"Pruned {prune(args.work_dir, names, keep)} unused artifacts")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,425 @@
+# -*- coding: utf-8 -*-
+"""Hyperparameter sweep over build_advanced_rnn_model with successive halving.
+
+Configurations are sampled from SEARCH_SPACE and trained in parallel CPU worker
+processes (see tf_workers.py). Every trial first trains for min_epochs; at the end
+of each rung only the best 1/eta of the trials, ranked by their best val_loss so far,
+are promoted and continue from their checkpoint for eta times as many epochs, up
+to max_epochs. The rest are pruned, so most of the budget goes to the promising
+configurations:
+
+    rung   epochs   trials still training (200 trials, eta=3)
+    0      3        200
+    1      9        66
+    2      27       22
+    3      81       7
+
+Everything is recorded in a SQLite study database (trials, per-epoch val_loss), and
+model state is checkpointed per trial after every rung. Running the same command
+again resumes an interrupted sweep: finished rungs are not retrained, only the
+trials that were in flight restart from their last checkpoint. A larger --trials
+adds new configurations to an existing study.
+
+Usage:
+    python rnn_sweep.py --input Clinical_and_Other_Features.xlsx --study rnn_sweep.db \\
+        --trials 300 --jobs 8
+    python rnn_sweep.py --study rnn_sweep.db --report
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import sqlite3
+import argparse
+from concurrent.futures import as_completed
+
+import numpy as np
+
+import instrumentation
+from instrumentation import get_logger
+from tf_input import make_dataset
+from tf_workers import tf_process_pool
+
+logger = get_logger('rnn_sweep')
+
+# Hyperparameters of build_advanced_rnn_model and how to sample them
+SEARCH_SPACE = {
+    'rnn_type': ('choice', ['LSTM', 'GRU', 'Dense']),  # 'Dense' ignores bidirectional
+    'units': ('choice', [16, 32, 64, 128, 256]),
+    'bidirectional': ('choice', [True, False]),
+    'dropout_rate': ('uniform', 0.0, 0.6),
+    'l1_reg': ('loguniform', 1e-6, 1e-2),
+    'l2_reg': ('loguniform', 1e-6, 1e-2),
+}
+
+# Bump when SEARCH_SPACE changes, the sampler replay of older studies no longer matches
+STUDY_VERSION = 2
+
+"""Search space"""
+
+def sample_config(rng, space=SEARCH_SPACE):
+    """Draw one configuration; floats are rounded to 3 significant digits so repeats dedupe"""
+    config = {}
+    for name, (kind, *args) in space.items():
+        if kind == 'choice':
+            config[name] = args[0][rng.integers(len(args[0]))]
+        elif kind == 'uniform':
+            config[name] = float(f"{rng.uniform(*args):.3g}")
+        elif kind == 'loguniform':
+            config[name] = float(f"{math.exp(rng.uniform(math.log(args[0]), math.log(args[1]))):.3g}")
+        else:
+            raise ValueError(f"Unknown distribution for {name}: {kind}")
+    return config
+
+
+def rung_budgets(min_epochs, max_epochs, eta):
+    """Cumulative epochs at the end of each rung, e.g. (3, 81, 3) -> [3, 9, 27, 81]"""
+    if min_epochs < 1 or max_epochs < min_epochs or eta < 2:
+        raise ValueError("need 1 <= min_epochs <= max_epochs and eta >= 2")
+    budgets = []
+    epochs = min_epochs
+    while epochs < max_epochs:
+        budgets.append(epochs)
+        epochs *= eta
+    budgets.append(max_epochs)
+    return budgets
+
+
+"""Study database"""
+
+class Study:
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS trials (
+            trial_id INTEGER PRIMARY KEY,
+            params TEXT NOT NULL UNIQUE,
+            state TEXT NOT NULL DEFAULT 'active',  -- active, pruned, complete or failed
+            rung INTEGER NOT NULL DEFAULT -1,      -- last finished rung
+            epochs INTEGER NOT NULL DEFAULT 0,     -- epochs trained so far
+            best_val_loss REAL,
+            val_auc REAL,
+            seconds REAL NOT NULL DEFAULT 0,
+            error TEXT
+        );
+        CREATE TABLE IF NOT EXISTS history (
+            trial_id INTEGER NOT NULL,
+            epoch INTEGER NOT NULL,
+            val_loss REAL,
+            PRIMARY KEY (trial_id, epoch)
+        );
+    """
+
+    def __init__(self, path):
+        """path: SQLite file, created if missing; checkpoints go to <path stem>_checkpoints/"""
+        self.path = path
+        self.checkpoint_dir = os.path.splitext(path)[0] + "_checkpoints"
+        self.db = sqlite3.connect(path)
+        self.db.executescript(self.SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def check_settings(self, settings):
+        """Store the sweep settings on first use, refuse to resume with different ones"""
+        settings = dict(settings, version=STUDY_VERSION)
+        stored = dict(self.db.execute("SELECT key, value FROM meta"))
+        if not stored:
+            with self.db:
+                self.db.executemany("INSERT INTO meta VALUES (?, ?)",
+                                    [(key, json.dumps(value)) for key, value in settings.items()])
+            return
+        stored = {key: json.loads(value) for key, value in stored.items()}
+        changed = {key: (stored.get(key), value) for key, value in settings.items() if stored.get(key) != value}
+        if changed:
+            raise ValueError(f"{self.path} was created with different settings {changed} "
+                             f"(stored, requested); use a new --study")
+
+    def add_trials(self, n_trials, seed, space=SEARCH_SPACE):
+        """
+        Grow the study to n_trials distinct configurations
+
+        The sampler is replayed from the same seed, so a resumed study gets the same
+        configurations back and a larger n_trials only appends new ones.
+        """
+        rng = np.random.default_rng(seed)
+        with self.db:
+            for _ in range(n_trials * 100):
+                if self.count() >= n_trials:
+                    break
+                params = json.dumps(sample_config(rng, space), sort_keys=True)
+                self.db.execute("INSERT OR IGNORE INTO trials (params) VALUES (?)", (params,))
+        return self.count()
+
+    def count(self):
+        return self.db.execute("SELECT COUNT(*) FROM trials").fetchone()[0]
+
+    def checkpoint(self, trial_id, epochs):
+        # Named by epoch count, so a checkpoint written just before an interruption can't be
+        # mistaken for the state the database last recorded
+        return os.path.join(self.checkpoint_dir, f"trial_{trial_id}.e{epochs}.keras")
+
+    def pending(self, rung):
+        """(trial_id, params, epochs) of the active trials that still have to finish rung"""
+        rows = self.db.execute(
+            "SELECT trial_id, params, epochs FROM trials WHERE state = 'active' AND rung < ? ORDER BY trial_id",
+            (rung,))
+        return [(trial_id, json.loads(params), epochs) for trial_id, params, epochs in rows]
+
+    def record(self, trial_id, rung, final, result):
+        """Store one finished rung of a trial and drop the checkpoint it started from"""
+        losses = result['val_losses']
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO history VALUES (?, ?, ?)",
+                                [(trial_id, result['start_epoch'] + i, loss) for i, loss in enumerate(losses)])
+            best = self.db.execute("SELECT MIN(val_loss) FROM history WHERE trial_id = ?", (trial_id,)).fetchone()[0]
+            self.db.execute(
+                "UPDATE trials SET state = ?, rung = ?, epochs = ?, best_val_loss = ?, val_auc = ?, "
+                "seconds = seconds + ? WHERE trial_id = ?",
+                ('complete' if final else 'active', rung, result['start_epoch'] + len(losses),
+                 best, result['val_auc'], result['seconds'], trial_id))
+        if result['start_epoch'] > 0 and os.path.exists(self.checkpoint(trial_id, result['start_epoch'])):
+            os.remove(self.checkpoint(trial_id, result['start_epoch']))
+
+    def fail(self, trial_id, error):
+        with self.db:
+            self.db.execute("UPDATE trials SET state = 'failed', error = ? WHERE trial_id = ?",
+                            (str(error)[:1000], trial_id))
+
+    def promote(self, rung, budget, eta):
+        """
+        Successive-halving cut at the end of a rung: rank every trial that reached the
+        rung by its best val_loss within the rung's epoch budget, keep the top 1/eta
+        and prune the other still-active trials at this rung. Returns the kept ids.
+        """
+        rows = self.db.execute(
+            "SELECT t.trial_id, MIN(h.val_loss) AS loss FROM trials t JOIN history h USING (trial_id) "
+            "WHERE t.rung >= ? AND t.state != 'failed' AND h.epoch < ? "
+            "GROUP BY t.trial_id ORDER BY loss IS NULL, loss, t.trial_id", (rung, budget)).fetchall()
+        keep = [trial_id for trial_id, _ in rows[:max(1, len(rows) // eta)]]
+        pruned = [trial_id for trial_id, in self.db.execute(
+            "SELECT trial_id FROM trials WHERE state = 'active' AND rung = ?", (rung,)) if trial_id not in keep]
+        with self.db:
+            self.db.executemany("UPDATE trials SET state = 'pruned' WHERE trial_id = ?",
+                                [(trial_id,) for trial_id in pruned])
+        # Pruned trials never resume, their checkpoints are just disk usage
+        for trial_id in pruned:
+            for name in os.listdir(self.checkpoint_dir):
+                if name.startswith(f"trial_{trial_id}."):
+                    os.remove(os.path.join(self.checkpoint_dir, name))
+        return keep
+
+    def best(self, n=10):
+        """Top n trials by best val_loss as dicts (params decoded)"""
+        rows = self.db.execute(
+            "SELECT trial_id, params, state, epochs, best_val_loss, val_auc, seconds FROM trials "
+            "WHERE best_val_loss IS NOT NULL ORDER BY rung DESC, best_val_loss LIMIT ?", (n,))
+        keys = ('trial_id', 'params', 'state', 'epochs', 'best_val_loss', 'val_auc', 'seconds')
+        return [dict(zip(keys, row), params=json.loads(row[1])) for row in rows]
+
+
+def best_params(study_path):
+    """Configuration of the best trial in a study, for build_advanced_rnn_model(**params)"""
+    study = Study(study_path)
+    try:
+        best = study.best(1)
+    finally:
+        study.close()
+    if not best:
+        raise ValueError(f"{study_path} has no finished trials")
+    return best[0]['params']
+
+
+"""Trials"""
+
+# Training/validation arrays of a sweep worker, set once by _init_sweep_worker
+_sweep_data = None
+
+
+def _init_sweep_worker(X_train, y_train, X_val, y_val):
+    global _sweep_data
+    _sweep_data = (X_train, y_train, X_val, y_val)
+
+
+def _train_trial(trial_id, params, start_epoch, stop_epoch, resume_from, save_to, batch_size, seed):
+    """Train one trial from start_epoch to stop_epoch, resuming from its checkpoint"""
+    import tensorflow as tf
+    from sklearn.metrics import roc_auc_score
+
+    from clinical_data_rnn import build_advanced_rnn_model
+
+    X_train, y_train, X_val, y_val = _sweep_data
+    start = time.perf_counter()
+    tf.keras.backend.clear_session()
+    tf.keras.utils.set_random_seed(seed + trial_id * 1000 + start_epoch)
+
+    if start_epoch > 0:
+        # .keras checkpoints keep the optimizer state, so training continues seamlessly
+        model = tf.keras.models.load_model(resume_from)
+    else:
+        model = build_advanced_rnn_model(input_shape=X_train.shape[1:], **params)
+    history = model.fit(make_dataset(X_train, y_train, batch_size=batch_size, shuffle=True),
+                        validation_data=make_dataset(X_val, y_val, batch_size=batch_size),
+                        initial_epoch=start_epoch, epochs=stop_epoch, verbose=0)
+
+    tmp_path = save_to[:-len(".keras")] + ".tmp.keras"
+    model.save(tmp_path)
+    os.replace(tmp_path, save_to)
+
+    prob = model.predict(X_val, verbose=0).ravel()
+    try:
+        val_auc = float(roc_auc_score(y_val, prob))
+    except ValueError:
+        # Only one class in the validation split
+        val_auc = None
+    losses = [float(loss) if np.isfinite(loss) else None for loss in history.history['val_loss']]
+    return {
+        'trial_id': trial_id,
+        'start_epoch': start_epoch,
+        'val_losses': losses,
+        'val_auc': val_auc,
+        'seconds': time.perf_counter() - start,
+    }
+
+
+def run_sweep(study, data, budgets, eta, batch_size=32, n_jobs=None, seed=42):
+    """
+    Run (or resume) successive halving over every trial in the study
+
+    Parameters:
+    -----------
+    study : Study
+        Study holding the trials to run
+    data : tuple
+        (X_train_seq, y_train, X_val_seq, y_val) as float32 arrays
+    budgets : list of int
+        Cumulative epochs per rung, see rung_budgets
+    eta : int
+        Keep the best 1/eta of the trials at every rung
+    n_jobs : int, optional
+        Parallel trials (default: all cores); 1 trains in this process
+    """
+    os.makedirs(study.checkpoint_dir, exist_ok=True)
+    n_jobs = n_jobs or os.cpu_count() or 1
+    pool = None
+    if n_jobs == 1:
+        _init_sweep_worker(*data)
+    else:
+        pool = tf_process_pool(n_jobs, initializer=_init_sweep_worker, initargs=data)
+
+    try:
+        for rung, budget in enumerate(budgets):
+            final = rung == len(budgets) - 1
+            pending = study.pending(rung)
+            start = time.perf_counter()
+            logger.info(f"Rung {rung}: {len(pending)} trials to train up to {budget} epochs")
+
+            jobs = [(trial_id, params, epochs, budget, study.checkpoint(trial_id, epochs),
+                     study.checkpoint(trial_id, budget), batch_size, seed)
+                    for trial_id, params, epochs in pending]
+            if pool is None:
+                results = (_call(_train_trial, *job) for job in jobs)
+            else:
+                futures = {pool.submit(_train_trial, *job): job[0] for job in jobs}
+                results = (_result(future, futures[future]) for future in as_completed(futures))
+
+            # Recorded as they finish, so an interrupted rung only retrains the trials in flight
+            for done, (trial_id, result) in enumerate(results, 1):
+                if isinstance(result, Exception):
+                    logger.warning(f"  trial {trial_id} failed: {result}")
+                    study.fail(trial_id, result)
+                    continue
+                study.record(trial_id, rung, final, result)
+                best = min((loss for loss in result['val_losses'] if loss is not None), default=float('nan'))
+                logger.info(f"  [{done}/{len(jobs)}] trial {trial_id}: best val_loss {best:.4f} "
+                            f"({result['seconds']:.1f}s)")
+
+            if not final:
+                keep = study.promote(rung, budget, eta)
+                logger.info(f"Rung {rung} done in {time.perf_counter() - start:.1f}s, "
+                            f"promoting {len(keep)} trials")
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+
+def _call(fn, *args):
+    try:
+        return args[0], fn(*args)
+    except Exception as e:
+        return args[0], e
+
+
+def _result(future, trial_id):
+    try:
+        return trial_id, future.result()
+    except Exception as e:
+        return trial_id, e
+
+
+def print_report(study, n=10):
+    print(f"{'trial':>5} {'state':>8} {'epochs':>6} {'val_loss':>9} {'val_auc':>7} {'time':>7}  params")
+    for trial in study.best(n):
+        auc = f"{trial['val_auc']:.3f}" if trial['val_auc'] is not None else "-"
+        print(f"{trial['trial_id']:>5} {trial['state']:>8} {trial['epochs']:>6} {trial['best_val_loss']:>9.4f} "
+              f"{auc:>7} {trial['seconds']:>6.0f}s  {json.dumps(trial['params'], sort_keys=True)}")
+
+
+"""Script"""
+
+def load_sweep_data(input_path, snapshot_dir=None):
+    """Encode the clinical sheet like clinical_data_rnn.main and return the train/val sequences"""
+    from clinical_data_rnn import (load_clinical_table, find_target_column, drop_metadata_rows,
+                                   ClinicalEncoder, encode_clinical_data, split_rnn_sequences)
+
+    clinical_df = drop_metadata_rows(load_clinical_table(input_path, snapshot_dir=snapshot_dir))
+    target_col = find_target_column(clinical_df)
+    encoded_df = encode_clinical_data(clinical_df, encoder=ClinicalEncoder(target_col=target_col).fit(clinical_df))
+    _, _, (X_train, y_train), (X_val, y_val), _ = split_rnn_sequences(encoded_df, target_col)
+    return (X_train.astype(np.float32), np.asarray(y_train, dtype=np.float32),
+            X_val.astype(np.float32), np.asarray(y_val, dtype=np.float32))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Successive-halving hyperparameter sweep of the clinical RNN")
+    parser.add_argument('--input', default='./Clinical_and_Other_Features.xlsx',
+                        help="clinical spreadsheet (default: %(default)s)")
+    parser.add_argument('--snapshot_dir', default=None,
+                        help="directory for the Parquet snapshot of the spreadsheet (default: next to --input)")
+    parser.add_argument('--study', default='rnn_sweep.db', help="SQLite study database (default: %(default)s)")
+    parser.add_argument('--trials', type=int, default=200, help="number of configurations in the study")
+    parser.add_argument('--min_epochs', type=int, default=3, help="epochs of the first rung")
+    parser.add_argument('--max_epochs', type=int, default=81, help="epochs of the surviving trials")
+    parser.add_argument('--eta', type=int, default=3, help="keep the best 1/eta of the trials at every rung")
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--jobs', type=int, default=None, help="parallel trials (default: all cores)")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--report', action='store_true', help="only print the best trials of --study")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args(argv)
+    instrumentation.setup(args.profile, args.log_level)
+
+    study = Study(args.study)
+    try:
+        if not args.report:
+            from clinical_data_rnn import file_sha1
+
+            study.check_settings({
+                'min_epochs': args.min_epochs, 'max_epochs': args.max_epochs, 'eta': args.eta,
+                'batch_size': args.batch_size, 'seed': args.seed, 'input_sha1': file_sha1(args.input),
+            })
+            logger.info(f"{study.add_trials(args.trials, args.seed)} trials in {args.study}")
+            data = load_sweep_data(args.input, args.snapshot_dir)
+            start = time.perf_counter()
+            run_sweep(study, data, rung_budgets(args.min_epochs, args.max_epochs, args.eta), args.eta,
+                      batch_size=args.batch_size, n_jobs=args.jobs, seed=args.seed)
+            logger.info(f"Sweep finished in {time.perf_counter() - start:.1f}s")
+        print_report(study)
+    finally:
+        study.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
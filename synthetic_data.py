@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+"""Synthetic cohorts in the on-disk layout the pipeline reads.
+
+Generates, for N patients named Breast_MRI_000, Breast_MRI_001, ...:
+
+    images/<patient>/<study>/T1_IMGS/NNN.dcm              one uint16 DICOM series (buildPathToSeries)
+    masks/<patient>/Segmentation_<patient>_Breast.seg.nrrd  the tumour segmentation (buildPathToNrrd)
+    clinical.csv                                            Name,Recurrence labels (trawlMyRecurrences)
+    Clinical_and_Other_Features.xlsx                        a clinical sheet with the real sheet's shape
+
+Each series is a noisy breast-shaped background with a brighter ellipsoid tumour;
+the mask is that ellipsoid. Recurrent patients get slightly larger, brighter
+tumours so the models have some signal to fit. The clinical sheet has the three
+header rows of the original (group, column name, coding) and the same mix of
+numeric, coded categorical and free-text columns; --clinical_rows can be larger
+than --patients to time the clinical stages at cohort scale. With --template the
+header rows are copied from a real sheet and every column is resampled from its
+own values, so no real patient row is reproduced.
+
+Everything is deterministic in --seed: pixels, masks, DICOM UIDs, labels and
+sheet cells (only the xlsx's own save timestamps differ between runs). Each
+patient only depends on the seed and its index, so --workers does not change
+the output. A synthetic.json manifest
+records the parameters; generate() reuses a directory whose manifest matches.
+
+Usage:
+    python synthetic_data.py --output synthetic/ --patients 16 --size 256 --depth 32 --clinical_rows 1000
+    python synthetic_data.py --output synthetic/ --template Clinical_and_Other_Features.xlsx --clinical_rows 5000
+"""
+
+import os
+import sys
+import csv
+import json
+import shutil
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+MANIFEST = "synthetic.json"
+# Bump when the generated data changes so old directories are regenerated
+SYNTHETIC_VERSION = 2
+
+CLINICAL_SHEET = "Clinical_and_Other_Features.xlsx"
+TARGET_NAME = "Recurrence event(s)"
+TARGET_CODING = "{0 = no, 1 = yes}"
+
+
+def patient_id(index):
+    return f"Breast_MRI_{index:03d}"
+
+
+def draw_labels(n, positive_rate, seed):
+    """Recurrence labels of patients 0..n-1, shared by the imaging and clinical data"""
+    rng = np.random.default_rng([seed, 0])
+    return (rng.random(n) < positive_rate).astype(int)
+
+
+"""Imaging"""
+
+def synthetic_volume(rng, label, size=256, depth=32):
+    """Return (volume uint16 (Z, H, W), mask uint8 (Z, H, W)) for one patient"""
+    zz, yy, xx = np.meshgrid(np.linspace(-1, 1, depth), np.linspace(-1, 1, size), np.linspace(-1, 1, size),
+                             indexing='ij', sparse=True)
+    # Two breast lobes over a dark background
+    tissue = np.zeros((depth, size, size), dtype=np.float32)
+    for cx in (-0.45, 0.45):
+        tissue += ((xx - cx) ** 2 / 0.4 ** 2 + (yy - 0.2) ** 2 / 0.7 ** 2) <= 1
+    volume = 150 + 700 * np.minimum(tissue, 1) + rng.normal(0, 60, tissue.shape).astype(np.float32)
+
+    # Tumour inside one lobe, larger and brighter on recurrence
+    radius = rng.uniform(0.08, 0.16, 3) * (1.25 if label else 1.0)
+    radius[0] = max(radius[0] * 4, 2.5 / depth)  # at least a few slices thick
+    centre = (rng.uniform(-0.4, 0.4), rng.uniform(0.0, 0.4), rng.choice([-0.45, 0.45]) + rng.uniform(-0.15, 0.15))
+    mask = ((zz - centre[0]) ** 2 / radius[0] ** 2 + (yy - centre[1]) ** 2 / radius[1] ** 2
+            + (xx - centre[2]) ** 2 / radius[2] ** 2) <= 1
+    volume[mask] += rng.uniform(900, 1300) + (300 if label else 0)
+    return np.clip(volume, 0, 65535).astype(np.uint16), mask.astype(np.uint8)
+
+
+def write_dicom_series(volume, series_dir, patient, seed=0):
+    """Write one MR slice file per Z plane (uncompressed, explicit VR little endian)"""
+    import pydicom
+    from pydicom.dataset import Dataset, FileMetaDataset
+    from pydicom.uid import ExplicitVRLittleEndian, MRImageStorage, generate_uid
+
+    os.makedirs(series_dir, exist_ok=True)
+    # UIDs are derived from the seed and patient, so regenerating gives byte-identical files
+    study_uid = generate_uid(entropy_srcs=[str(seed), patient, 'study'])
+    series_uid = generate_uid(entropy_srcs=[str(seed), patient, 'series'])
+    for z, pixels in enumerate(volume):
+        meta = FileMetaDataset()
+        meta.MediaStorageSOPClassUID = MRImageStorage
+        meta.MediaStorageSOPInstanceUID = generate_uid(entropy_srcs=[str(seed), patient, str(z)])
+        meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+        ds = Dataset()
+        ds.file_meta = meta
+        ds.SOPClassUID = meta.MediaStorageSOPClassUID
+        ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+        ds.Modality = 'MR'
+        ds.PatientID = patient
+        ds.StudyInstanceUID = study_uid
+        ds.SeriesInstanceUID = series_uid
+        ds.SeriesDescription = 'ax t1'
+        ds.InstanceNumber = z + 1
+        ds.ImagePositionPatient = [0.0, 0.0, float(z)]
+        ds.PixelSpacing = [0.7, 0.7]
+        ds.SliceThickness = 1.0
+        ds.Rows, ds.Columns = pixels.shape
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.BitsAllocated = ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 0
+        ds.PixelData = np.ascontiguousarray(pixels).tobytes()
+        pydicom.dcmwrite(os.path.join(series_dir, f"{z + 1:03d}.dcm"), ds, enforce_file_format=True)
+
+
+def write_nrrd_mask(mask, nrrd_path):
+    import SimpleITK as sitk
+
+    os.makedirs(os.path.dirname(nrrd_path), exist_ok=True)
+    sitk.WriteImage(sitk.GetImageFromArray(mask), nrrd_path, useCompression=True)
+
+
+def write_patient(output, index, label, size, depth, seed, with_mask):
+    """Write patient index's series (and mask) and return its patient id"""
+    patient = patient_id(index)
+    rng = np.random.default_rng([seed, 1, index])
+    volume, mask = synthetic_volume(rng, label, size=size, depth=depth)
+    study = f"01-01-1990-NA-MRI BREAST BILATERAL WWO-{10000 + index}"
+    write_dicom_series(volume, os.path.join(output, 'images', patient, study, 'T1_IMGS'), patient, seed=seed)
+    # The masks directory lists the cohort, so patients without a mask still get a folder
+    mask_dir = os.path.join(output, 'masks', patient)
+    os.makedirs(mask_dir, exist_ok=True)
+    if with_mask:
+        write_nrrd_mask(mask, os.path.join(mask_dir, f"Segmentation_{patient}_Breast.seg.nrrd"))
+    return patient
+
+
+"""Clinical Sheet"""
+
+# (group header, number of numeric columns, number of coded categorical columns) in sheet order,
+# about the real sheet's 61 numeric / 36 categorical split
+CLINICAL_GROUPS = [
+    ('MRI Technical Information', 14, 6),
+    ('Demographics', 3, 4),
+    ('Tumor Characteristics', 10, 8),
+    ('MRI Findings', 12, 6),
+    ('Surgery', 4, 4),
+    ('Radiation Therapy', 3, 2),
+    ('Tumor Response', 4, 2),
+    ('Recurrence', 2, 0),
+    ('Follow Up', 8, 3),
+]
+
+
+def clinical_schema():
+    """[(group, name, coding, kind)] of the generated sheet; kind is id, numeric, category, text or target"""
+    schema = [('Patient Information', 'Patient ID', None, 'id')]
+    for group, n_numeric, n_category in CLINICAL_GROUPS:
+        first = len(schema)
+        for k in range(n_numeric):
+            schema.append((None, f"{group} measurement {k + 1}", None, 'numeric'))
+        for k in range(n_category):
+            levels = 2 + k % 4
+            coding = "{" + "\n".join(f"{v} = level {v}" for v in range(levels)) + "}"
+            schema.append((None, f"{group} category {k + 1}", coding, 'category'))
+        if group == 'MRI Technical Information':
+            schema.append((None, 'Image Position of Patient', None, 'text'))
+        if group == 'Recurrence':
+            schema.append((None, TARGET_NAME, TARGET_CODING, 'target'))
+        schema[first] = (group,) + schema[first][1:]
+    return schema
+
+
+def synthetic_clinical_frame(n_rows, labels, seed):
+    """Header rows + n_rows data rows of a sheet shaped like Clinical_and_Other_Features.xlsx"""
+    schema = clinical_schema()
+    columns = {}
+    for j, (_, name, coding, kind) in enumerate(schema):
+        rng = np.random.default_rng([seed, 2, j])
+        if kind == 'id':
+            values = [patient_id(i) for i in range(n_rows)]
+        elif kind == 'target':
+            values = labels
+        elif kind == 'numeric':
+            values = np.round(rng.lognormal(rng.uniform(0, 5), 0.5, n_rows), 1).astype(object)
+            values[rng.random(n_rows) < 0.05] = np.nan
+        elif kind == 'category':
+            levels = coding.count('=')
+            values = rng.integers(0, levels, n_rows).astype(object)
+            # The real sheet's not-calculated / not-present codes make these columns non-numeric
+            missing = rng.random(n_rows) < 0.05
+            values[missing] = rng.choice(['NC', 'NP'], missing.sum())
+        else:
+            xyz = rng.normal(0, 100, (n_rows, 3))
+            values = [f"{x:.1f} X {y:.1f} X {z:.1f}" for x, y, z in xyz]
+        columns[j] = values
+    header = pd.DataFrame([[s[0] for s in schema], [s[1] for s in schema], [s[2] for s in schema]])
+    return pd.concat([header, pd.DataFrame(columns)], ignore_index=True)
+
+
+def resampled_clinical_frame(template, n_rows, labels, seed):
+    """Template's three header rows + n_rows rows, each column drawn independently from its own values"""
+    raw = pd.read_excel(template, header=None)
+    header, data = raw.iloc[:3], raw.iloc[3:]
+    names = header.iloc[1].fillna('').astype(str)
+    columns = {}
+    for j in range(raw.shape[1]):
+        if j == 0:
+            columns[j] = [patient_id(i) for i in range(n_rows)]
+        elif TARGET_NAME in names.iloc[j]:
+            columns[j] = labels
+        else:
+            rng = np.random.default_rng([seed, 2, j])
+            values = data.iloc[:, j].to_numpy(dtype=object)
+            columns[j] = values[rng.integers(0, len(values), n_rows)]
+    return pd.concat([header.reset_index(drop=True), pd.DataFrame(columns)], ignore_index=True)
+
+
+def write_clinical_sheet(path, n_rows, labels, seed, template=None):
+    if template:
+        frame = resampled_clinical_frame(template, n_rows, labels, seed)
+    else:
+        frame = synthetic_clinical_frame(n_rows, labels, seed)
+    tmp_path = f"{path}.{os.getpid()}.tmp.xlsx"
+    frame.to_excel(tmp_path, header=False, index=False)
+    os.replace(tmp_path, path)
+
+
+"""Cohort"""
+
+def layout(output):
+    """Paths of a generated cohort, in the form the pipeline's CLIs take them"""
+    return {
+        'images_dir': os.path.join(output, 'images'),
+        'masks_dir': os.path.join(output, 'masks'),
+        'clinical_csv': os.path.join(output, 'clinical.csv'),
+        'clinical_xlsx': os.path.join(output, CLINICAL_SHEET),
+    }
+
+
+def read_manifest(output):
+    try:
+        with open(os.path.join(output, MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def generate(output, patients=16, size=256, depth=32, clinical_rows=None, positive_rate=0.2,
+             missing_masks=0.0, template=None, seed=0, workers=None, force=False):
+    """
+    Write a synthetic cohort to output and return its layout() paths
+
+    clinical_rows: rows of the clinical sheet (at least patients, defaults to patients)
+    positive_rate: fraction of recurrent patients
+    missing_masks: fraction of patients written without a segmentation
+    template: real clinical sheet whose headers and column values are resampled
+    workers: processes writing patients in parallel (None/0 writes them in this process)
+    force: regenerate even if output already holds a cohort with these parameters
+    """
+    clinical_rows = max(clinical_rows or patients, patients)
+    params = {
+        'version': SYNTHETIC_VERSION, 'patients': patients, 'size': size, 'depth': depth,
+        'clinical_rows': clinical_rows, 'positive_rate': positive_rate, 'missing_masks': missing_masks,
+        'template': os.path.abspath(template) if template else None, 'seed': seed,
+    }
+    paths = layout(output)
+    if not force and read_manifest(output) == params:
+        return paths
+
+    for sub in ('images', 'masks'):
+        shutil.rmtree(os.path.join(output, sub), ignore_errors=True)
+    os.makedirs(output, exist_ok=True)
+
+    labels = draw_labels(clinical_rows, positive_rate, seed)
+    with_mask = np.random.default_rng([seed, 3]).random(patients) >= missing_masks
+    jobs = [(output, i, int(labels[i]), size, depth, seed, bool(with_mask[i])) for i in range(patients)]
+    if workers:
+        with ProcessPoolExecutor(workers) as pool:
+            ids = list(pool.map(write_patient, *zip(*jobs)))
+    else:
+        ids = [write_patient(*job) for job in jobs]
+
+    with open(paths['clinical_csv'], 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Name', 'Recurrence'])
+        writer.writerows(zip(ids, labels[:patients].tolist()))
+    write_clinical_sheet(paths['clinical_xlsx'], clinical_rows, labels.tolist(), seed, template=template)
+
+    with open(os.path.join(output, MANIFEST), 'w') as f:
+        json.dump(params, f, indent=2)
+    return paths
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a synthetic DICOM/NRRD/clinical cohort")
+    parser.add_argument('--output', required=True, help="directory to write the cohort to")
+    parser.add_argument('--patients', type=int, default=16, help="patients with a DICOM series")
+    parser.add_argument('--size', type=int, default=256, help="slice height/width in pixels")
+    parser.add_argument('--depth', type=int, default=32, help="slices per series")
+    parser.add_argument('--clinical_rows', type=int, default=None,
+                        help="rows of the clinical sheet (defaults to --patients)")
+    parser.add_argument('--positive_rate', type=float, default=0.2, help="fraction of recurrent patients")
+    parser.add_argument('--missing_masks', type=float, default=0.0, help="fraction of patients without a mask")
+    parser.add_argument('--template', default=None, help="real clinical sheet to resample headers and values from")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=None, help="processes writing patients in parallel")
+    parser.add_argument('--force', action='store_true', help="regenerate even if the manifest matches")
+    args = parser.parse_args(argv)
+
+    paths = generate(args.output, patients=args.patients, size=args.size, depth=args.depth,
+                     clinical_rows=args.clinical_rows, positive_rate=args.positive_rate,
+                     missing_masks=args.missing_masks, template=args.template, seed=args.seed,
+                     workers=args.workers, force=args.force)
+    for name, path in paths.items():
+        print(f"{name:<14} {path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""Pre-baked, memory-mapped tensor store for the MRI series and masks.
+
+The ingestion stage fans the patient list out over a process pool, decodes every
+DICOM series and NRRD mask exactly once and appends them to a single flat float32
+file. A JSON index next to it maps patient id -> offset, shape and label, so
+MemmapMRIDataset can serve zero-copy np.memmap views instead of re-parsing DICOM
+on every access.
+
+Usage:
+    python tensor_store.py --images_dir data/images/ --masks_dir data/masks/ \\
+        --clinical_csv data/clinical.csv --output mri_store --workers 8
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+import instrumentation
+from instrumentation import get_logger, stage
+from mri_images_cnn import load_dicom_series, load_nrrd_mask, load_roi_box, crop_to_box, collect_patients
+from volume_cache import VolumeCache
+
+STORE_VERSION = 1
+DTYPE = np.float32
+
+logger = get_logger('tensor_store')
+
+"""Ingestion"""
+
+_worker_cache = None
+
+
+def _init_worker(cache_dir, threads):
+    global _worker_cache
+    # One torch thread per process, the pool already provides the parallelism
+    torch.set_num_threads(threads)
+    if cache_dir is not None:
+        _worker_cache = VolumeCache(cache_dir=cache_dir)
+
+
+def _decode_patient(patient, series_dir, mask_path, target_size, roi_margin=None):
+    with stage('decode_patient', patient=patient):
+        box = load_roi_box(mask_path, roi_margin, cache=_worker_cache) if roi_margin is not None else None
+        image = load_dicom_series(series_dir, target_size=target_size, cache=_worker_cache, roi=box).numpy()
+        mask = load_nrrd_mask(mask_path) if mask_path is not None else None
+        if mask is not None:
+            mask = (mask if box is None else crop_to_box(mask, box)).numpy()
+    return patient, image, mask
+
+
+def ingest(patients, output, workers=None, target_size=(224, 224), cache_dir=None, roi_margin=None):
+    """
+    Decode all patients in a process pool and write them to <output>.bin / <output>.json
+
+    patients: list of (patient, series_dir, mask_path or None, label) as from collect_patients
+    roi_margin: if set, images and masks are cropped to the mask bounding box (see BreastMRIDataset)
+    Returns the index dict that was written.
+    """
+    workers = workers or os.cpu_count()
+    data_path, index_path = output + ".bin", output + ".json"
+    labels = {patient: label for patient, _, _, label in patients}
+    entries = {}
+    offset = 0
+    start = time.perf_counter()
+
+    # Results arrive in completion order, the index keeps the offsets so order doesn't matter
+    with open(data_path + ".tmp", "wb") as f, ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker, initargs=(cache_dir, 1)) as pool:
+        futures = {pool.submit(_decode_patient, patient, series_dir, mask_path, tuple(target_size), roi_margin): patient
+                   for patient, series_dir, mask_path, _ in patients}
+        total = len(futures)
+        for done, future in enumerate(as_completed(futures), 1):
+            # Drop our reference so each decoded image and mask is freed once written,
+            # parent memory stays at a few patients instead of the whole cohort
+            submitted = futures.pop(future)
+            try:
+                patient, image, mask = future.result()
+            except Exception as e:
+                logger.warning(f"Skipping {submitted}: {e}")
+                continue
+            entry = {'label': labels[patient]}
+            for name, array in (('image', image), ('mask', mask)):
+                if array is None:
+                    entry[name] = None
+                    continue
+                array = np.ascontiguousarray(array, dtype=DTYPE)
+                f.write(array.tobytes())
+                entry[name] = {'offset': offset, 'shape': list(array.shape)}
+                offset += array.size
+            entries[patient] = entry
+            logger.debug(f"[{done}/{total}] {patient}")
+
+    index = {
+        'version': STORE_VERSION,
+        'dtype': np.dtype(DTYPE).name,
+        'target_size': list(target_size),
+        'roi_margin': roi_margin,
+        'length': offset,
+        'entries': entries,
+    }
+    # Both files go through .tmp and a rename, a crash never leaves a truncated index
+    with open(index_path + ".tmp", "w") as f:
+        json.dump(index, f, indent=1)
+    os.replace(data_path + ".tmp", data_path)
+    os.replace(index_path + ".tmp", index_path)
+
+    elapsed = time.perf_counter() - start
+    logger.info(f"Ingested {len(entries)} patients ({offset * np.dtype(DTYPE).itemsize / 1e6:.1f} MB) "
+                f"in {elapsed:.1f}s with {workers} workers")
+    return index
+
+
+"""Reading"""
+
+class TensorStore:
+    def __init__(self, path):
+        """path: store prefix, i.e. the --output given to the ingestion CLI"""
+        self.path = path
+        with open(path + ".json") as f:
+            self.index = json.load(f)
+        if self.index.get('version') != STORE_VERSION:
+            raise ValueError(f"Unsupported tensor store version: {self.index.get('version')}")
+        self.ids = list(self.index['entries'])
+        self._data = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getstate__(self):
+        # Never pickle the mapping itself (DataLoader workers re-open it lazily)
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
+
+    @property
+    def data(self):
+        if self._data is None:
+            # Copy-on-write mapping: views are writable for torch.from_numpy but never touch the file
+            self._data = np.memmap(self.path + ".bin", dtype=self.index['dtype'], mode='c',
+                                   shape=(self.index['length'],))
+        return self._data
+
+    def _view(self, ref):
+        if ref is None:
+            return None
+        count = int(np.prod(ref['shape']))
+        return self.data[ref['offset']:ref['offset'] + count].reshape(ref['shape'])
+
+    def get(self, patient):
+        """Return (image, mask or None, label) as zero-copy numpy views"""
+        entry = self.index['entries'][patient]
+        return self._view(entry['image']), self._view(entry['mask']), entry['label']
+
+
+class MemmapMRIDataset(Dataset):
+    def __init__(self, store, patient_ids=None, transform=None, use_mask=True):
+        """
+        store: TensorStore or store prefix written by the ingestion CLI
+        patient_ids: optional subset/order of patients (defaults to every patient in the store)
+        Items match BreastMRIDataset: (image, mask or None, label)
+        """
+        self.store = store if isinstance(store, TensorStore) else TensorStore(store)
+        self.patient_ids = list(patient_ids) if patient_ids is not None else self.store.ids
+        self.transform = transform
+        self.use_mask = use_mask
+
+    @property
+    def labels(self):
+        return [self.store.index['entries'][patient]['label'] for patient in self.patient_ids]
+
+    def __len__(self):
+        return len(self.patient_ids)
+
+    def __getitem__(self, idx):
+        image, mask, label = self.store.get(self.patient_ids[idx])
+        image = torch.from_numpy(image)
+        mask = torch.from_numpy(mask) if self.use_mask and mask is not None else None
+
+        if self.transform:
+            image = self.transform(image)
+            if mask is not None:
+                mask = self.transform(mask)
+
+        label = torch.tensor(label, dtype=torch.float32)
+        return image, mask, label
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Decode DICOM series and NRRD masks into a memory-mapped tensor store")
+    parser.add_argument('--images_dir', default=None, help="root of the DICOM series (defaults to mri_images_cnn.baselineLocationImgs)")
+    parser.add_argument('--masks_dir', default=None, help="root of the NRRD masks (defaults to mri_images_cnn.baselineLocationSeg)")
+    parser.add_argument('--clinical_csv', default=None, help="CSV with Name,Recurrence columns")
+    parser.add_argument('--output', default='mri_store', help="store prefix, writes <output>.bin and <output>.json")
+    parser.add_argument('--workers', type=int, default=None, help="number of decode processes (default: all cores)")
+    parser.add_argument('--target_size', type=int, nargs=2, default=(224, 224))
+    parser.add_argument('--cache_dir', default=None, help="optional VolumeCache directory shared by the workers")
+    parser.add_argument('--roi_margin', type=float, default=None,
+                        help="crop to the mask bounding box grown by this fraction (e.g. 0.1)")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args(argv)
+    instrumentation.setup(args.profile, args.log_level)
+
+    patients = collect_patients(args.images_dir, args.masks_dir, args.clinical_csv)
+    logger.info(f"Found {len(patients)} patients with a DICOM series")
+    with stage('ingest', patients=len(patients)):
+        ingest(patients, args.output, workers=args.workers,
+               target_size=tuple(args.target_size), cache_dir=args.cache_dir, roi_margin=args.roi_margin)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
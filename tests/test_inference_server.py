@@ -0,0 +1,70 @@
+"""Concurrent FusionPredictor.preprocess calls sharing one VolumeCache"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('pydicom')
+pytest.importorskip('torchvision')
+
+from clinical_data_rnn import ClinicalEncoder
+from inference_server import FusionPredictor
+from mri_images_cnn import TumorFeatureCNN
+from synthetic_data import write_dicom_series
+from volume_cache import VolumeCache
+
+
+def make_predictor(cache):
+    """FusionPredictor with just the parts preprocess uses, no Keras models"""
+    from torchvision.transforms import Resize, Compose
+
+    predictor = FusionPredictor.__new__(FusionPredictor)
+    predictor.encoder = ClinicalEncoder(target_col='Recurrence event').fit(
+        pd.DataFrame({'Age': [40.0, 50.0, 60.0], 'Grade': ['1', '2', '3'], 'Recurrence event': [0, 1, 0]}))
+    predictor.cnn = TumorFeatureCNN(use_mask=False, in_channels=1).eval()
+    predictor.target_size = (32, 32)
+    predictor.transform = Compose([Resize(predictor.target_size)])
+    predictor.cache = cache
+    predictor.roi_margin = None
+    return predictor
+
+
+@pytest.mark.parametrize('max_bytes', [512 * 1024 ** 2, 3 * 32 * 32 * 4])
+def test_concurrent_preprocess(tmp_path, max_bytes):
+    # A budget of three entries makes nearly every put evict while other threads read
+    rng = np.random.default_rng(0)
+    series = []
+    for i in range(6):
+        series_dir = str(tmp_path / 'dicom' / f'P{i}')
+        write_dicom_series(rng.integers(0, 1000, (3, 48, 48), dtype=np.uint16), series_dir, f'P{i}')
+        series.append(series_dir)
+    predictor = make_predictor(VolumeCache(cache_dir=str(tmp_path / 'cache'), max_bytes=max_bytes))
+    requests = [{'series_dir': series[i % len(series)], 'clinical': {'Age': 45.0, 'Grade': '2'}}
+                for i in range(240)]
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(predictor.preprocess, requests))
+
+    expected = {series_dir: make_predictor(None).preprocess({'series_dir': series_dir})[0] for series_dir in series}
+    for request, (image, mask, clinical) in zip(requests, results):
+        assert image.shape == (1, 32, 32)
+        np.testing.assert_allclose(image.numpy(), expected[request['series_dir']].numpy(), rtol=1e-6)
+        assert mask is None
+        assert clinical.shape == (2,)
+    assert predictor.cache.nbytes <= max_bytes
+    assert not [name for name in os.listdir(tmp_path / 'cache') if name.endswith('.tmp')]
+
+
+def test_concurrent_put_same_key(tmp_path):
+    cache = VolumeCache(cache_dir=str(tmp_path))
+    arrays = [np.full((64, 64), i, np.float32) for i in range(16)]
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(lambda array: cache.put('series', array), arrays))
+
+    stored = np.load(tmp_path / 'series.npy')
+    assert any(np.array_equal(stored, array) for array in arrays)
+    assert os.listdir(tmp_path) == ['series.npy']
@@ -0,0 +1,34 @@
+"""Padding and masking of variable-length visit sequences"""
+
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+
+from clinical_data_rnn import build_advanced_rnn_model
+from tf_input import SEQUENCE_PAD, pad_sequences, make_sequence_dataset
+
+
+def test_all_zero_visit_is_not_masked():
+    # A visit whose features all encode to 0.0 (means, category code 0, NaN fill) is real data
+    sequences = [np.zeros((2, 3), np.float32), np.ones((1, 3), np.float32)]
+    masking = tf.keras.layers.Masking(mask_value=SEQUENCE_PAD)
+
+    mask = np.asarray(masking.compute_mask(tf.constant(pad_sequences(sequences))))
+    np.testing.assert_array_equal(mask, [[True, True], [True, False]])
+
+    (batch, _), = make_sequence_dataset(sequences, [0, 1], batch_size=2, bucket_boundaries=[]).take(1)
+    np.testing.assert_array_equal(np.asarray(masking.compute_mask(batch)), [[True, True], [True, False]])
+
+
+@pytest.mark.parametrize('bidirectional', [False, True])
+def test_masked_rnn_sees_all_zero_visit(bidirectional):
+    tf.keras.utils.set_random_seed(0)
+    model = build_advanced_rnn_model(input_shape=(None, 3), units=4, bidirectional=bidirectional, masking=True)
+    visit = np.full((1, 3), 0.5, np.float32)
+    with_zero_visit = pad_sequences([np.concatenate([visit, np.zeros((1, 3), np.float32)]), visit])
+
+    probs = model.predict_on_batch(with_zero_visit).ravel()
+    # The padded step of the second patient is skipped, the all-zero visit of the first is not
+    assert probs[0] != pytest.approx(probs[1], abs=1e-7)
+    assert probs[1] == pytest.approx(model.predict_on_batch(visit[None]).ravel()[0], abs=1e-6)
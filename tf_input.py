@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""tf.data input pipelines for the RNN and fusion models.
+
+Passing NumPy arrays to model.fit makes Keras wrap them in a fresh data adapter on
+every call and feed batches synchronously, with no prefetching. make_dataset turns
+in-memory arrays into a prefetched tf.data pipeline instead. The arrays become
+tensors once, and each batch is gathered with a single tf.gather from a shuffled
+index batch rather than slicing and re-batching every row. Unshuffled
+(validation) pipelines are cached after the first pass.
+
+make_sequence_dataset batches variable-length per-patient visit sequences. It
+buckets them by length and pads each batch only to its own longest sequence (with
+SEQUENCE_PAD, which a Keras Masking layer skips), so short histories don't pay
+for the longest patient in the cohort.
+
+stream_fused_features serves the aligned CNN/RNN feature stores (feature_store.py)
+straight from their memory maps for cohorts that don't fit in RAM. Rows are read
+in blocks, so only one block is resident at a time. Shuffling permutes the block
+order and the rows within each block, which is a close approximation of a full
+shuffle for block sizes well above the batch size.
+"""
+
+import numpy as np
+
+from feature_store import load_features, join_rows
+
+
+def make_dataset(x, y=None, batch_size=32, shuffle=False, seed=None, cache=True):
+    """
+    Batched, prefetched tf.data.Dataset over in-memory arrays
+
+    Parameters:
+    -----------
+    x : array-like or dict of array-like
+        Model inputs, a dict for multi-input models (e.g. {'cnn_in': ..., 'rnn_in': ...})
+    y : array-like, optional
+        Labels; the dataset yields (x, y) batches if given, x batches otherwise
+    batch_size : int, default=32
+        Rows per batch (the last batch may be smaller)
+    shuffle : bool, default=False
+        Reshuffle the rows every epoch (as model.fit does for arrays)
+    seed : int, optional
+        Shuffle seed; None follows the global TensorFlow seed
+    cache : bool, default=True
+        Cache the batches of an unshuffled dataset after the first epoch
+
+    Returns:
+    --------
+    tf.data.Dataset
+    """
+    import tensorflow as tf
+
+    # Converted to tensors once, every batch is then a single gather per input
+    x = tf.nest.map_structure(lambda column: tf.convert_to_tensor(np.asarray(column, dtype=np.float32)), x)
+    n_rows = int(tf.nest.flatten(x)[0].shape[0])
+    if y is not None:
+        y = tf.convert_to_tensor(np.asarray(y, dtype=np.float32))
+
+    def gather(idx):
+        batch = tf.nest.map_structure(lambda column: tf.gather(column, idx), x)
+        return batch if y is None else (batch, tf.gather(y, idx))
+
+    ds = tf.data.Dataset.range(n_rows)
+    if shuffle:
+        ds = ds.shuffle(n_rows, seed=seed, reshuffle_each_iteration=True)
+    ds = ds.batch(batch_size).map(gather, num_parallel_calls=tf.data.AUTOTUNE)
+    if cache and not shuffle:
+        ds = ds.cache()
+    return ds.prefetch(tf.data.AUTOTUNE)
+
+
+# Padding value of variable-length sequences; the masked RNN skips all-SEQUENCE_PAD steps.
+# Not 0.0: a feature at its mean, categorical code 0 and the NaN fill all encode to 0.0,
+# so a real visit could be all zeros. Standardized values never get near -1e9.
+SEQUENCE_PAD = -1e9
+
+
+def pad_sequences(sequences, max_len=None):
+    """Stack (steps, features) arrays into one (n, max_len, features) array padded with SEQUENCE_PAD"""
+    max_len = max_len or max(len(seq) for seq in sequences)
+    n_features = sequences[0].shape[1]
+    padded = np.full((len(sequences), max_len, n_features), SEQUENCE_PAD, dtype=np.float32)
+    for i, seq in enumerate(sequences):
+        padded[i, :len(seq)] = seq[:max_len]
+    return padded
+
+
+def length_buckets(lengths, n_buckets=4):
+    """Bucket boundaries at the length quantiles, so buckets hold similar numbers of patients"""
+    quantiles = np.quantile(lengths, np.linspace(0, 1, n_buckets + 1)[1:-1])
+    return sorted({int(q) + 1 for q in quantiles if int(q) + 1 <= max(lengths)})
+
+
+def make_sequence_dataset(sequences, labels=None, batch_size=32, shuffle=False, seed=None,
+                          bucket_boundaries=None):
+    """
+    Length-bucketed, padded and prefetched tf.data.Dataset over variable-length sequences
+
+    Parameters:
+    -----------
+    sequences : list of numpy.ndarray
+        One (steps, features) array per patient, steps may differ
+    labels : array-like, optional
+        One label per sequence; batches are (x, y) if given, x otherwise
+    batch_size : int, default=32
+        Sequences per batch (batches at the end of a bucket may be smaller)
+    shuffle : bool, default=False
+        Reshuffle the sequences every epoch before bucketing
+    seed : int, optional
+        Shuffle seed; None follows the global TensorFlow seed
+    bucket_boundaries : list of int, optional
+        Length boundaries between buckets, default length_buckets(lengths)
+
+    Returns:
+    --------
+    tf.data.Dataset
+        Batches of shape (batch, longest sequence in the batch, features); batch order
+        differs from the input order whenever there is more than one bucket
+    """
+    import tensorflow as tf
+
+    lengths = np.asarray([len(seq) for seq in sequences], dtype=np.int64)
+    values = np.concatenate(sequences).astype(np.float32)
+    # One ragged tensor for the whole cohort instead of a Python generator per patient
+    ragged = tf.RaggedTensor.from_row_lengths(values, lengths)
+
+    # Each slice is a (steps, features) sequence; make sure it is a dense tensor for bucketing
+    def dense(x):
+        return x.to_tensor() if isinstance(x, tf.RaggedTensor) else x
+
+    if labels is None:
+        ds = tf.data.Dataset.from_tensor_slices(ragged).map(dense)
+    else:
+        labels = tf.convert_to_tensor(np.asarray(labels, dtype=np.float32))
+        ds = tf.data.Dataset.from_tensor_slices((ragged, labels)).map(lambda x, y: (dense(x), y))
+    if shuffle:
+        ds = ds.shuffle(len(sequences), seed=seed, reshuffle_each_iteration=True)
+
+    if bucket_boundaries is None:
+        bucket_boundaries = length_buckets(lengths)
+    element_length = (lambda x: tf.shape(x)[0]) if labels is None else (lambda x, y: tf.shape(x)[0])
+    ds = ds.bucket_by_sequence_length(
+        element_length,
+        bucket_boundaries=bucket_boundaries,
+        bucket_batch_sizes=[batch_size] * (len(bucket_boundaries) + 1),
+        padding_values=(SEQUENCE_PAD if labels is None else (SEQUENCE_PAD, 0.0)),
+    )
+    return ds.prefetch(tf.data.AUTOTUNE)
+
+
+def stream_fused_features(cnn_path='cnn_features', rnn_path='rnn_features', rows=None,
+                          batch_size=32, shuffle=False, block_rows=65536, seed=42):
+    """
+    Stream aligned ({'cnn_in', 'rnn_in'}, label) batches from two feature stores on disk
+
+    Parameters:
+    -----------
+    cnn_path, rnn_path : str
+        Feature store directories; rows are aligned on id in the RNN store's order
+        with labels from the RNN side, like fusion_layer.load_aligned_features
+    rows : array-like, optional
+        Positions into the aligned order to serve (e.g. a train split), default all
+    batch_size : int, default=32
+        Rows per batch
+    shuffle : bool, default=False
+        Shuffle block order and rows within each block every epoch
+    block_rows : int, default=65536
+        Rows read from the memory maps at a time, bounds resident memory
+    seed : int, default=42
+        Seed of the first epoch's shuffle (epoch e uses seed + e)
+
+    Returns:
+    --------
+    tf.data.Dataset
+    """
+    import tensorflow as tf
+
+    rnn = load_features(rnn_path)
+    cnn = load_features(cnn_path)
+    rnn_rows, cnn_rows, _ = join_rows(rnn, cnn)
+    positions = np.arange(len(rnn_rows)) if rows is None else np.asarray(rows, dtype=np.intp)
+    epoch = [0]
+
+    def batches():
+        rng = np.random.default_rng(seed + epoch[0])
+        epoch[0] += 1
+        blocks = [positions[i:i + block_rows] for i in range(0, len(positions), block_rows)]
+        if shuffle:
+            blocks = [blocks[i] for i in rng.permutation(len(blocks))]
+        for block in blocks:
+            # Read in file order so the memory maps are touched sequentially
+            block = np.sort(block)
+            cnn_block = np.asarray(cnn.features[cnn_rows[block]])
+            rnn_block = np.asarray(rnn.features[rnn_rows[block]])
+            labels = np.asarray(rnn.labels[rnn_rows[block]])
+            order = rng.permutation(len(block)) if shuffle else np.arange(len(block))
+            for start in range(0, len(order), batch_size):
+                idx = order[start:start + batch_size]
+                yield {'cnn_in': cnn_block[idx], 'rnn_in': rnn_block[idx]}, labels[idx]
+
+    signature = (
+        {'cnn_in': tf.TensorSpec((None, cnn.n_features), tf.float32),
+         'rnn_in': tf.TensorSpec((None, rnn.n_features), tf.float32)},
+        tf.TensorSpec((None,), tf.float32),
+    )
+    n_batches = sum(-(-len(positions[i:i + block_rows]) // batch_size)
+                    for i in range(0, len(positions), block_rows))
+    ds = tf.data.Dataset.from_generator(batches, output_signature=signature)
+    # Known length, so Keras shows progress and needs no steps_per_epoch
+    ds = ds.apply(tf.data.experimental.assert_cardinality(n_batches))
+    return ds.prefetch(tf.data.AUTOTUNE)
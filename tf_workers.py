@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""Helpers for running TensorFlow work in a pool of worker processes.
+
+TensorFlow sizes its thread pools to the whole machine the first time it runs an
+op, so N workers on a 32-core node would each start 32 intra-op threads and fight
+over the cores. Workers are therefore started with the "spawn" method (TF is not
+fork-safe once initialised in the parent) and pin their TF thread pools to their
+share of the cores before touching TensorFlow.
+"""
+
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+
+def threads_per_worker(n_jobs, total=None):
+    """Split total cores (default: all) evenly over n_jobs workers, at least one each"""
+    total = total or os.cpu_count() or 1
+    return max(1, total // max(1, n_jobs))
+
+
+def limit_tf_threads(intra_op, inter_op=1):
+    """Pin TensorFlow's thread pools; must run before the first TF op in the process"""
+    os.environ.setdefault('TF_CPP_MIN_LOG_LEVEL', '2')
+    import tensorflow as tf
+
+    tf.config.threading.set_intra_op_parallelism_threads(intra_op)
+    tf.config.threading.set_inter_op_parallelism_threads(inter_op)
+
+
+def _init_worker(intra_op, inter_op, initializer, initargs):
+    limit_tf_threads(intra_op, inter_op)
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def tf_process_pool(n_jobs, initializer=None, initargs=(), threads=None):
+    """
+    ProcessPoolExecutor of n_jobs spawned workers with per-worker TF thread limits
+
+    threads: intra-op threads per worker (default: cores // n_jobs)
+    initializer/initargs: optional extra per-worker setup, run after the thread limits
+    """
+    threads = threads or threads_per_worker(n_jobs)
+    return ProcessPoolExecutor(
+        max_workers=n_jobs,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=_init_worker,
+        initargs=(threads, 1, initializer, initargs),
+    )
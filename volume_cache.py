@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""Decoded-volume cache for the MRI loaders.
+
+Decoding a DICOM series with pydicom, collapsing Z and resizing it is by far the
+most expensive part of each epoch, and the result never changes between epochs.
+VolumeCache keeps decoded arrays in an in-memory LRU (bounded by a byte budget)
+backed by one .npy file per entry on disk. Keys are content-addressed: they are a
+hash of the source file list, their sizes and mtimes, and the preprocessing
+parameters, so editing or replacing a series automatically invalidates its entry.
+A VolumeCache can be shared by threads (e.g. the inference server's handlers).
+"""
+
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# Bump when the preprocessing in the loaders changes so stale entries are ignored
+CACHE_VERSION = 1
+
+
+def fingerprint_files(paths, *params):
+    """Return a hex key for a list of source files plus preprocessing parameters"""
+    h = hashlib.sha1()
+    h.update(f"v{CACHE_VERSION}".encode())
+    for path in paths:
+        st = os.stat(path)
+        h.update(f"{os.path.basename(path)}|{st.st_size}|{st.st_mtime_ns};".encode())
+    for param in params:
+        h.update(repr(param).encode())
+    return h.hexdigest()
+
+
+class VolumeCache:
+    def __init__(self, cache_dir=None, max_bytes=512 * 1024 ** 2):
+        """
+        cache_dir: directory for the on-disk .npy entries (None keeps the cache in memory only)
+        max_bytes: byte budget of the in-memory LRU
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        # Guards _entries, _bytes and the hit/miss counters, disk I/O runs outside it
+        self._lock = threading.Lock()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def __getstate__(self):
+        # Locks don't pickle, e.g. when a Dataset holding the cache goes to spawned DataLoader workers
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries or (self.cache_dir is not None and os.path.exists(self._path(key)))
+
+    @property
+    def nbytes(self):
+        return self._bytes
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".npy")
+
+    def _remember(self, key, array):
+        # Caller holds self._lock
+        if key in self._entries:
+            self._bytes -= self._entries.pop(key).nbytes
+        # Entries bigger than the whole budget would just flush everything else
+        if array.nbytes > self.max_bytes:
+            return
+        array.flags.writeable = False
+        self._entries[key] = array
+        self._bytes += array.nbytes
+        while self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted.nbytes
+
+    def get(self, key):
+        """Return the cached array for key, or None on a miss"""
+        with self._lock:
+            array = self._entries.get(key)
+            if array is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return array
+
+        if self.cache_dir is not None:
+            path = self._path(key)
+            if os.path.exists(path):
+                try:
+                    array = np.load(path, allow_pickle=False)
+                except (OSError, ValueError):
+                    # Partially written or corrupt entry, drop it and decode again
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        # Another thread or process dropped or replaced it first
+                        pass
+                else:
+                    with self._lock:
+                        self._remember(key, array)
+                        self.hits += 1
+                    return array
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, array):
+        """Store array under key in memory and (if configured) on disk"""
+        # Own a private contiguous copy, cached entries are handed out read-only
+        array = np.array(array, order="C")
+        if self.cache_dir is not None:
+            path = self._path(key)
+            # Private temp name per writer, threads of one process may store the same key at once
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, array, allow_pickle=False)
+            # Atomic rename so concurrent DataLoader workers never read half a file
+            os.replace(tmp_path, path)
+        with self._lock:
+            self._remember(key, array)
+        return array
+
+    def clear(self, disk=False):
+        """Drop the in-memory entries, and the on-disk ones too if disk=True"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+        if disk and self.cache_dir is not None:
+            for name in os.listdir(self.cache_dir):
+                if name.endswith(".npy"):
+                    os.remove(os.path.join(self.cache_dir, name))